@@ -0,0 +1,111 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare the memory kept alive by a feed made of mapped Episode
+instances against one made of EpisodeRow
+
+usage: python benchmarks/episodes.py [episodes]
+"""
+
+import gc
+import sys
+
+from datetime import date, timedelta
+from timeit import timeit
+
+from sqlalchemy import create_engine
+
+from webisoder.models import Base, DBSession, Episode, EpisodeRow, Show
+
+SHOWS = 100
+
+
+def setup(episodes):
+
+	engine = create_engine("sqlite://")
+	DBSession.configure(bind=engine)
+	Base.metadata.create_all(engine)
+
+	today = date.today()
+	per_show = episodes // SHOWS
+
+	engine.execute(Show.__table__.insert(), [{"show_id": id,
+		"url": "%d" % id, "show_name": "Show %d" % id, "status": 1,
+		"enabled": True, "updated": None, "next_airdate": None}
+		for id in range(SHOWS)])
+	engine.execute(Episode.__table__.insert(), [{"show_id": id,
+		"season": 1, "num": num, "title": "Episode %d" % num,
+		"airdate": today + timedelta(num % 30), "totalnum": num,
+		"prodnum": "%d" % num} for id in range(SHOWS)
+		for num in range(per_show)])
+
+
+def orm_feed():
+
+	episodes = DBSession.query(Episode).all()
+
+	for episode in episodes:
+		episode.show.name
+
+	return episodes
+
+
+def row_feed():
+
+	return EpisodeRow.query()
+
+
+def allocated(func):
+
+	""" The number of objects and bytes that stay alive while the result
+	of func and the session holding it are in use
+	"""
+	gc.collect()
+	before = gc.get_objects()
+	ids = set(id(obj) for obj in before)
+	size = sum(sys.getsizeof(obj) for obj in before)
+
+	result = func()
+	gc.collect()
+	after = gc.get_objects()
+	new = [obj for obj in after if id(obj) not in ids]
+
+	count = len(new)
+	size = sum(sys.getsizeof(obj) for obj in after) - size
+
+	del(result, new, before, after)
+	DBSession.remove()
+
+	return count, size
+
+
+def main(argv=sys.argv):
+
+	episodes = int(argv[1]) if len(argv) > 1 else 5000
+	setup(episodes)
+
+	print("%d episodes of %d shows" % (episodes, SHOWS))
+
+	for name, func in [("Episode", orm_feed), ("EpisodeRow", row_feed)]:
+		objects, size = allocated(func)
+		time = timeit(lambda: (func(), DBSession.remove()), number=10)
+
+		print("%-10s %7d objects %9.1f kB %7.1f ms" % (name, objects,
+					size / 1024.0, time * 100))
+
+
+if __name__ == "__main__":
+	main()
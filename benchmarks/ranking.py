@@ -0,0 +1,70 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare per-row ResultRating against the batch ranker
+
+usage: python benchmarks/ranking.py [rows]
+"""
+
+import sys
+
+from random import Random
+from timeit import timeit
+
+from webisoder.models import ResultRating
+from webisoder.ranking import rank
+
+WORDS = ["doctor", "who", "the", "big", "bang", "theory", "show", "night",
+	"late", "star", "trek", "law", "order", "house", "of", "cards"]
+
+
+def make_result(rows):
+
+	random = Random(rows)
+	return [{"seriesname": " ".join(random.choice(WORDS).title()
+		for _ in range(random.randint(1, 5))), "seriesid": id}
+		for id in range(rows)]
+
+
+def per_row(search, result):
+
+	for row in result:
+		row["rating"] = ResultRating(search, row["seriesname"])
+
+	return sorted(result, key=lambda row: row["rating"], reverse=True)
+
+
+def main(argv=sys.argv):
+
+	sizes = [int(argv[1])] if len(argv) > 1 else [100, 1000, 10000, 100000]
+
+	for rows in sizes:
+		result = make_result(rows)
+		number = max(1, 100000 // rows)
+
+		for search in ["doctor who", "star"]:
+			old = timeit(lambda: per_row(search, result), number=number)
+			new = timeit(lambda: rank(search, result), number=number)
+			top = timeit(lambda: rank(search, result, 50), number=number)
+
+			print("%7d rows %-12s per-row %8.3f ms  batch %8.3f ms  "
+				"batch top 50 %8.3f ms" % (rows, repr(search),
+				old * 1000 / number, new * 1000 / number,
+				top * 1000 / number))
+
+
+if __name__ == "__main__":
+	main()
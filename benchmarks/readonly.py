@@ -0,0 +1,130 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare a feed request on the transaction-managed DBSession with the
+same request on ReadSession, which skips the transaction manager
+
+usage: python benchmarks/readonly.py [requests]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import transaction
+
+from datetime import date, timedelta
+from timeit import timeit
+
+from sqlalchemy import create_engine
+
+from webisoder.models import Base, DBSession, Episode, ReadSession, Show
+from webisoder.models import User, subscriptions, sync_upcoming
+from webisoder.pragmas import configure_sqlite
+
+SHOWS = 20
+EPISODES = 50
+
+
+def setup(path):
+
+	engine = create_engine("sqlite:///%s" % path)
+	configure_sqlite(engine, {})
+	DBSession.configure(bind=engine)
+	ReadSession.configure(bind=engine)
+	Base.metadata.create_all(engine)
+
+	today = date.today()
+
+	engine.execute(User.__table__.insert(), [{"user_name": "user",
+		"mail": "user", "passwd": "x", "token": "token",
+		"days_back": 7}])
+	engine.execute(Show.__table__.insert(), [{"show_id": id,
+		"url": "%d" % id, "show_name": "Show %d" % id, "status": 1,
+		"enabled": True} for id in range(SHOWS)])
+	engine.execute(subscriptions.insert(), [{"show_id": id,
+		"user_name": "user"} for id in range(SHOWS)])
+	engine.execute(Episode.__table__.insert(), [{"show_id": id,
+		"season": 1, "num": num, "title": "Episode %d" % num,
+		"airdate": today + timedelta(7 * (num - EPISODES + 2))}
+		for id in range(SHOWS) for num in range(EPISODES)])
+
+	with engine.begin() as connection:
+		sync_upcoming(connection)
+
+
+def feed(session):
+
+	user = session.query(User).get("user")
+	then = date.today() - timedelta(int(user.days_back))
+	return user.episodes_since(then)
+
+
+def token(session):
+
+	return session.query(User).get("user").token
+
+
+def managed(view):
+
+	def request():
+
+		with transaction.manager:
+			view(DBSession)
+
+		DBSession.remove()
+
+	return request
+
+
+def readonly(view):
+
+	def request():
+
+		view(ReadSession)
+		ReadSession.remove()
+
+	return request
+
+
+def main(argv=sys.argv):
+
+	requests = int(argv[1]) if len(argv) > 1 else 2000
+	tmp = tempfile.mkdtemp()
+
+	try:
+		setup(os.path.join(tmp, "webisoder.sqlite"))
+
+		print("%d requests, %d episodes per feed" % (requests,
+					len(feed(ReadSession))))
+		ReadSession.remove()
+
+		for view in [token, feed]:
+			for name, wrap in [("DBSession", managed),
+						("ReadSession", readonly)]:
+				func = wrap(view)
+				func()
+				time = timeit(func, number=requests)
+
+				print("%-6s %-11s %8.1f us per request" % (
+					view.__name__, name,
+					time * 1e6 / requests))
+	finally:
+		shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+	main()
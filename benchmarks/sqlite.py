@@ -0,0 +1,152 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Measure feed-like reads while episodes are bulk written, with the
+SQLite defaults and with the pragmas from webisoder.pragmas
+
+usage: python benchmarks/sqlite.py [seconds] [readers]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+from datetime import date, timedelta
+from threading import Event, Thread
+from time import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+
+from webisoder.models import Base, Episode, Show
+from webisoder.pragmas import configure_sqlite
+
+SHOWS = 500
+BATCH = 5000
+
+# Rows per write transaction, like a snapshot import or a large refresh
+TRANSACTION = 100000
+
+episodes = Episode.__table__
+
+
+def setup(path, tuned):
+
+	engine = create_engine("sqlite:///%s" % path)
+
+	if tuned:
+		configure_sqlite(engine, {})
+	else:
+		# Disable everything, as if there was no tuning
+		configure_sqlite(engine, {"journal_mode": "", "synchronous": "",
+			"mmap_size": "", "cache_size": "", "busy_timeout": "",
+			"temp_store": ""}, "")
+
+	Base.metadata.create_all(engine)
+	engine.execute(Show.__table__.insert(), [{"show_id": id,
+		"url": "%d" % id, "show_name": "Show %d" % id, "status": 1,
+		"enabled": True, "updated": None, "next_airdate": None}
+		for id in range(SHOWS)])
+
+	return engine
+
+
+def write(engine, stop, stats):
+
+	today = date.today()
+	season = 0
+
+	while not stop.is_set():
+		try:
+			with engine.begin() as connection:
+				for _ in range(TRANSACTION // BATCH):
+					season += 1
+					rows = [{"show_id": num % SHOWS,
+						"season": season, "num": num,
+						"airdate": today + timedelta(num % 30),
+						"title": "Episode %d" % num,
+						"totalnum": num, "prodnum": None}
+						for num in range(BATCH)]
+					connection.execute(episodes.insert(), rows)
+
+			stats["written"] += TRANSACTION
+		except OperationalError:
+			stats["write errors"] += 1
+
+
+def read(engine, stop, stats):
+
+	today = date.today()
+	query = select([episodes]).where(episodes.c.show_id.in_(range(20))
+				).where(episodes.c.airdate >= today)
+
+	while not stop.is_set():
+		try:
+			with engine.connect() as connection:
+				connection.execute(query).fetchall()
+			stats["reads"] += 1
+		except OperationalError:
+			stats["read errors"] += 1
+
+
+def run(tuned, seconds, readers):
+
+	directory = tempfile.mkdtemp()
+
+	try:
+		engine = setup(os.path.join(directory, "bench.sqlite"), tuned)
+		stats = {"reads": 0, "read errors": 0, "written": 0,
+							"write errors": 0}
+		stop = Event()
+
+		threads = [Thread(target=write, args=(engine, stop, stats))]
+		threads.extend(Thread(target=read, args=(engine, stop, stats))
+						for _ in range(readers))
+
+		start = time()
+
+		for thread in threads:
+			thread.start()
+
+		stop.wait(seconds)
+		stop.set()
+
+		for thread in threads:
+			thread.join()
+
+		elapsed = time() - start
+		engine.dispose()
+	finally:
+		shutil.rmtree(directory)
+
+	print("%-8s %8.1f reads/s %6d read errors %9.1f rows/s written "
+		"%4d write errors" % ("tuned" if tuned else "default",
+		stats["reads"] / elapsed, stats["read errors"],
+		stats["written"] / elapsed, stats["write errors"]))
+
+
+def main(argv=sys.argv):
+
+	seconds = float(argv[1]) if len(argv) > 1 else 10
+	readers = int(argv[2]) if len(argv) > 2 else 4
+
+	for tuned in [False, True]:
+		run(tuned, seconds, readers)
+
+
+if __name__ == "__main__":
+	main()
@@ -9,13 +9,13 @@ with open(os.path.join(here, 'CHANGES.txt')) as f:
     CHANGES = f.read()
 
 requires = [
-    'pyramid >= 1.7',
+    'pyramid >= 1.9',
     'pyramid_chameleon',
     'pyramid_debugtoolbar',
     'pyramid_tm',
     'pyramid_beaker',
     'pyramid_mailer',
-    'SQLAlchemy',
+    'SQLAlchemy >= 1.2',
     'transaction',
     'zope.sqlalchemy',
     'waitress',
@@ -51,5 +51,13 @@ setup(name='webisoder',
       main = webisoder:main
       [console_scripts]
       initialize_webisoder_db = webisoder.scripts.initializedb:main
+      refresh_webisoder_shows = webisoder.scripts.refresh:main
+      fake_tvdb_server = webisoder.scripts.fake_tvdb:main
+      export_webisoder_snapshot = webisoder.scripts.snapshot:export_main
+      import_webisoder_snapshot = webisoder.scripts.snapshot:import_main
+      maintain_webisoder_upcoming = webisoder.scripts.upcoming:main
+      archive_webisoder_episodes = webisoder.scripts.archive:main
+      rebalance_webisoder_shards = webisoder.scripts.shards:main
+      aggregate_webisoder_profiles = webisoder.scripts.profiles:main
       """,
       )
@@ -14,16 +14,32 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import transaction
+
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
 
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.authentication import SessionAuthenticationPolicy
 from pyramid.httpexceptions import HTTPFound
+from pyramid.tweens import INGRESS
 
 from pyramid_beaker import set_cache_regions_from_settings
 
-from .models import DBSession, Base
+from .airdates import airdates
+from .engines import engine_from_settings, shard_engines
+from .jobs import import_queue
+from .metrics import metrics as app_metrics
+from .models import ArchivedEpisode, DBSession, ReadSession, ReplicaSession
+from .models import Base, fill_upcoming
+from .profiling import profiler
+from .queries import collector
+from .readonly import replica
+from .retry import retry_policy
+from .search import search_cache
+from .shards import shard_binds
+from .subscribers import subscribers
+from .tvdb import TVDBWrapper, breaker, pool, stale_cache
+from .users import request_user
 
 def redirect_login(request):
 
@@ -33,12 +49,69 @@ def main(global_config, **settings):
 
 	""" This function returns a Pyramid WSGI application.
 	"""
-	engine = engine_from_config(settings, 'sqlalchemy.')
+	engine = engine_from_settings(settings)
 	DBSession.configure(bind=engine)
 	Base.metadata.bind = engine
 
+	ReadSession.configure(bind=engine)
+	shards = shard_engines(settings, engine)
+
+	collector.configure(settings, "webisoder.queries.")
+
+	for e in [engine] + shards:
+		collector.watch(e)
+
+	if shards:
+		DBSession.configure(shards=shard_binds(engine, shards))
+		ReadSession.configure(shards=shard_binds(engine, shards))
+
+	if settings.get("sqlalchemy.replica.url"):
+		replica.bind(engine_from_settings(settings,
+							"sqlalchemy.replica."))
+		collector.watch(replica.engine)
+
+		# Only the catalog is read from the replica
+		if shards:
+			ReplicaSession.configure(shards=shard_binds(
+						replica.engine, shards))
+
+	replica.configure(settings, "webisoder.replica.")
+
 	set_cache_regions_from_settings(settings)
+	search_cache.configure(settings)
+	breaker.configure(settings, "webisoder.tvdb.")
+	stale_cache.configure(settings, "webisoder.tvdb.")
+	pool.configure(settings, "webisoder.tvdb.")
+	TVDBWrapper.base_url = settings.get("webisoder.tvdb.base_url")
+	ArchivedEpisode.DAYS = int(settings.get("webisoder.archive.days", 0))
+	import_queue.configure(settings, "webisoder.import.")
+	airdates.configure(settings, "webisoder.calendar.")
+	subscribers.configure(settings, "webisoder.subscribers.")
+	app_metrics.configure(settings, "webisoder.metrics.")
+
+	# The upcoming episodes are created empty by an upgrade
+	with engine.begin() as connection:
+		fill_upcoming(connection)
+
+	with transaction.manager:
+		airdates.build()
+		subscribers.load()
+
+	subscribers.start()
+
 	config = Configurator(settings=settings, root_factory='.resources.Root')
+	retry_policy.configure(settings, "webisoder.retry.")
+	config.set_execution_policy(retry_policy)
+	config.add_tween("webisoder.queries.query_tween_factory",
+								under=INGRESS)
+	config.add_tween("webisoder.metrics.metrics_tween_factory",
+								under=INGRESS)
+
+	profiler.configure(settings, "webisoder.profile.")
+
+	if profiler.enabled:
+		config.add_tween("webisoder.profiling.profile_tween_factory",
+								under=INGRESS)
 
 	authentication_policy = SessionAuthenticationPolicy()
 	authorization_policy = ACLAuthorizationPolicy()
@@ -47,6 +120,7 @@ def main(global_config, **settings):
 	config.set_authentication_policy(authentication_policy)
 	config.set_authorization_policy(authorization_policy)
 	config.add_forbidden_view(redirect_login)
+	config.add_request_method(request_user, "user", reify=True)
 	config.include('pyramid_chameleon')
 	config.include("pyramid_beaker")
 	config.add_static_view('static', 'static', cache_max_age=3600)
@@ -60,6 +134,7 @@ def main(global_config, **settings):
 	config.add_route('shows', '/shows')
 	config.add_route('banners', '/banners/{show_id}')
 	config.add_route('search', '/search')
+	config.add_route('suggest', '/search/suggest')
 	config.add_route('profile', '/profile')
 	config.add_route('settings_feed', '/settings/feeds')
 	config.add_route('settings_pw', '/settings/password')
@@ -71,6 +146,7 @@ def main(global_config, **settings):
 	config.add_route('html', '/episodes/{user}/{token}')
 	config.add_route('subscribe', '/subscribe')
 	config.add_route('unsubscribe', '/unsubscribe')
+	config.add_route('metrics', '/metrics')
 	config.add_route('setup', '/setup') # TODO remove this
 	config.scan()
 	return config.make_wsgi_app()
@@ -0,0 +1,251 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date, datetime, timedelta
+from threading import Lock
+from time import time
+
+from sqlalchemy import event
+
+from .models import DBSession, Episode, EpisodeRow, Show, UpcomingEpisode
+from .models import catalog_change
+
+
+class AirdateIndex(object):
+
+	""" An in-memory calendar of all episodes airing in the feed window,
+	shared by all feed requests. Episode rows are kept per airdate and per
+	show; shows that change in this process are reloaded on the next
+	lookup, changes made elsewhere are picked up from Show.updated. The
+	whole index is rebuilt when the catalog changed in a way that does not
+	show there, see CATALOG_CHANGE.
+	"""
+
+	def __init__(self, days=7, interval=60, overlap=300):
+
+		self.days = days
+		self.interval = interval
+		self.overlap = overlap
+		self.dates = {}
+		self.shows = {}
+		self.start = None
+		self.stale = set()
+		self.checked = None
+		self.change = None
+		self.last_refresh = None
+		self.lock = Lock()
+
+	def configure(self, settings, prefix):
+
+		self.days = int(settings.get(prefix + "days", self.days))
+		self.interval = int(settings.get(prefix + "interval",
+								self.interval))
+		self.overlap = int(settings.get(prefix + "overlap",
+								self.overlap))
+
+	def window(self):
+
+		return date.today() - timedelta(self.days)
+
+	def query(self, start, shows=None, session=DBSession):
+
+		if start < UpcomingEpisode.start():
+			table, rows = Episode, EpisodeRow.query
+		else:
+			table, rows = UpcomingEpisode, UpcomingEpisode.rows
+
+		criteria = [table.airdate >= start]
+
+		if shows is not None:
+			criteria.append(table.show_id.in_(shows))
+
+		return rows(*criteria, session=session)
+
+	def __add(self, episode):
+
+		self.dates.setdefault(episode.airdate, []).append(episode)
+		self.shows.setdefault(episode.show.id, []).append(episode)
+
+	def __remove(self, show_id):
+
+		for episode in self.shows.pop(show_id, []):
+			bucket = self.dates[episode.airdate]
+			bucket.remove(episode)
+
+			if not bucket:
+				del(self.dates[episode.airdate])
+
+	def build(self, session=DBSession):
+
+		""" Load all episodes of the feed window
+		"""
+		start = self.window()
+		checked = datetime.now()
+		change = catalog_change(session)
+		episodes = self.query(start, session=session)
+
+		with self.lock:
+			self.dates = {}
+			self.shows = {}
+			self.start = start
+			self.stale = set()
+			self.checked = checked
+			self.change = change
+			self.last_refresh = time()
+
+			for episode in episodes:
+				self.__add(episode)
+
+	def invalidate(self, shows=None):
+
+		with self.lock:
+			if shows is None:
+				self.start = None
+			else:
+				self.stale.update(shows)
+
+	def prune(self):
+
+		""" Drop the days that have left the window
+		"""
+		start = self.window()
+
+		with self.lock:
+			for day in [d for d in self.dates if d < start]:
+				for episode in self.dates.pop(day):
+					show = self.shows[episode.show.id]
+					show.remove(episode)
+
+					if not show:
+						del(self.shows[episode.show.id])
+
+			self.start = start
+
+	def refresh(self, session=DBSession):
+
+		""" Bring the index up to date before a lookup
+		"""
+		if self.start is None:
+			return self.build(session)
+
+		now = time()
+
+		if now - self.last_refresh >= self.interval:
+			self.last_refresh = now
+
+			if catalog_change(session) != self.change:
+				return self.build(session)
+
+			checked = datetime.now()
+
+			# Show.updated is set before the change is committed, a
+			# commit that lands after our last check may carry an
+			# older time. Shows are looked at again for a while.
+			since = self.checked - timedelta(seconds=self.overlap)
+			updated = session.query(Show.id).filter(
+						Show.updated >= since)
+			self.invalidate(id for id, in updated)
+			self.checked = checked
+
+		if self.start < self.window():
+			self.prune()
+
+		with self.lock:
+			stale = self.stale
+			self.stale = set()
+
+		if not stale:
+			return
+
+		episodes = self.query(self.start, stale, session)
+
+		with self.lock:
+			for show_id in stale:
+				self.__remove(show_id)
+
+			for episode in episodes:
+				self.__add(episode)
+
+	def episodes(self, shows, then, session=DBSession):
+
+		""" The episodes of the given shows that air on or after the given
+		date, or None if that date is outside of the window
+		"""
+		self.refresh(session)
+
+		with self.lock:
+			if self.start is None or then < self.start:
+				return None
+
+			res = []
+
+			for show_id in set(shows).intersection(self.shows):
+				res.extend(e for e in self.shows[show_id]
+							if e.airdate >= then)
+
+		return sorted(res, key=lambda e: (e.airdate, e.show.id,
+							e.season, e.num))
+
+	def on(self, day):
+
+		""" All episodes airing on the given day
+		"""
+		self.refresh()
+
+		with self.lock:
+			return list(self.dates.get(day, []))
+
+	def watch(self, session):
+
+		""" Track changes to shows and episodes made through the given
+		session and reload the affected shows once they are committed
+		"""
+		def changed(session, context):
+
+			touched = session.info.setdefault("airdates", set())
+
+			if touched is None:
+				return
+
+			for obj in session.new | session.dirty | session.deleted:
+				if isinstance(obj, Episode):
+					touched.add(obj.show_id)
+				elif isinstance(obj, Show):
+					touched.add(obj.id)
+
+		def bulk_changed(context):
+
+			# There's no telling which shows a bulk statement affected
+			context.session.info["airdates"] = None
+
+		def committed(session):
+
+			if "airdates" in session.info:
+				self.invalidate(session.info.pop("airdates"))
+
+		def rolled_back(session):
+
+			session.info.pop("airdates", None)
+
+		event.listen(session, "after_flush", changed)
+		event.listen(session, "after_bulk_update", bulk_changed)
+		event.listen(session, "after_bulk_delete", bulk_changed)
+		event.listen(session, "after_commit", committed)
+		event.listen(session, "after_rollback", rolled_back)
+
+
+airdates = AirdateIndex()
+airdates.watch(DBSession)
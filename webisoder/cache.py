@@ -0,0 +1,82 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from beaker.cache import Cache, cache_regions
+
+from .metrics import metrics
+
+
+class CountedCache(object):
+
+	""" A beaker cache that counts hits and misses for its region
+	"""
+
+	def __init__(self, cache, region):
+
+		self.cache = cache
+		self.region = region
+
+	def __getattr__(self, name):
+
+		return getattr(self.cache, name)
+
+	def get(self, key, **kwargs):
+
+		createfunc = kwargs.get("createfunc")
+		created = []
+
+		if createfunc is not None:
+			def create():
+
+				created.append(True)
+				return createfunc()
+
+			kwargs["createfunc"] = create
+
+		try:
+			value = self.cache.get(key, **kwargs)
+		except KeyError:
+			metrics.cache_lookup(self.region, False)
+			raise
+
+		metrics.cache_lookup(self.region, not created)
+		return value
+
+
+def region_cache(namespace, region):
+
+	""" Return the beaker cache for a namespace in one of the configured
+	cache regions or None if the region is missing or disabled.
+	"""
+	settings = cache_regions.get(region)
+
+	if not settings or not settings.get("enabled", True):
+		return None
+
+	return CountedCache(Cache._get_cache(namespace, settings), region)
+
+
+def cached(namespace, region, key, create):
+
+	""" The value for key from a cache region, created once by calling
+	create if it is not cached yet
+	"""
+	cache = region_cache(namespace, region)
+
+	if cache is None:
+		return create()
+
+	return cache.get(key, createfunc=create)
@@ -0,0 +1,69 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import engine_from_config, event
+
+from .pragmas import configure_sqlite
+
+
+def engine_from_settings(settings, prefix="sqlalchemy."):
+
+	""" Create the engine configured under the given prefix, with the
+	SQLite pragmas applied. The settings of other engines nested below the
+	prefix (like sqlalchemy.replica.url) are left out.
+	"""
+	options = dict((key, value) for key, value in settings.items()
+		if key.startswith(prefix) and "." not in key[len(prefix):])
+
+	engine = engine_from_config(options, prefix)
+	configure_sqlite(engine, settings)
+	return engine
+
+
+def attach_catalog(engine, catalog):
+
+	""" Make the tables of the main SQLite database visible on every
+	connection of a shard. Other databases have to replicate the catalog to
+	each shard themselves.
+	"""
+	if engine.dialect.name != "sqlite" or catalog.dialect.name != "sqlite":
+		return
+
+	path = catalog.url.database
+
+	if not path or path == ":memory:":
+		raise ValueError("Shards need the main database in a file")
+
+	@event.listens_for(engine, "connect")
+	def attach(connection, record):
+
+		connection.execute("ATTACH DATABASE ? AS catalog", (path,))
+
+
+def shard_engines(settings, catalog, prefix="sqlalchemy."):
+
+	""" The engines of the user shards, in order, configured under
+	<prefix>shard0. to <prefix>shard<n-1>. for webisoder.shards.count = n
+	"""
+	engines = []
+
+	for index in range(int(settings.get("webisoder.shards.count", 0))):
+		engine = engine_from_settings(settings, "%sshard%d." % (prefix,
+								index))
+		attach_catalog(engine, catalog)
+		engines.append(engine)
+
+	return engines
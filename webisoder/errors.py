@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from tvdb_api import tvdb_error
+
 
 class LoginFailure(Exception):
 
@@ -36,6 +38,21 @@ class SubscriptionFailure(Exception):
 	pass
 
 
+class UpstreamUnavailable(tvdb_error):
+
+	pass
+
+
+class UpstreamBusy(UpstreamUnavailable):
+
+	pass
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+
+	pass
+
+
 class FormError(Exception):
 
 	def __init__(self, vals):
@@ -65,6 +65,7 @@ class UnSubscribeForm(MappingSchema):
 class SubscribeForm(MappingSchema):
 
 	url = SchemaNode(String(), validator=Length(min=1))
+	name = SchemaNode(String(), missing=None)
 
 class LoginForm(MappingSchema):
 
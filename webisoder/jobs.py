@@ -0,0 +1,263 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import transaction
+
+from datetime import date, datetime
+from Queue import Queue, Full
+from threading import Thread, Timer
+
+from tvdb_api import tvdb_attributenotfound, tvdb_shownotfound
+from zope.sqlalchemy import mark_changed
+
+from .models import ArchivedEpisode, DBSession, Episode, Show
+from .subscribers import subscribers
+from .suggest import suggestions
+from .tvdb import TVDBWrapper
+
+log = logging.getLogger(__name__)
+
+STATUS = {
+	"Continuing": Show.RUNNING,
+	"Ended": Show.ENDED
+}
+
+
+class JobQueue(object):
+
+	""" Runs jobs on background worker threads, each job in a transaction
+	of its own.
+	"""
+
+	def __init__(self, name, maxsize=1000, retries=3, retry_delay=60):
+
+		self.name = name
+		self.queue = Queue(maxsize)
+		self.workers = []
+		self.retries = retries
+		self.retry_delay = retry_delay
+
+	def configure(self, settings, prefix):
+
+		maxsize = settings.get("%smax_queue" % prefix)
+
+		if maxsize is not None:
+			self.queue.maxsize = int(maxsize)
+
+		self.retries = int(settings.get("%sretries" % prefix,
+								self.retries))
+		self.retry_delay = float(settings.get("%sretry_delay" % prefix,
+							self.retry_delay))
+
+		self.start(int(settings.get("%sworkers" % prefix, 1)))
+
+	def start(self, workers=1):
+
+		while len(self.workers) < workers:
+			name = "%s-%d" % (self.name, len(self.workers))
+			worker = Thread(target=self.work, name=name)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def put(self, func, *args):
+
+		try:
+			self.queue.put_nowait((func, args))
+		except Full:
+			log.error("Job queue %s is full, dropping %s%r" % (
+						self.name, func.__name__, args))
+
+	def defer(self, func, *args):
+
+		""" Queue a job once the current transaction has been committed,
+		so that the job sees the data it refers to.
+		"""
+		def queue_job(success):
+
+			if success:
+				self.put(func, *args)
+
+		transaction.get().addAfterCommitHook(queue_job)
+
+	def retry(self, attempt, func, *args):
+
+		""" Queue a job again after a delay that doubles with every
+		attempt. False once the job has been tried often enough.
+		"""
+		if attempt > self.retries:
+			return False
+
+		delay = self.retry_delay * 2 ** (attempt - 1)
+		timer = Timer(delay, self.put, (func,) + args)
+		timer.daemon = True
+		timer.start()
+		return True
+
+	def work(self):
+
+		while True:
+			func, args = self.queue.get()
+
+			try:
+				with transaction.manager:
+					func(*args)
+			except Exception:
+				log.exception("Job %s%r failed" % (func.__name__, args))
+			finally:
+				DBSession.remove()
+				self.queue.task_done()
+
+	def join(self):
+
+		self.queue.join()
+
+
+def parse_date(value):
+
+	try:
+		return datetime.strptime(value, "%Y-%m-%d").date()
+	except (TypeError, ValueError):
+		return None
+
+
+def parse_int(value):
+
+	try:
+		return int(float(value))
+	except (TypeError, ValueError):
+		return None
+
+
+def parse_status(data):
+
+	try:
+		return STATUS.get(data["status"])
+	except (KeyError, tvdb_attributenotfound):
+		return None
+
+
+def episodes_from(show_id, data):
+
+	""" Flatten the season / episode structure returned by TheTVDB into
+	rows for the episodes table
+	"""
+	episodes = {}
+
+	for season in data.values():
+
+		if not isinstance(season, dict):
+			continue
+
+		for episode in season.values():
+			row = {
+				"show_id": show_id,
+				"season": parse_int(episode.get("seasonnumber")),
+				"num": parse_int(episode.get("episodenumber")),
+				"airdate": parse_date(episode.get("firstaired")),
+				"title": episode.get("episodename"),
+				"totalnum": parse_int(episode.get("absolute_number")),
+				"prodnum": episode.get("productioncode")
+			}
+
+			if row["season"] is None or row["num"] is None:
+				continue
+
+			episodes[(row["season"], row["num"])] = row
+
+	return sorted(episodes.values(), key=lambda row: (row["season"],
+								row["num"]))
+
+
+def store_show(show, data):
+
+	""" Replace the meta data and all episodes of a show with the data
+	from TheTVDB. Episodes are written in a single bulk insert, those
+	older than the archive horizon go straight to the archive.
+	"""
+	episodes = episodes_from(show.id, data)
+	horizon = ArchivedEpisode.horizon()
+	archived = []
+
+	if horizon:
+		archived = [e for e in episodes
+				if e["airdate"] and e["airdate"] < horizon]
+		episodes = [e for e in episodes
+				if not e["airdate"] or e["airdate"] >= horizon]
+	today = date.today()
+	airdates = [e["airdate"] for e in episodes + archived if e["airdate"]]
+	upcoming = [airdate for airdate in airdates if airdate >= today]
+
+	show.name = data["seriesname"]
+	show.status = parse_status(data) or show.status
+	show.next_airdate = min(upcoming) if upcoming else None
+	show.last_airdate = max(airdates) if airdates else None
+	show.updated = datetime.now()
+	show.pending = False
+	show.failed = False
+
+	for table, rows in [(Episode.__table__, episodes),
+				(ArchivedEpisode.__table__, archived)]:
+		DBSession.execute(table.delete().where(
+					table.c.show_id == show.id))
+
+		if rows:
+			DBSession.execute(table.insert(), rows)
+
+	DBSession.expire(show, ["episodes", "archived_episodes"])
+	DBSession().info.setdefault("changed_shows", set()).add(show.id)
+	mark_changed(DBSession())
+
+
+def import_show(show_id, backend=TVDBWrapper, attempt=0):
+
+	""" Fetch the meta data and the full list of episodes for a newly added
+	show from TheTVDB. Failed imports are queued again a few times, after
+	that the show is marked as failed and left to the refresh job.
+	"""
+	show = DBSession.query(Show).get(show_id)
+
+	if not show or not show.pending:
+		return
+
+	subscribers.refresh()
+	engine = backend()
+
+	try:
+		data = engine.getByURL(show.url)
+	except tvdb_shownotfound:
+		log.warning("Show %s not found on TVDB, removing it" % show.url)
+		DBSession.delete(show)
+		return
+	except Exception as e:
+		attempt += 1
+
+		if import_queue.retry(attempt, import_show, show_id, backend,
+								attempt):
+			log.warning("Failed to import show %s, trying again: %s"
+							% (show.url, e))
+		else:
+			log.error("Failed to import show %s: %s" % (show.url, e))
+			show.failed = True
+
+		return
+
+	store_show(show, data)
+	suggestions.add(show.url, show.name)
+
+
+import_queue = JobQueue("import")
@@ -0,0 +1,269 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+from .queries import collector
+from .retry import retry_stats
+
+# Upper bounds of the histogram buckets, in seconds and bytes
+LATENCY = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+UPSTREAM = (.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30)
+SIZE = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+
+	""" Counts of observed values per bucket, along with their sum. Not
+	thread-safe on its own, Metrics keeps it under its lock.
+	"""
+
+	def __init__(self, buckets):
+
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self):
+
+		""" The (upper bound, count) pairs of the Prometheus buckets
+		"""
+		total = 0
+		res = []
+
+		for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+			total += count
+			res.append((bound, total))
+
+		return res
+
+
+def escape(value):
+
+	# Requests that matched no route have no route name
+	if value is None:
+		return ""
+
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+								'"', '\\"')
+
+
+def labels(**kwargs):
+
+	return ",".join('%s="%s"' % (key, escape(value))
+					for key, value in sorted(kwargs.items()))
+
+
+class Metrics(object):
+
+	""" Request latency, status and response size per route, requests in
+	flight, cache hits and misses per beaker region and the latency of
+	calls to TheTVDB, rendered in the Prometheus text format
+	"""
+
+	def __init__(self):
+
+		self.lock = Lock()
+		self.token = None
+		self.reset()
+
+	def configure(self, settings, prefix):
+
+		self.token = settings.get(prefix + "token") or None
+
+	def reset(self):
+
+		with self.lock:
+			self.latency = {}
+			self.sizes = {}
+			self.statuses = {}
+			self.in_flight = 0
+			self.cache = {}
+			self.upstream = {}
+
+	def start(self):
+
+		with self.lock:
+			self.in_flight += 1
+
+	def finish(self, route, status, size, duration):
+
+		with self.lock:
+			self.in_flight -= 1
+
+			latency = self.latency.get(route)
+
+			if latency is None:
+				latency = self.latency[route] = Histogram(LATENCY)
+
+			latency.observe(duration)
+
+			key = (route, status)
+			self.statuses[key] = self.statuses.get(key, 0) + 1
+
+			if size is None:
+				return
+
+			sizes = self.sizes.get(route)
+
+			if sizes is None:
+				sizes = self.sizes[route] = Histogram(SIZE)
+
+			sizes.observe(size)
+
+	def cache_lookup(self, region, hit):
+
+		key = (region, "hit" if hit else "miss")
+
+		with self.lock:
+			self.cache[key] = self.cache.get(key, 0) + 1
+
+	def upstream_call(self, name, success, duration):
+
+		key = (name, "ok" if success else "error")
+
+		with self.lock:
+			calls = self.upstream.get(key)
+
+			if calls is None:
+				calls = self.upstream[key] = Histogram(UPSTREAM)
+
+			calls.observe(duration)
+
+	def histogram(self, lines, name, histograms, names):
+
+		for key, histogram in sorted(histograms.items()):
+			values = dict(zip(names, key if isinstance(key, tuple)
+								else (key,)))
+
+			for bound, count in histogram.cumulative():
+				lines.append("%s_bucket{%s} %d" % (name,
+					labels(le=bound, **values), count))
+
+			lines.append("%s_sum{%s} %s" % (name, labels(**values),
+							repr(histogram.sum)))
+			lines.append("%s_count{%s} %d" % (name, labels(**values),
+							histogram.count))
+
+	def counter(self, lines, name, counts, names):
+
+		for key, count in sorted(counts.items()):
+			values = dict(zip(names, key if isinstance(key, tuple)
+								else (key,)))
+			lines.append("%s{%s} %s" % (name, labels(**values),
+								repr(count)))
+
+	def describe(self, lines, name, kind, text):
+
+		lines.append("# HELP %s %s" % (name, text))
+		lines.append("# TYPE %s %s" % (name, kind))
+
+	def render(self):
+
+		""" All metrics in the Prometheus text exposition format
+		"""
+		lines = []
+
+		with self.lock:
+			self.describe(lines, "webisoder_request_duration_seconds",
+				"histogram", "Time to handle a request, per route")
+			self.histogram(lines, "webisoder_request_duration_seconds",
+							self.latency, ["route"])
+
+			self.describe(lines, "webisoder_response_size_bytes",
+				"histogram", "Size of the response body, per route")
+			self.histogram(lines, "webisoder_response_size_bytes",
+							self.sizes, ["route"])
+
+			self.describe(lines, "webisoder_responses_total", "counter",
+					"Responses per route and status code")
+			self.counter(lines, "webisoder_responses_total",
+					self.statuses, ["route", "status"])
+
+			self.describe(lines, "webisoder_requests_in_flight",
+				"gauge", "Requests currently being handled")
+			lines.append("webisoder_requests_in_flight %d" %
+							self.in_flight)
+
+			self.describe(lines, "webisoder_cache_lookups_total",
+				"counter", "Cache hits and misses per beaker region")
+			self.counter(lines, "webisoder_cache_lookups_total",
+					self.cache, ["region", "result"])
+
+			self.describe(lines, "webisoder_tvdb_call_duration_seconds",
+				"histogram", "Time of calls to TheTVDB, per call")
+			self.histogram(lines,
+				"webisoder_tvdb_call_duration_seconds",
+				self.upstream, ["call", "result"])
+
+		queries = collector.stats.snapshot()
+
+		self.describe(lines, "webisoder_db_statements_total", "counter",
+					"SQL statements executed, per route")
+		self.counter(lines, "webisoder_db_statements_total", dict(
+			(k, v["queries"]) for k, v in queries.items()), ["route"])
+
+		self.describe(lines, "webisoder_db_seconds_total", "counter",
+				"Time spent executing SQL statements, per route")
+		self.counter(lines, "webisoder_db_seconds_total", dict(
+			(k, v["time"]) for k, v in queries.items()), ["route"])
+
+		retries = retry_stats.snapshot()
+
+		for key, text in (
+				("retries", "Attempts repeated after a conflict"),
+				("retried", "Requests repeated at least once"),
+				("exhausted", "Requests failed after the last attempt")):
+
+			name = "webisoder_retry_%s_total" % key
+			self.describe(lines, name, "counter", text + ", per route")
+			self.counter(lines, name, retries[key], ["route"])
+
+		return "\n".join(lines) + "\n"
+
+
+def metrics_tween_factory(handler, registry):
+
+	""" Time every request and count its response
+	"""
+	def metrics_tween(request):
+
+		metrics.start()
+		start = time()
+		status, size = 500, None
+
+		try:
+			response = handler(request)
+			status, size = response.status_int, response.content_length
+			return response
+		finally:
+			route = getattr(request, "matched_route", None)
+			metrics.finish(route.name if route else None, status, size,
+							time() - start)
+
+	return metrics_tween
+
+
+metrics = Metrics()
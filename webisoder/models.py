@@ -14,23 +14,37 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple
 from random import SystemRandom
+from uuid import uuid4
 from string import digits, ascii_lowercase, ascii_uppercase
-from datetime import date
+from datetime import date, timedelta
 
 from sqlalchemy import Boolean, DateTime, Integer, String, Numeric, Index, event
 from sqlalchemy import Table, ForeignKey, UniqueConstraint, Text, Date, Column
+from sqlalchemy import and_, or_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session, scoped_session, sessionmaker
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import text, func
+from sqlalchemy.sql import select, text, func
 
 from hashlib import md5
 from bcrypt import hashpw, gensalt
 
 from zope.sqlalchemy import ZopeTransactionExtension
 
-DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+from .shards import RoutingSession
+
+DBSession = scoped_session(sessionmaker(class_=RoutingSession,
+				extension=ZopeTransactionExtension()))
+# For views that only read: not joined to the transaction manager and never
+# flushed, the connection is simply released when the session is removed
+ReadSession = scoped_session(sessionmaker(class_=RoutingSession,
+							autoflush=False))
+# The same, for the read replica
+ReplicaSession = scoped_session(sessionmaker(class_=RoutingSession,
+							autoflush=False))
 Base = declarative_base()
 
 subscriptions = Table('subscriptions', Base.metadata,
@@ -41,11 +55,16 @@ subscriptions = Table('subscriptions', Base.metadata,
 	UniqueConstraint("show_id", "user_name")
 )
 
-# This is unused in webisoder
+# Settings shared by all processes, see CATALOG_CHANGE
 meta = Table("meta", Base.metadata,
 	Column("key", Text, primary_key=True),
 	Column("value", Text))
 
+# Set to a new value whenever the catalog changes in a way that does not show
+# in Show.updated, such as filling the upcoming episodes from scratch, so that
+# the in-memory indices of all processes reload
+CATALOG_CHANGE = "catalog_change"
+
 
 class ResultRating(float):
 
@@ -78,16 +97,11 @@ class SiteNews(Base):
 	text = Column(Text, nullable=False)
 
 
-class Episode(Base):
+class EpisodeFormat(object):
 
-	__tablename__ = "episodes"
-	show_id = Column(Integer, ForeignKey("shows.show_id"), primary_key=True)
-	num = Column(Integer, primary_key=True)
-	airdate = Column(Date)
-	season = Column(Integer, primary_key=True)
-	title = Column(Text)
-	totalnum = Column(Integer)
-	prodnum = Column(Text)
+	""" Rendering shared by Episode and EpisodeRow
+	"""
+	__slots__ = ()
 
 	def render(self, format):
 
@@ -105,8 +119,109 @@ class Episode(Base):
 					self.season, self.num, self.title)
 
 
+class Episode(EpisodeFormat, Base):
+
+	__tablename__ = "episodes"
+	show_id = Column(Integer, ForeignKey("shows.show_id"), primary_key=True)
+	num = Column(Integer, primary_key=True)
+	airdate = Column(Date)
+	season = Column(Integer, primary_key=True)
+	title = Column(Text)
+	totalnum = Column(Integer)
+	prodnum = Column(Text)
+
+
+class ArchivedEpisode(Base):
+
+	""" Episodes that aired before the archive horizon, moved out of the
+	episodes table by the archival job
+	"""
+	DAYS = None
+
+	__tablename__ = "episodes_archive"
+	show_id = Column(Integer, ForeignKey("shows.show_id"), primary_key=True)
+	num = Column(Integer, primary_key=True)
+	airdate = Column(Date)
+	season = Column(Integer, primary_key=True)
+	title = Column(Text)
+	totalnum = Column(Integer)
+	prodnum = Column(Text)
+
+	@staticmethod
+	def horizon():
+
+		""" Episodes older than this are archived, None if archival is
+		disabled. Never inside the feed window.
+		"""
+		if not ArchivedEpisode.DAYS:
+			return None
+
+		days = max(ArchivedEpisode.DAYS, UpcomingEpisode.DAYS)
+		return date.today() - timedelta(days)
+
+
+ShowRow = namedtuple("ShowRow", ["id", "name", "url", "updated"])
+
+
+class EpisodeRow(EpisodeFormat):
+
+	""" A read-only episode for display, without the overhead of a mapped
+	instance. All episodes of a show share the same ShowRow.
+	"""
+	__slots__ = ("show", "season", "num", "airdate", "title")
+
+	def __init__(self, show, season, num, airdate, title):
+
+		self.show = show
+		self.season = season
+		self.num = num
+		self.airdate = airdate
+		self.title = title
+
+	def __eq__(self, other):
+
+		return (isinstance(other, EpisodeRow) and
+			(self.show.id, self.season, self.num) ==
+			(other.show.id, other.season, other.num))
+
+	def __ne__(self, other):
+
+		return not self == other
+
+	def __hash__(self):
+
+		return hash((self.show.id, self.season, self.num))
+
+	@staticmethod
+	def query(*criteria, **kwargs):
+
+		""" Episode rows matching the given criteria, read with a single
+		column query
+		"""
+		session = kwargs.get("session", DBSession)
+		query = session.query(Show.id, Show.name, Show.url,
+			Show.updated, Episode.season, Episode.num,
+			Episode.airdate, Episode.title).join(Episode.show)
+		shows = {}
+		res = []
+
+		for row in query.filter(*criteria):
+			show = shows.get(row[0])
+
+			if show is None:
+				show = shows[row[0]] = ShowRow(*row[:4])
+
+			res.append(EpisodeRow(show, *row[4:]))
+
+		return res
+
+
 class Show(Base):
 
+	RUNNING = 1
+	PAUSED = 2
+	ENDED = 3
+
 	__tablename__ = 'shows'
 	id = Column('show_id', Integer, primary_key=True)
 	name = Column('show_name', Text)
@@ -114,8 +229,17 @@ class Show(Base):
 	updated = Column(DateTime)
 	enabled = Column(Boolean)
 	status = Column(Integer)
+	next_airdate = Column(Date)
+	last_airdate = Column(Date)
+	# A placeholder for a show that has not been fetched from TheTVDB yet
+	pending = Column(Boolean, nullable=False, default=False,
+						server_default=text("False"))
+	# The import gave up, the show is fetched with the next refresh
+	failed = Column(Boolean, nullable=False, default=False,
+						server_default=text("False"))
 
 	episodes = relationship(Episode, cascade="all,delete", backref="show")
+	archived_episodes = relationship(ArchivedEpisode, cascade="all,delete")
 
 	def __lt__(self, other):
 
@@ -125,21 +249,119 @@ class Show(Base):
 
 		return "Webisoder show '%s'" % self.name
 
+	def __is_finished(self):
+
+		""" Ended with the last episode aired, an ended show may still
+		have its finale ahead
+		"""
+		if self.status != Show.ENDED:
+			return False
+
+		return self.last_airdate is None or self.last_airdate < date.today()
+
 	def __get_next_episode(self):
 
+		# Nothing left to air, no need to load the episodes
+		if self.finished:
+			return None
+
 		today = date.today()
-		episodes = self.episodes
+		upcoming = [ep for ep in self.episodes
+					if ep.airdate and ep.airdate >= today]
+
+		if not upcoming:
+			return None
+
+		return min(upcoming, key=lambda ep: ep.airdate)
+
+	def __get_next_date(self):
 
-		for ep in episodes:
-			if not ep.airdate:
-				continue
+		""" The day the next episode airs on, as stored by the last
+		update. The episodes are only loaded when that day has passed
+		since.
+		"""
+		if self.finished or self.next_airdate is None:
+			return None
 
-			if ep.airdate >= today:
-				return ep
+		if self.next_airdate >= date.today():
+			return self.next_airdate
 
-		return None
+		episode = self.next_episode
+		return episode.airdate if episode else None
 
+	@hybrid_property
+	def active(self):
+
+		return self.enabled is not False and self.status != Show.ENDED
+
+	@active.expression
+	def active(cls):
+
+		return and_(or_(cls.enabled.is_(None), cls.enabled == True),
+			or_(cls.status.is_(None), cls.status != Show.ENDED))
+
+	def aired_since(self, then):
+
+		""" Whether the show might have episodes airing on or after the
+		given date. An ended show whose last episode airs before that date
+		cannot have any.
+		"""
+		if self.status != Show.ENDED:
+			return True
+
+		return self.last_airdate is not None and self.last_airdate >= then
+
+	finished = property(__is_finished)
 	next_episode = property(__get_next_episode)
+	next_date = property(__get_next_date)
+
+
+class UpcomingEpisode(Base):
+
+	""" The episodes of the longest feed window and all future episodes,
+	with the show details copied in, so that feeds never have to look at
+	the full episode history. Kept up to date by sync_upcoming.
+	"""
+	DAYS = 7
+
+	__tablename__ = "upcoming_episodes"
+	show_id = Column(Integer, primary_key=True)
+	season = Column(Integer, primary_key=True)
+	num = Column(Integer, primary_key=True)
+	airdate = Column(Date, nullable=False)
+	title = Column(Text)
+	show_name = Column(Text)
+	show_url = Column(Text)
+	show_updated = Column(DateTime)
+
+	@staticmethod
+	def start():
+
+		return date.today() - timedelta(UpcomingEpisode.DAYS)
+
+	@staticmethod
+	def rows(*criteria, **kwargs):
+
+		""" Episode rows for the upcoming episodes matching the given
+		criteria
+		"""
+		cls = UpcomingEpisode
+		session = kwargs.get("session", DBSession)
+		query = session.query(cls.show_id, cls.show_name, cls.show_url,
+			cls.show_updated, cls.season, cls.num, cls.airdate,
+			cls.title)
+		shows = {}
+		res = []
+
+		for row in query.filter(*criteria):
+			show = shows.get(row[0])
+
+			if show is None:
+				show = shows[row[0]] = ShowRow(*row[:4])
+
+			res.append(EpisodeRow(show, *row[4:]))
+
+		return res
 
 
 class User(Base):
@@ -218,12 +440,32 @@ class User(Base):
 						Episode.show_id.in_(shows))
 		return [x for x in matches]
 
+	def episodes_since(self, then):
+
+		shows = [x.id for x in self.shows if x.aired_since(then)]
+
+		if not shows:
+			return []
+
+		session = object_session(self) or DBSession
+
+		if then < UpcomingEpisode.start():
+			return EpisodeRow.query(Episode.show_id.in_(shows),
+				Episode.airdate >= then, session=session)
+
+		return UpcomingEpisode.rows(UpcomingEpisode.show_id.in_(shows),
+				UpcomingEpisode.airdate >= then, session=session)
+
 	episodes = property(__get_episodes)
 	password = property(None, __set_password)
 
 
 Index('user_index', User.name, unique=True)
 Index('show_id', Show.id, unique=True)
+Index('episode_airdate', Episode.show_id, Episode.airdate)
+Index('upcoming_show_airdate', UpcomingEpisode.show_id,
+						UpcomingEpisode.airdate)
+Index('upcoming_airdate', UpcomingEpisode.airdate)
 
 @event.listens_for(User, "before_insert")
 def user_before_insert(mapper, connection, target):
@@ -231,3 +473,158 @@ def user_before_insert(mapper, connection, target):
 	if target.token is None:
 
 		target.reset_token()
+
+
+def mark_catalog_changed(connection):
+
+	value = uuid4().hex
+	res = connection.execute(meta.update().where(
+		meta.c.key == CATALOG_CHANGE).values(value=value))
+
+	if not res.rowcount:
+		connection.execute(meta.insert().values(key=CATALOG_CHANGE,
+								value=value))
+
+
+def catalog_change(connection):
+
+	return connection.execute(select([meta.c.value]).where(
+				meta.c.key == CATALOG_CHANGE)).scalar()
+
+
+def sync_upcoming(connection, shows=None):
+
+	""" Copy the upcoming episodes of the given shows (or of all shows)
+	from the episodes table
+	"""
+	upcoming = UpcomingEpisode.__table__
+	episodes = Episode.__table__
+	show = Show.__table__
+
+	query = select([episodes.c.show_id, episodes.c.season, episodes.c.num,
+		episodes.c.airdate, episodes.c.title, show.c.show_name,
+		show.c.url, show.c.updated]).select_from(episodes.join(show,
+		episodes.c.show_id == show.c.show_id)).where(
+		episodes.c.airdate >= UpcomingEpisode.start())
+	delete = upcoming.delete()
+
+	if shows is not None:
+		shows = list(shows)
+		query = query.where(episodes.c.show_id.in_(shows))
+		delete = delete.where(upcoming.c.show_id.in_(shows))
+
+	connection.execute(delete)
+	connection.execute(upcoming.insert().from_select(["show_id", "season",
+		"num", "airdate", "title", "show_name", "show_url",
+		"show_updated"], query))
+
+	if shows is None:
+		mark_catalog_changed(connection)
+
+
+def fill_upcoming(connection):
+
+	""" Fill the upcoming episodes from scratch if the table is empty
+	while there are episodes to fill it with, e.g. right after it was
+	created
+	"""
+	upcoming = UpcomingEpisode.__table__
+	episodes = Episode.__table__
+
+	if connection.execute(select([upcoming.c.show_id]).limit(1)).first():
+		return False
+
+	if not connection.execute(select([episodes.c.show_id]).where(
+		episodes.c.airdate >= UpcomingEpisode.start()).limit(1)).first():
+		return False
+
+	sync_upcoming(connection)
+	return True
+
+
+def sync_airdates(connection, shows=None):
+
+	""" Set the next and the last airdate of the given shows (or of all
+	shows) from their episodes
+	"""
+	show = Show.__table__
+	episodes = Episode.__table__
+	archive = ArchivedEpisode.__table__
+
+	upcoming = select([func.min(episodes.c.airdate)]).where(and_(
+		episodes.c.show_id == show.c.show_id,
+		episodes.c.airdate >= date.today())).as_scalar()
+
+	# Archived episodes are older than all others
+	last = func.coalesce(*[select([func.max(table.c.airdate)]).where(
+		table.c.show_id == show.c.show_id).as_scalar()
+		for table in [episodes, archive]])
+
+	update = show.update().values(next_airdate=upcoming, last_airdate=last)
+
+	if shows is not None:
+		update = update.where(show.c.show_id.in_(list(shows)))
+
+	connection.execute(update)
+
+
+def roll_off_upcoming(connection):
+
+	""" Remove the episodes that have left the feed window
+	"""
+	upcoming = UpcomingEpisode.__table__
+	res = connection.execute(upcoming.delete().where(
+			upcoming.c.airdate < UpcomingEpisode.start()))
+	return res.rowcount
+
+
+@event.listens_for(DBSession, "after_flush")
+def upcoming_after_flush(session, context):
+
+	shows = set()
+
+	for obj in session.new | session.dirty | session.deleted:
+		if isinstance(obj, Episode):
+			shows.add(obj.show_id)
+		elif isinstance(obj, Show) and (obj in session.deleted or
+			session.is_modified(obj, include_collections=False)):
+			shows.add(obj.id)
+
+	if shows:
+		sync_upcoming(session, shows)
+
+
+@event.listens_for(DBSession, "after_bulk_update")
+@event.listens_for(DBSession, "after_bulk_delete")
+def upcoming_after_bulk(context):
+
+	if context.mapper.class_ in (Episode, Show):
+		sync_upcoming(context.session)
+
+
+def archive_episodes(connection, horizon):
+
+	""" Move all episodes that aired before the horizon to the archive
+	"""
+	episodes = Episode.__table__
+	archive = ArchivedEpisode.__table__
+	old = episodes.c.airdate < horizon
+
+	connection.execute(archive.insert().from_select(
+			[c.name for c in episodes.c],
+			select([episodes]).where(old)))
+	return connection.execute(episodes.delete().where(old)).rowcount
+
+
+def restore_history(connection, show_id):
+
+	""" Move the archived episodes of a show back to the episodes table
+	"""
+	episodes = Episode.__table__
+	archive = ArchivedEpisode.__table__
+	show = archive.c.show_id == show_id
+
+	connection.execute(episodes.insert().from_select(
+			[c.name for c in archive.c],
+			select([archive]).where(show)))
+	return connection.execute(archive.delete().where(show)).rowcount
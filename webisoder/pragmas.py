@@ -0,0 +1,74 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from sqlalchemy import event
+
+# Readers do not block the writer and vice versa, commits only sync the
+# WAL at checkpoints and lock conflicts wait instead of failing at once
+PRAGMAS = [
+	("journal_mode", "WAL"),
+	("synchronous", "NORMAL"),
+	("mmap_size", "268435456"),
+	("cache_size", "-20000"),
+	("busy_timeout", "5000"),
+	("temp_store", "MEMORY"),
+]
+
+VALUE = re.compile(r"^-?\w+$")
+
+
+def sqlite_pragmas(settings, prefix):
+
+	""" The pragmas to apply, as configured; an empty value keeps the
+	SQLite default
+	"""
+	pragmas = []
+
+	for name, default in PRAGMAS:
+		value = settings.get(prefix + name, default).strip()
+
+		if not value:
+			continue
+
+		if not VALUE.match(value):
+			raise ValueError("Invalid value for %s%s: %r" %
+							(prefix, name, value))
+
+		pragmas.append((name, value))
+
+	return pragmas
+
+
+def configure_sqlite(engine, settings, prefix="webisoder.sqlite."):
+
+	""" Apply the pragmas to every new connection of a SQLite engine
+	"""
+	if engine.dialect.name != "sqlite":
+		return
+
+	pragmas = sqlite_pragmas(settings, prefix)
+
+	@event.listens_for(engine, "connect")
+	def set_pragmas(connection, record):
+
+		cursor = connection.cursor()
+
+		for name, value in pragmas:
+			cursor.execute("PRAGMA %s = %s" % (name, value))
+
+		cursor.close()
@@ -0,0 +1,256 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import logging
+import os
+import sys
+
+from cProfile import Profile
+from itertools import count
+from random import random
+from threading import Condition, Thread, current_thread
+from time import sleep, strftime, time
+
+log = logging.getLogger(__name__)
+
+HEADER = "X-Webisoder-Profile"
+
+FORMATS = {"collapsed": ".collapsed", "pstats": ".prof"}
+
+# Profiles of requests that matched no route
+UNMATCHED = "_unmatched"
+
+
+def sign(secret, expires):
+
+	return hmac.new(str(secret), str(int(expires)),
+					hashlib.sha256).hexdigest()
+
+
+def profile_header(secret, ttl):
+
+	""" A header value that has requests profiled for the next ttl
+	seconds
+	"""
+	expires = int(time() + ttl)
+	return "%d:%s" % (expires, sign(secret, expires))
+
+
+def frame_name(frame):
+
+	code = frame.f_code
+	return "%s:%s:%d" % (frame.f_globals.get("__name__", "?"),
+					code.co_name, code.co_firstlineno)
+
+
+def collapse(frame):
+
+	""" The stack of a frame, outermost call first, in the collapsed
+	format of flamegraph.pl
+	"""
+	names = []
+
+	while frame is not None:
+		names.append(frame_name(frame))
+		frame = frame.f_back
+
+	return ";".join(reversed(names))
+
+
+class Sampler(object):
+
+	""" Records the stacks of the registered threads every interval
+	seconds. The sampling thread sleeps while no thread is registered.
+	"""
+
+	def __init__(self, interval=.005):
+
+		self.interval = interval
+		self.threads = {}
+		self.thread = None
+		self.cond = Condition()
+
+	def start(self, ident):
+
+		with self.cond:
+			stacks = self.threads[ident] = {}
+
+			if self.thread is None:
+				self.thread = Thread(target=self.run,
+							name="profile-sampler")
+				self.thread.daemon = True
+				self.thread.start()
+
+			self.cond.notify()
+
+		return stacks
+
+	def stop(self, ident):
+
+		with self.cond:
+			return self.threads.pop(ident)
+
+	def sample(self):
+
+		frames = sys._current_frames()
+
+		for ident, stacks in self.threads.items():
+			frame = frames.get(ident)
+
+			if frame is not None:
+				stack = collapse(frame)
+				stacks[stack] = stacks.get(stack, 0) + 1
+
+	def run(self):
+
+		while True:
+			with self.cond:
+				while not self.threads:
+					self.cond.wait()
+
+				self.sample()
+
+			sleep(self.interval)
+
+
+class Profiler(object):
+
+	""" Profiles a share of all requests, and requests that carry a
+	signed header, and writes one profile per request to a directory per
+	route, keeping only the newest ones
+	"""
+
+	def __init__(self):
+
+		self.rate = 0.0
+		self.secret = None
+		self.directory = None
+		self.format = "collapsed"
+		self.keep = 100
+		self.sampler = Sampler()
+		self.counter = count()
+
+	def configure(self, settings, prefix):
+
+		self.rate = float(settings.get(prefix + "rate", self.rate))
+		self.secret = settings.get(prefix + "secret") or None
+		self.directory = settings.get(prefix + "directory",
+							self.directory)
+		self.format = settings.get(prefix + "format", self.format)
+		self.keep = int(settings.get(prefix + "keep", self.keep))
+		self.sampler.interval = float(settings.get(prefix + "interval",
+							self.sampler.interval))
+
+		if self.format not in FORMATS:
+			raise ValueError("Invalid value for %sformat: %r" % (
+							prefix, self.format))
+
+	@property
+	def enabled(self):
+
+		return bool(self.directory and (self.rate > 0 or self.secret))
+
+	def signed(self, request):
+
+		value = request.headers.get(HEADER)
+
+		if not value or not self.secret or ":" not in value:
+			return False
+
+		expires, signature = value.split(":", 1)
+
+		if not expires.isdigit() or int(expires) < time():
+			return False
+
+		return hmac.compare_digest(str(signature),
+						sign(self.secret, expires))
+
+	def wanted(self, request):
+
+		return (self.rate > 0 and random() < self.rate) or (
+							self.signed(request))
+
+	def run(self, handler, request):
+
+		""" Handle the request under the profiler and write the profile
+		"""
+		if self.format == "pstats":
+			profile = Profile()
+
+			try:
+				return profile.runcall(handler, request)
+			finally:
+				self.write(request, profile.dump_stats)
+
+		ident = current_thread().ident
+		self.sampler.start(ident)
+
+		try:
+			return handler(request)
+		finally:
+			stacks = self.sampler.stop(ident)
+			self.write(request, lambda path: self.dump(stacks, path))
+
+	def dump(self, stacks, path):
+
+		with open(path, "w") as out:
+			for stack, samples in sorted(stacks.items()):
+				out.write("%s %d\n" % (stack, samples))
+
+	def write(self, request, dump):
+
+		route = getattr(request, "matched_route", None)
+		directory = os.path.join(self.directory,
+					route.name if route else UNMATCHED)
+		name = "%s-%d-%06d%s" % (strftime("%Y%m%d%H%M%S"), os.getpid(),
+				next(self.counter), FORMATS[self.format])
+
+		# Profiles must never break the request they were taken of
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+
+			dump(os.path.join(directory, name))
+			self.rotate(directory)
+		except (IOError, OSError) as e:
+			log.error("Failed to write profile: %s" % e)
+
+	def rotate(self, directory):
+
+		names = sorted(os.listdir(directory))
+
+		for name in names[:max(0, len(names) - self.keep)]:
+			os.remove(os.path.join(directory, name))
+
+
+def profile_tween_factory(handler, registry):
+
+	""" Profile the requests the profiler wants. Only registered while
+	profiling is configured, it costs nothing otherwise.
+	"""
+	def profile_tween(request):
+
+		if not profiler.wanted(request):
+			return handler(request)
+
+		return profiler.run(handler, request)
+
+	return profile_tween
+
+
+profiler = Profiler()
@@ -0,0 +1,194 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from contextlib import contextmanager
+from threading import Lock, local
+from time import time
+
+from pyramid.settings import asbool
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# Statements are shortened to this many characters in the log
+STATEMENT_LENGTH = 200
+
+
+class Queries(object):
+
+	""" The statements of one request: how many, how long they took in
+	total (in seconds) and the slowest one
+	"""
+
+	def __init__(self, keep=False):
+
+		self.count = 0
+		self.time = 0.0
+		self.slowest = None
+		self.slowest_time = 0.0
+		self.statements = [] if keep else None
+
+	def add(self, statement, duration):
+
+		self.count += 1
+		self.time += duration
+
+		if self.slowest is None or duration > self.slowest_time:
+			self.slowest = statement
+			self.slowest_time = duration
+
+		if self.statements is not None:
+			self.statements.append(statement)
+
+
+class QueryStats(object):
+
+	""" Requests, statements and database time per route, with the most
+	statements a single request issued and the slowest statement
+	"""
+
+	def __init__(self):
+
+		self.lock = Lock()
+		self.reset()
+
+	def reset(self):
+
+		with self.lock:
+			self.routes = {}
+
+	def add(self, route, queries):
+
+		with self.lock:
+			stats = self.routes.get(route)
+
+			if stats is None:
+				stats = self.routes[route] = {"requests": 0,
+					"queries": 0, "time": 0.0, "max_queries": 0,
+					"slowest": None, "slowest_time": 0.0}
+
+			stats["requests"] += 1
+			stats["queries"] += queries.count
+			stats["time"] += queries.time
+			stats["max_queries"] = max(stats["max_queries"],
+								queries.count)
+
+			if queries.slowest_time > stats["slowest_time"]:
+				stats["slowest"] = queries.slowest
+				stats["slowest_time"] = queries.slowest_time
+
+	def snapshot(self):
+
+		with self.lock:
+			return dict((route, dict(stats))
+					for route, stats in self.routes.items())
+
+
+class QueryCollector(object):
+
+	""" Counts and times the statements executed on the watched engines
+	while a request is handled in the same thread. Statements run outside
+	of a request, by the background workers for example, are not counted.
+	"""
+
+	def __init__(self):
+
+		self.local = local()
+		self.stats = QueryStats()
+		self.headers = False
+		self.log = False
+
+	def configure(self, settings, prefix):
+
+		self.headers = asbool(settings.get(prefix + "headers",
+								self.headers))
+		self.log = asbool(settings.get(prefix + "log", self.log))
+
+	def current(self):
+
+		return getattr(self.local, "queries", None)
+
+	def before(self, conn, cursor, statement, params, context, many):
+
+		if self.current() is not None:
+			context.query_start = time()
+
+	def after(self, conn, cursor, statement, params, context, many):
+
+		queries = self.current()
+		start = getattr(context, "query_start", None)
+
+		if queries is not None and start is not None:
+			queries.add(statement, time() - start)
+
+	def watch(self, engine):
+
+		event.listen(engine, "before_cursor_execute", self.before)
+		event.listen(engine, "after_cursor_execute", self.after)
+
+	@contextmanager
+	def collect(self, keep=False):
+
+		""" Record the statements executed in this thread until the block
+		is left
+		"""
+		queries = self.local.queries = Queries(keep)
+
+		try:
+			yield queries
+		finally:
+			self.local.queries = None
+
+	def report(self, request, response, queries):
+
+		route = getattr(request, "matched_route", None)
+		name = route.name if route else None
+		self.stats.add(name, queries)
+
+		if self.headers:
+			response.headers["X-DB-Queries"] = str(queries.count)
+			response.headers["X-DB-Time"] = "%.1f" % (
+							queries.time * 1000)
+			response.headers["X-DB-Slowest"] = "%.1f" % (
+						queries.slowest_time * 1000)
+
+		if self.log:
+			slowest = " ".join((queries.slowest or "").split())
+			log.info("route=%s queries=%d db_ms=%.1f slowest_ms=%.1f "
+				"slowest=%s" % (name, queries.count,
+				queries.time * 1000, queries.slowest_time * 1000,
+				slowest[:STATEMENT_LENGTH]))
+
+
+def query_tween_factory(handler, registry):
+
+	""" Collect the statements of every request and report them once the
+	response is ready
+	"""
+	def query_tween(request):
+
+		with collector.collect() as queries:
+			response = handler(request)
+
+		collector.report(request, response, queries)
+		return response
+
+	return query_tween
+
+
+collector = QueryCollector()
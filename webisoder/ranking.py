@@ -0,0 +1,63 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from heapq import nlargest
+
+
+def score(search, padded, name):
+
+	if search == name:
+		return 1
+	elif name.endswith(search):
+		return .9
+	elif name.startswith(search):
+		return .9
+	elif padded and padded in " %s " % name:
+		return .5
+	elif search in name:
+		return .4
+
+	return 0
+
+
+def lower(text):
+
+	return text.lower()
+
+
+def rank(search, result, limit=None, normalize=lower):
+
+	""" Rate all search results against the search term and return them
+	best match first. Ratings are the same as ResultRating would give for
+	each row, but the search term is only prepared once per batch. The
+	term and the show names are compared after passing them through
+	normalize.
+	"""
+	search = normalize(search)
+
+	# A search term containing spaces can never equal a single word
+	padded = None if " " in search else " %s " % search
+
+	for row in result:
+		name = normalize(row["seriesname"])
+		row["rating"] = score(search, padded, name)
+
+	rating = lambda row: row["rating"]
+
+	if limit is not None and limit < len(result):
+		return nlargest(limit, result, key=rating)
+
+	return sorted(result, key=rating, reverse=True)
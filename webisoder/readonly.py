@@ -0,0 +1,142 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from time import time
+
+from pyramid.interfaces import IRoutesMapper
+
+from .models import DBSession, ReadSession, ReplicaSession
+
+# Routes whose GET views never write to the database
+READ_ONLY_ROUTES = frozenset(["feed", "ical", "html", "shows", "episodes"])
+
+# Routes visited by logged in users, who expect to see their own changes
+SESSION_ROUTES = frozenset(["shows", "episodes"])
+
+METHODS = ("GET", "HEAD")
+
+KEY = "webisoder.readonly"
+
+WROTE = "webisoder.wrote"
+
+
+class Replica(object):
+
+	""" A read-only copy of the database that read-only requests read
+	from. Users who have just written keep reading from the primary for a
+	few seconds, until the replica has caught up with their changes.
+	"""
+
+	def __init__(self, stickiness=5):
+
+		self.engine = None
+		self.stickiness = stickiness
+
+	def configure(self, settings, prefix):
+
+		self.stickiness = float(settings.get(prefix + "stickiness",
+							self.stickiness))
+
+	def bind(self, engine):
+
+		self.engine = engine
+		ReplicaSession.configure(bind=engine)
+
+	def wrote(self, request, response):
+
+		request.session[WROTE] = time()
+
+	def sticky(self, request):
+
+		return time() - request.session.get(WROTE, 0) < self.stickiness
+
+
+def route_name(request):
+
+	""" The name of the route the request will be dispatched to. Tweens run
+	before the router, so the route has to be matched here.
+	"""
+	mapper = request.registry.queryUtility(IRoutesMapper)
+
+	if mapper is None:
+		return None
+
+	route = mapper(request).get("route")
+	return route.name if route else None
+
+
+def tm_activate(request):
+
+	""" A pyramid_tm activate hook that keeps the transaction manager out
+	of requests to read-only routes
+	"""
+	if request.method not in METHODS:
+		if replica.engine is not None:
+			request.add_response_callback(replica.wrote)
+
+		return True
+
+	name = route_name(request)
+
+	if name not in READ_ONLY_ROUTES:
+		return True
+
+	if name in SESSION_ROUTES and replica.engine is not None and (
+						replica.sticky(request)):
+		return True
+
+	request.environ[KEY] = True
+	return False
+
+
+def remove_session(request):
+
+	ReadSession.remove()
+	ReplicaSession.remove()
+
+
+def read_session(request):
+
+	""" The session views that only read should use: ReadSession for
+	requests that tm_activate kept out of the transaction manager, DBSession
+	for all others
+	"""
+	if not request.environ.get(KEY):
+		return DBSession
+
+	# Every attempt of a retried request is a new request object
+	if not getattr(request, "read_session", None):
+		request.read_session = ReadSession
+		request.add_finished_callback(remove_session)
+
+	return ReadSession
+
+
+def replica_session(request):
+
+	""" Like read_session, but reading from the replica if there is one.
+	Data that is cached across requests should still be read from the
+	primary, a lagging replica would leave stale entries behind.
+	"""
+	session = read_session(request)
+
+	if session is ReadSession and replica.engine is not None:
+		return ReplicaSession
+
+	return session
+
+
+replica = Replica()
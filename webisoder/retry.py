@@ -0,0 +1,199 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from random import random
+from threading import Lock
+from time import sleep
+
+from sqlalchemy.exc import DBAPIError
+from transaction.interfaces import TransientError
+
+log = logging.getLogger(__name__)
+
+# SQLite reports lock conflicts as OperationalError with these messages
+LOCKED = ("database is locked", "database table is locked",
+						"database schema has changed")
+
+# PostgreSQL serialization failure and deadlock
+SQLSTATES = ("40001", "40P01")
+
+
+def is_retryable(exc):
+
+	""" Whether the error is a transient conflict with another transaction
+	"""
+	if isinstance(exc, TransientError):
+		return True
+
+	if not isinstance(exc, DBAPIError) or exc.connection_invalidated:
+		return False
+
+	code = getattr(exc.orig, "pgcode", None)
+
+	if code in SQLSTATES:
+		return True
+
+	message = str(exc.orig).lower()
+	return any(text in message for text in LOCKED)
+
+
+def retry_state(request):
+
+	""" A dict that is kept across all attempts of a request, for views
+	that must not repeat side effects such as sending mail
+	"""
+	return request.environ.setdefault("webisoder.retry", {})
+
+
+class RetryStats(object):
+
+	""" Counts retried requests, retries and requests that failed after
+	the last attempt, per route
+	"""
+
+	def __init__(self):
+
+		self.lock = Lock()
+		self.reset()
+
+	def reset(self):
+
+		with self.lock:
+			self.retries = {}
+			self.retried = {}
+			self.exhausted = {}
+
+	def __count(self, counter, route):
+
+		with self.lock:
+			counter[route] = counter.get(route, 0) + 1
+
+	def retry(self, route, attempt):
+
+		if attempt == 1:
+			self.__count(self.retried, route)
+
+		self.__count(self.retries, route)
+
+	def exhaust(self, route):
+
+		self.__count(self.exhausted, route)
+
+	def snapshot(self):
+
+		with self.lock:
+			return {
+				"retries": dict(self.retries),
+				"retried": dict(self.retried),
+				"exhausted": dict(self.exhausted)
+			}
+
+
+class RetryPolicy(object):
+
+	""" A Pyramid execution policy that runs a request again, on a fresh
+	request object and transaction, when it failed on a transient database
+	conflict. Attempts are separated by a random, exponentially growing
+	backoff.
+	"""
+
+	def __init__(self, attempts=3, backoff=.05, max_backoff=1.0,
+							stats=None):
+
+		self.attempts = attempts
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.stats = stats or retry_stats
+		self.sleep = sleep
+
+	def configure(self, settings, prefix):
+
+		self.attempts = max(1, int(settings.get(prefix + "attempts",
+								self.attempts)))
+		self.backoff = float(settings.get(prefix + "backoff",
+								self.backoff))
+		self.max_backoff = float(settings.get(prefix + "max_backoff",
+							self.max_backoff))
+
+	def delay(self, attempt):
+
+		return random() * min(self.max_backoff,
+					self.backoff * 2 ** (attempt - 1))
+
+	def route(self, request):
+
+		route = getattr(request, "matched_route", None)
+		return route.name if route else None
+
+	def __call__(self, environ, router):
+
+		for attempt in range(self.attempts):
+			last = attempt == self.attempts - 1
+
+			with router.request_context(environ) as request:
+
+				if attempt == 0:
+					request.make_body_seekable()
+				else:
+					self.sleep(self.delay(attempt))
+
+				request.retry_attempt = attempt
+
+				try:
+					response = router.invoke_request(request)
+				except Exception as e:
+					if not is_retryable(e):
+						return request.invoke_exception_view(
+								reraise=True)
+
+					if last:
+						self.exhaust(request, e)
+						return request.invoke_exception_view(
+								reraise=True)
+
+					self.retrying(request, e)
+					continue
+
+				# The error may have been turned into a response already
+				exc = getattr(request, "exception", None)
+
+				if exc is None or not is_retryable(exc):
+					return response
+
+				if last:
+					self.exhaust(request, exc)
+					return response
+
+				self.retrying(request, exc)
+
+	def retrying(self, request, exc):
+
+		route = self.route(request)
+		self.stats.retry(route, request.retry_attempt + 1)
+		log.warning("Retrying %s after conflict: %s" % (route, exc))
+
+	def exhaust(self, request, exc):
+
+		route = self.route(request)
+		self.stats.exhaust(route)
+		log.error("Giving up on %s after %d attempts: %s" %
+					(route, self.attempts, exc))
+
+
+retry_stats = RetryStats()
+retry_policy = RetryPolicy()
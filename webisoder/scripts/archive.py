@@ -0,0 +1,55 @@
+import os
+import sys
+
+
+from pyramid.paster import (
+	get_appsettings,
+	setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+
+from ..engines import engine_from_settings
+from ..models import (
+	ArchivedEpisode,
+	Base,
+	archive_episodes,
+	restore_history,
+)
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> [restore=<show_id>] [var=value]\n'
+		'(example: "%s development.ini")' % (cmd, cmd))
+	sys.exit(1)
+
+
+def main(argv=sys.argv):
+	if len(argv) < 2:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[2:])
+	setup_logging(config_uri)
+	settings = get_appsettings(config_uri, options=options)
+	engine = engine_from_settings(settings)
+	Base.metadata.create_all(engine)
+
+	ArchivedEpisode.DAYS = int(settings.get('webisoder.archive.days', 0))
+	restore = options.get('restore')
+
+	with engine.begin() as connection:
+		if restore:
+			count = restore_history(connection, int(restore))
+			print('Restored %d episodes of show %s' % (count, restore))
+			return
+
+		horizon = ArchivedEpisode.horizon()
+
+		if not horizon:
+			print('Archival is disabled (webisoder.archive.days)')
+			return
+
+		count = archive_episodes(connection, horizon)
+		print('Archived %d episodes that aired before %s' %
+							(count, horizon))
@@ -0,0 +1,329 @@
+""" A small stand-in for the parts of TheTVDB XML API that tvdb_api uses.
+
+It serves a synthetic catalog generated from a seed, so the same options
+always produce the same shows, episodes and banners. Latency, errors and
+throttling can be injected to benchmark webisoder without internet access:
+
+	fake_tvdb_server --port 8081 --shows 10000 --latency 0.2
+
+and point webisoder at it with webisoder.tvdb.base_url = http://localhost:8081
+"""
+
+import argparse
+import logging
+import os
+import re
+import sys
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import date, timedelta
+from random import Random
+from threading import Lock
+from time import sleep, time
+from urlparse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+log = logging.getLogger(__name__)
+
+WORDS = ["doctor", "who", "big", "bang", "theory", "star", "trek", "law",
+	"order", "house", "cards", "game", "thrones", "breaking", "bad", "lost",
+	"office", "friends", "night", "city", "blue", "dead", "walking", "wire",
+	"sherlock", "mad", "men", "crown", "dark", "good", "place", "new"]
+
+STATUS = ["Continuing", "Continuing", "Ended"]
+
+BANNER = open(os.path.join(os.path.dirname(__file__), "..", "static", "img",
+						"nobanner.png"), "rb").read()
+
+
+class Catalog(object):
+
+	""" Shows are numbered from first_id on, everything about a show is
+	derived from the seed and its id so that nothing but the names needs
+	to be kept in memory.
+	"""
+
+	def __init__(self, shows=1000, seed=0, first_id=70000):
+
+		self.seed = seed
+		self.first_id = first_id
+		self.names = {}
+
+		random = Random(seed)
+
+		for id in range(first_id, first_id + shows):
+			words = random.sample(WORDS, random.randint(1, 4))
+			self.names[id] = "%s %d" % (" ".join(words).title(), id)
+
+	def random(self, id):
+
+		return Random("%s:%d" % (self.seed, id))
+
+	def search(self, text, limit=100):
+
+		text = text.lower()
+		res = [id for id, name in self.names.items()
+						if text in name.lower()]
+		return sorted(res)[:limit]
+
+	def show(self, id):
+
+		if id not in self.names:
+			return None
+
+		random = self.random(id)
+		return {
+			"id": id,
+			"SeriesName": self.names[id],
+			"Status": random.choice(STATUS),
+			"FirstAired": str(date(2000, 1, 1) +
+					timedelta(random.randint(0, 6000))),
+			"Overview": "Synthetic show number %d" % id,
+			"Language": "en"
+		}
+
+	def episodes(self, id):
+
+		random = self.random(id)
+		random.choice(STATUS)
+
+		seasons = random.randint(1, 10)
+		start = date.today() - timedelta(random.randint(0, 3000))
+		airdate = start
+		res = []
+
+		for season in range(1, seasons + 1):
+			for num in range(1, random.randint(6, 24) + 1):
+				res.append({
+					"id": id * 1000 + len(res),
+					"SeasonNumber": season,
+					"EpisodeNumber": num,
+					"EpisodeName": "Episode %d of season %d" % (
+								num, season),
+					"FirstAired": str(airdate),
+					"absolute_number": len(res) + 1,
+					"ProductionCode": "%d%02d" % (season, num)
+				})
+				airdate += timedelta(7)
+
+			airdate += timedelta(random.randint(30, 200))
+
+		return res
+
+	def banners(self, id):
+
+		return [{
+			"id": id * 10 + num,
+			"BannerPath": "fanart/original/%d-%d.jpg" % (id, num),
+			"BannerType": "fanart",
+			"BannerType2": "1920x1080",
+			"Rating": "%.1f" % (num * 2.5),
+			"ThumbnailPath": "_cache/fanart/original/%d-%d.jpg" % (id, num)
+		} for num in range(1, 3)]
+
+
+class Faults(object):
+
+	""" Latency, error and throttling injection shared by all requests
+	"""
+
+	def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit=0,
+							seed=0, clock=time):
+
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.rate_limit = rate_limit
+		self.random = Random(seed)
+		self.clock = clock
+		self.tokens = float(rate_limit)
+		self.last = clock()
+		self.lock = Lock()
+
+	def throttled(self):
+
+		if not self.rate_limit:
+			return False
+
+		with self.lock:
+			now = self.clock()
+			self.tokens = min(float(self.rate_limit), self.tokens +
+					(now - self.last) * self.rate_limit)
+			self.last = now
+
+			if self.tokens < 1:
+				return True
+
+			self.tokens -= 1
+			return False
+
+	def delay(self):
+
+		with self.lock:
+			jitter = self.random.uniform(0, self.jitter)
+
+		if self.latency or jitter:
+			sleep(self.latency + jitter)
+
+	def failed(self):
+
+		with self.lock:
+			return self.random.random() < self.error_rate
+
+
+def element(tag, data):
+
+	fields = "".join("<%s>%s</%s>" % (key, escape("%s" % value), key)
+			for key, value in sorted(data.items()) if value is not None)
+	return "<%s>%s</%s>" % (tag, fields, tag)
+
+
+class FakeTVDBHandler(BaseHTTPRequestHandler):
+
+	routes = [
+		(re.compile(r"^/api/GetSeries\.php$"), "search"),
+		(re.compile(r"^/api/[^/]+/series/(\d+)/all/[a-z]+\.xml$"), "all"),
+		(re.compile(r"^/api/[^/]+/series/(\d+)/banners\.xml$"), "banners"),
+		(re.compile(r"^/api/[^/]+/series/(\d+)/[a-z]+\.xml$"), "series"),
+		(re.compile(r"^/banners/(.+)$"), "image")
+	]
+
+	def log_message(self, format, *args):
+
+		log.debug(format % args)
+
+	def send(self, body, content_type="text/xml; charset=utf-8", code=200):
+
+		if isinstance(body, unicode):
+			body = body.encode("utf-8")
+
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def xml(self, body):
+
+		self.send('<?xml version="1.0" encoding="UTF-8" ?>\n%s' % body)
+
+	def do_GET(self):
+
+		faults = self.server.faults
+		url = urlparse(self.path)
+
+		if faults.throttled():
+			return self.send("Too many requests", "text/plain", 429)
+
+		faults.delay()
+
+		if faults.failed():
+			return self.send("Internal error", "text/plain", 500)
+
+		for pattern, name in self.routes:
+			match = pattern.match(url.path)
+
+			if match:
+				return getattr(self, name)(url, *match.groups())
+
+		self.send("Not found", "text/plain", 404)
+
+	def search(self, url):
+
+		catalog = self.server.catalog
+		query = parse_qs(url.query).get("seriesname", [""])[0]
+		shows = [catalog.show(id) for id in
+				catalog.search(query.decode("utf-8"))]
+
+		self.xml("<Data>%s</Data>" % "".join(element("Series", {
+			"seriesid": show["id"],
+			"id": show["id"],
+			"SeriesName": show["SeriesName"],
+			"FirstAired": show["FirstAired"],
+			"Overview": show["Overview"],
+			"language": "en"
+		}) for show in shows))
+
+	def series(self, url, id, episodes=False):
+
+		catalog = self.server.catalog
+		show = catalog.show(int(id))
+
+		if not show:
+			return self.send("Not found", "text/plain", 404)
+
+		body = element("Series", show)
+
+		if episodes:
+			body += "".join(element("Episode", episode)
+				for episode in catalog.episodes(int(id)))
+
+		self.xml("<Data>%s</Data>" % body)
+
+	def all(self, url, id):
+
+		self.series(url, id, True)
+
+	def banners(self, url, id):
+
+		catalog = self.server.catalog
+
+		if not catalog.show(int(id)):
+			return self.send("Not found", "text/plain", 404)
+
+		self.xml("<Banners>%s</Banners>" % "".join(element("Banner", b)
+				for b in catalog.banners(int(id))))
+
+	def image(self, url, path):
+
+		self.send(BANNER, "image/png")
+
+
+class FakeTVDBServer(ThreadingMixIn, HTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, address, catalog, faults):
+
+		HTTPServer.__init__(self, address, FakeTVDBHandler)
+		self.catalog = catalog
+		self.faults = faults
+
+	def base_url(self):
+
+		host, port = self.server_address[:2]
+		return "http://%s:%d" % (host, port)
+
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+		description="Serve a synthetic TheTVDB catalog")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8081)
+	parser.add_argument("--shows", type=int, default=1000,
+		help="number of shows in the catalog")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--latency", type=float, default=0,
+		help="seconds added to every response")
+	parser.add_argument("--jitter", type=float, default=0,
+		help="up to this many random seconds added on top")
+	parser.add_argument("--error-rate", type=float, default=0,
+		help="fraction of requests answered with HTTP 500")
+	parser.add_argument("--rate-limit", type=float, default=0,
+		help="requests per second before answering HTTP 429")
+	args = parser.parse_args(argv[1:])
+
+	logging.basicConfig(level=logging.INFO)
+
+	catalog = Catalog(args.shows, args.seed)
+	faults = Faults(args.latency, args.jitter, args.error_rate,
+						args.rate_limit, args.seed)
+	server = FakeTVDBServer((args.host, args.port), catalog, faults)
+
+	log.info("Serving %d shows on %s" % (args.shows, server.base_url()))
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -2,7 +2,6 @@ import os
 import sys
 import transaction
 
-from sqlalchemy import engine_from_config
 
 from pyramid.paster import (
 	get_appsettings,
@@ -11,10 +10,20 @@ from pyramid.paster import (
 
 from pyramid.scripts.common import parse_vars
 
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from ..engines import engine_from_settings, shard_engines
 from ..models import (
 	DBSession,
 	Base,
+	fill_upcoming,
+	sync_airdates,
 )
+from .shards import create_user_tables
+
+# Columns that are filled from the episodes when they are added
+AIRDATES = set(['shows.next_airdate', 'shows.last_airdate'])
 
 
 def usage(argv):
@@ -24,6 +33,46 @@ def usage(argv):
 	sys.exit(1)
 
 
+def add_columns(engine):
+	""" Add the columns that were introduced after a table was created,
+	create_all does not alter existing tables
+	"""
+	inspector = inspect(engine)
+	added = []
+
+	for table in Base.metadata.sorted_tables:
+		existing = set(c['name'] for c in inspector.get_columns(
+								table.name))
+
+		for column in table.columns:
+			if column.name in existing:
+				continue
+
+			ddl = CreateColumn(column).compile(dialect=engine.dialect)
+			engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+							table.name, ddl))
+			added.append('%s.%s' % (table.name, column.name))
+
+	return added
+
+
+def upgrade(engine):
+	""" Bring a database created by an earlier version up to date. Shows
+	that already exist were imported by then, shows.pending defaults to
+	false for them.
+	"""
+	Base.metadata.create_all(engine)
+	added = add_columns(engine)
+
+	with engine.begin() as connection:
+		if AIRDATES.intersection(added):
+			sync_airdates(connection)
+
+		fill_upcoming(connection)
+
+	return added
+
+
 def main(argv=sys.argv):
 	if len(argv) < 2:
 		usage(argv)
@@ -31,9 +80,14 @@ def main(argv=sys.argv):
 	options = parse_vars(argv[2:])
 	setup_logging(config_uri)
 	settings = get_appsettings(config_uri, options=options)
-	engine = engine_from_config(settings, 'sqlalchemy.')
+	engine = engine_from_settings(settings)
 	DBSession.configure(bind=engine)
-	Base.metadata.create_all(engine)
+
+	for column in upgrade(engine):
+		print('Added column %s' % column)
+
+	for shard in shard_engines(settings, engine):
+		create_user_tables(shard)
 	#with transaction.manager:
 	#	model = MyModel(name='one', value=1)
 	#	DBSession.add(model)
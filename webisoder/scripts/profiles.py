@@ -0,0 +1,106 @@
+import os
+import pstats
+import sys
+
+from pyramid.paster import get_appsettings
+
+from pyramid.scripts.common import parse_vars
+
+from ..profiling import FORMATS, Profiler, profile_header
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> [route=<name>] [output=<file>] '
+		'[header=<seconds>] [var=value]\n'
+		'(example: "%s development.ini route=feed > feed.collapsed")' %
+		(cmd, cmd))
+	sys.exit(1)
+
+
+def profile_paths(directory, extension, route=None):
+
+	""" The profiles of a route, or of all routes, by route name
+	"""
+	routes = [route] if route else sorted(os.listdir(directory))
+	res = []
+
+	for name in routes:
+		path = os.path.join(directory, name)
+
+		if not os.path.isdir(path):
+			continue
+
+		res.extend((name, os.path.join(path, f)) for f in
+				sorted(os.listdir(path)) if f.endswith(extension))
+
+	return res
+
+
+def merge_stacks(paths, prefix=False):
+
+	""" Add up the samples of identical stacks, optionally with the route
+	as the outermost frame
+	"""
+	stacks = {}
+
+	for route, path in paths:
+		with open(path) as profile:
+			for line in profile:
+				stack, samples = line.rstrip("\n").rsplit(" ", 1)
+
+				if prefix:
+					stack = "%s;%s" % (route, stack)
+
+				stacks[stack] = stacks.get(stack, 0) + int(samples)
+
+	return stacks
+
+
+def main(argv=sys.argv):
+	if len(argv) < 2:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[2:])
+	settings = get_appsettings(config_uri, options=options)
+
+	profiler = Profiler()
+	profiler.configure(settings, 'webisoder.profile.')
+
+	if 'header' in options:
+		if not profiler.secret:
+			print('No secret configured (webisoder.profile.secret)')
+			sys.exit(1)
+
+		print('X-Webisoder-Profile: %s' % profile_header(
+				profiler.secret, int(options['header'])))
+		return
+
+	route = options.get('route')
+	output = options.get('output')
+	paths = profile_paths(profiler.directory, FORMATS[profiler.format],
+									route)
+
+	if not paths:
+		print('No profiles found in %s' % profiler.directory)
+		sys.exit(1)
+
+	if profiler.format == 'pstats':
+		stats = pstats.Stats(*[path for route, path in paths])
+
+		if output:
+			stats.dump_stats(output)
+		else:
+			stats.sort_stats('cumulative').print_stats(40)
+
+		return
+
+	stacks = merge_stacks(paths, prefix=not route)
+	out = open(output, 'w') if output else sys.stdout
+
+	try:
+		for stack, samples in sorted(stacks.items()):
+			out.write('%s %d\n' % (stack, samples))
+	finally:
+		if output:
+			out.close()
@@ -0,0 +1,153 @@
+import logging
+import os
+import sys
+import transaction
+
+from datetime import date, datetime, timedelta
+from threading import Lock, Thread
+
+from sqlalchemy import and_, or_
+from tvdb_api import tvdb_shownotfound
+
+from pyramid.paster import (
+	get_appsettings,
+	setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+from pyramid_beaker import set_cache_regions_from_settings
+
+from ..engines import engine_from_settings
+from ..jobs import store_show
+from ..models import (
+	ArchivedEpisode,
+	DBSession,
+	Show,
+)
+from ..subscribers import subscribers
+from ..tvdb import AIMDLimiter, TVDBWrapper, breaker, pool
+
+log = logging.getLogger(__name__)
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> [var=value]\n'
+		'(example: "%s development.ini")' % (cmd, cmd))
+	sys.exit(1)
+
+
+def refresh_show(show_id, url, backend):
+	# Failures must reach the limiter, which does the backing off, and old
+	# data must not be stored as fresh: the circuit breaker and the stale
+	# fallback are for the site only
+	data = backend.getByURL(url, site=False)
+
+	with transaction.manager:
+		show = DBSession.query(Show).get(show_id)
+
+		if show:
+			store_show(show, data)
+
+
+def scheduled_shows(recheck=30):
+	# Disabled shows will not change anymore. Ended shows only do while
+	# their last episodes are still ahead, or when they are renewed.
+	# Shows whose import failed or never ran are imported here.
+	enabled = or_(Show.enabled.is_(None), Show.enabled == True)
+	ended = and_(enabled, Show.status == Show.ENDED, or_(
+		Show.last_airdate >= date.today(), Show.updated.is_(None),
+		Show.updated < datetime.now() - timedelta(recheck)))
+
+	return DBSession.query(Show.id, Show.url).filter(or_(Show.active,
+						Show.pending, ended)).all()
+
+
+class Refresh(object):
+
+	def __init__(self, shows, limiter, backend=TVDBWrapper):
+		self.shows = iter(shows)
+		self.limiter = limiter
+		self.backend = backend()
+		self.lock = Lock()
+
+	def next_show(self):
+		with self.lock:
+			return next(self.shows, None)
+
+	def work(self):
+		while True:
+			show = self.next_show()
+
+			if show is None:
+				return
+
+			start = self.limiter.acquire()
+			success = True
+
+			try:
+				refresh_show(show[0], show[1], self.backend)
+			except tvdb_shownotfound:
+				log.warning("Show %s not found on TVDB" % show[1])
+			except Exception as e:
+				log.error("Failed to refresh show %s: %s" % (show[1], e))
+				success = False
+			finally:
+				DBSession.remove()
+				self.limiter.release(start, success)
+
+			if self.limiter.completed % 100 == 0:
+				log.info('%d shows refreshed, %.2f shows/s, concurrency %d'
+					% (self.limiter.completed, self.limiter.rate(),
+					self.limiter.limit))
+
+	def run(self):
+		workers = [Thread(target=self.work, name="refresh-%d" % i)
+					for i in range(self.limiter.maximum)]
+
+		for worker in workers:
+			worker.start()
+
+		for worker in workers:
+			worker.join()
+
+
+def main(argv=sys.argv):
+	if len(argv) < 2:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[2:])
+	setup_logging(config_uri)
+	settings = get_appsettings(config_uri, options=options)
+	engine = engine_from_settings(settings)
+	DBSession.configure(bind=engine)
+	set_cache_regions_from_settings(settings)
+	breaker.configure(settings, 'webisoder.tvdb.')
+	TVDBWrapper.base_url = settings.get('webisoder.tvdb.base_url')
+	ArchivedEpisode.DAYS = int(settings.get('webisoder.archive.days', 0))
+
+	limiter = AIMDLimiter()
+	limiter.configure(settings, 'webisoder.refresh.')
+
+	# The limiter decides on the concurrency, the pool must not cap it
+	pool.configure(settings, 'webisoder.tvdb.')
+	pool.workers = limiter.maximum
+	pool.queue.maxsize = limiter.maximum
+
+	with transaction.manager:
+		shows = scheduled_shows(int(settings.get(
+				'webisoder.refresh.recheck_ended', 30)))
+		subscribers.load()
+
+	# Collect the users whose feeds changed while refreshing
+	affected = set()
+	subscribers.listeners.append(lambda shows, users:
+						affected.update(users))
+
+	refresh = Refresh(shows, limiter)
+	refresh.run()
+
+	print('Refreshed %d shows (%d failed) at %.2f shows/s, final '
+		'concurrency %d' % (limiter.completed, limiter.errors,
+		limiter.rate(), limiter.limit))
+	print('%d users affected' % len(affected))
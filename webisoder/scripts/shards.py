@@ -0,0 +1,128 @@
+import os
+import sys
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine.url import make_url
+
+from pyramid.paster import (
+	get_appsettings,
+	setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+
+from ..engines import engine_from_settings, shard_engines
+from ..models import (
+	Base,
+	User,
+	subscriptions,
+)
+from ..shards import shard_index
+
+users = User.__table__
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> [sources=<url>,...] [var=value]\n'
+		'(example: "%s development.ini")' % (cmd, cmd))
+	sys.exit(1)
+
+
+def create_user_tables(engine):
+
+	# On SQLite, the attached catalog would hide missing tables
+	if engine.dialect.name == 'sqlite':
+		bare = create_engine(engine.url)
+		Base.metadata.create_all(bare, tables=[users, subscriptions])
+		bare.dispose()
+	else:
+		Base.metadata.create_all(engine, tables=[users, subscriptions])
+
+
+def move_user(source, target, name):
+
+	""" Copy a user and their subscriptions to the target, then remove them
+	from the source. Rows that are already on the target are kept, so that
+	an interrupted run can simply be repeated.
+	"""
+	user = source.execute(users.select().where(
+				users.c.user_name == name)).first()
+	rows = source.execute(subscriptions.select().where(
+			subscriptions.c.user_name == name)).fetchall()
+
+	with target.begin() as connection:
+		exists = connection.execute(select([users.c.user_name]).where(
+				users.c.user_name == name)).first()
+
+		if not exists:
+			connection.execute(users.insert(), dict(user))
+
+		shows = set(id for id, in connection.execute(
+			select([subscriptions.c.show_id]).where(
+			subscriptions.c.user_name == name)))
+		rows = [dict(row) for row in rows if row.show_id not in shows]
+
+		if rows:
+			connection.execute(subscriptions.insert(), rows)
+
+	with source.begin() as connection:
+		connection.execute(subscriptions.delete().where(
+				subscriptions.c.user_name == name))
+		connection.execute(users.delete().where(
+				users.c.user_name == name))
+
+
+def rebalance(sources, targets):
+
+	""" Move every user on the sources to the target they hash to. Engines
+	are told apart by their URL, the same database may well be reached
+	through more than one of them.
+	"""
+	moved = 0
+	seen = set()
+
+	for source in sources:
+		url = str(source.url)
+
+		if url in seen:
+			continue
+
+		seen.add(url)
+		names = [name for name, in source.execute(
+					select([users.c.user_name]))]
+
+		for name in names:
+			target = targets[shard_index(name, len(targets))]
+
+			if str(target.url) != url:
+				move_user(source, target, name)
+				moved += 1
+
+	return moved
+
+
+def main(argv=sys.argv):
+	if len(argv) < 2:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[2:])
+	setup_logging(config_uri)
+	settings = get_appsettings(config_uri, options=options)
+	engine = engine_from_settings(settings)
+
+	# Without shards, all users are moved back to the main database
+	targets = shard_engines(settings, engine) or [engine]
+
+	for target in targets:
+		create_user_tables(target)
+
+	# Shards that are no longer configured, when reducing their number
+	sources = [engine] + [t for t in targets if t is not engine]
+	known = set(str(source.url) for source in sources)
+	sources.extend(create_engine(url) for url in
+			options.get('sources', '').split(',')
+			if url and str(make_url(url)) not in known)
+
+	moved = rebalance(sources, targets)
+	print('Moved %d users across %d shards' % (moved, len(targets)))
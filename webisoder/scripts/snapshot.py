@@ -0,0 +1,206 @@
+""" Export and import the show catalog (shows and episodes) as a snapshot.
+
+A snapshot is a gzip compressed text file with one JSON array per line. The
+first line identifies the format, followed by all shows and then all
+episodes, so that every episode comes after its show:
+
+	["webisoder-snapshot", 1]
+	["show", show_id, url, name, status, enabled, updated, next_airdate]
+	["episode", show_id, season, num, airdate, title, totalnum, prodnum]
+
+Dates are ISO 8601 strings, missing values are null. Archived episodes are
+exported like all others and imported into the episodes table. Both
+directions stream the data in batches, so memory use does not depend on the
+catalog size. Shows that already exist in the target database are skipped
+together with their episodes, which makes it safe to run an import again.
+"""
+
+import gzip
+import json
+import os
+import sys
+
+from datetime import datetime
+
+from sqlalchemy import select
+
+from pyramid.paster import (
+	get_appsettings,
+	setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+
+from ..engines import engine_from_settings
+from ..models import (
+	ArchivedEpisode,
+	Base,
+	Episode,
+	Show,
+	sync_airdates,
+	sync_upcoming,
+)
+
+FORMAT = ["webisoder-snapshot", 1]
+BATCH = 10000
+
+shows = Show.__table__
+episodes = Episode.__table__
+archive = ArchivedEpisode.__table__
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> <snapshot> [var=value]\n'
+		'(example: "%s development.ini catalog.jsonl.gz")' % (cmd, cmd))
+	sys.exit(1)
+
+
+def iso(value):
+	return value.isoformat() if value is not None else None
+
+
+def parse_date(value):
+	if value is None:
+		return None
+	return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parse_datetime(value):
+	if value is None:
+		return None
+	return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def write(out, row):
+	out.write(json.dumps(row, separators=(",", ":")))
+	out.write("\n")
+
+
+def export_snapshot(connection, out):
+	write(out, FORMAT)
+	count = [0, 0]
+
+	query = select([shows.c.show_id, shows.c.url, shows.c.show_name,
+		shows.c.status, shows.c.enabled, shows.c.updated,
+		shows.c.next_airdate]).order_by(shows.c.show_id)
+	result = connection.execution_options(stream_results=True).execute(
+									query)
+
+	for row in iter(lambda: result.fetchmany(BATCH), []):
+		for id, url, name, status, enabled, updated, upcoming in row:
+			write(out, ["show", id, url, name, status, enabled,
+					iso(updated), iso(upcoming)])
+			count[0] += 1
+
+	for table in [episodes, archive]:
+		query = select([table.c.show_id, table.c.season, table.c.num,
+			table.c.airdate, table.c.title, table.c.totalnum,
+			table.c.prodnum]).order_by(table.c.show_id)
+		result = connection.execution_options(
+				stream_results=True).execute(query)
+
+		for row in iter(lambda: result.fetchmany(BATCH), []):
+			for show, season, num, airdate, title, total, prod in row:
+				write(out, ["episode", show, season, num,
+					iso(airdate), title, total, prod])
+				count[1] += 1
+
+	return tuple(count)
+
+
+def import_snapshot(connection, snapshot, batch=BATCH):
+	header = json.loads(next(snapshot))
+
+	if header != FORMAT:
+		raise ValueError("Not a webisoder snapshot: %r" % header)
+
+	existing = set(id for id, in connection.execute(
+						select([shows.c.show_id])))
+	pending = {shows: [], episodes: []}
+	count = {shows: 0, episodes: 0}
+
+	def flush(table):
+		if pending[table]:
+			connection.execute(table.insert(), pending[table])
+			count[table] += len(pending[table])
+			del pending[table][:]
+
+	for line in snapshot:
+		row = json.loads(line)
+
+		if row[0] == "show":
+			id, url, name, status, enabled, updated, upcoming = row[1:]
+
+			if id in existing:
+				continue
+
+			pending[shows].append({"show_id": id, "url": url,
+				"show_name": name, "status": status,
+				"enabled": enabled, "updated": parse_datetime(updated),
+				"next_airdate": parse_date(upcoming)})
+
+			if len(pending[shows]) >= batch:
+				flush(shows)
+
+		elif row[0] == "episode":
+			show, season, num, airdate, title, total, prod = row[1:]
+
+			if show in existing:
+				continue
+
+			# All shows are listed before the first episode
+			flush(shows)
+
+			pending[episodes].append({"show_id": show, "season": season,
+				"num": num, "airdate": parse_date(airdate),
+				"title": title, "totalnum": total, "prodnum": prod})
+
+			if len(pending[episodes]) >= batch:
+				flush(episodes)
+
+	flush(shows)
+	flush(episodes)
+
+	return count[shows], count[episodes]
+
+
+def setup(argv):
+	if len(argv) < 3:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[3:])
+	setup_logging(config_uri)
+	settings = get_appsettings(config_uri, options=options)
+	engine = engine_from_settings(settings)
+	return engine
+
+
+def export_main(argv=sys.argv):
+	engine = setup(argv)
+
+	with engine.connect() as connection:
+		out = gzip.open(argv[2], 'wb')
+		try:
+			count = export_snapshot(connection, out)
+		finally:
+			out.close()
+
+	print('Exported %d shows and %d episodes' % count)
+
+
+def import_main(argv=sys.argv):
+	engine = setup(argv)
+	Base.metadata.create_all(engine)
+
+	snapshot = gzip.open(argv[2], 'rb')
+
+	try:
+		with engine.begin() as connection:
+			count = import_snapshot(connection, snapshot)
+			sync_airdates(connection)
+			sync_upcoming(connection)
+	finally:
+		snapshot.close()
+
+	print('Imported %d shows and %d episodes' % count)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+from pyramid.paster import (
+	get_appsettings,
+	setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+
+from ..engines import engine_from_settings
+from ..models import (
+	fill_upcoming,
+	roll_off_upcoming,
+)
+
+
+def usage(argv):
+	cmd = os.path.basename(argv[0])
+	print('usage: %s <config_uri> [var=value]\n'
+		'(example: "%s development.ini")' % (cmd, cmd))
+	sys.exit(1)
+
+
+def maintain_upcoming(connection):
+	""" Daily job: drop the episodes that have left the feed window, fill
+	the table from scratch if it is empty
+	"""
+	if fill_upcoming(connection):
+		return 0
+
+	return roll_off_upcoming(connection)
+
+
+def main(argv=sys.argv):
+	if len(argv) < 2:
+		usage(argv)
+	config_uri = argv[1]
+	options = parse_vars(argv[2:])
+	setup_logging(config_uri)
+	settings = get_appsettings(config_uri, options=options)
+	engine = engine_from_settings(settings)
+
+	with engine.begin() as connection:
+		removed = maintain_upcoming(connection)
+
+	print('Removed %d past episodes from the upcoming episodes' % removed)
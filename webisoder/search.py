@@ -0,0 +1,126 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+
+from threading import Event, Lock
+
+from .cache import region_cache
+from .ranking import rank
+
+log = logging.getLogger(__name__)
+
+PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+
+
+def normalize_query(text):
+
+	""" Normalize a search term so that queries which only differ in case,
+	whitespace or punctuation are treated as the same query.
+	"""
+	text = PUNCTUATION.sub("", text.lower())
+	return " ".join(text.split())
+
+
+class PendingSearch(object):
+
+	def __init__(self):
+
+		self.done = Event()
+		self.result = None
+		self.error = None
+
+	def wait(self):
+
+		self.done.wait()
+
+		if self.error is not None:
+			raise self.error
+
+		return self.result
+
+
+class SearchCache(object):
+
+	""" Caches ranked search results by normalized query in a beaker cache
+	region and makes sure that concurrent identical searches only result in
+	a single upstream call.
+	"""
+
+	namespace = "webisoder.search"
+
+	def __init__(self, region="default_term", limit=50):
+
+		self.region = region
+		self.limit = limit
+		self.pending = {}
+		self.lock = Lock()
+
+	def configure(self, settings):
+
+		self.region = settings.get("webisoder.search_cache_region",
+								self.region)
+		self.limit = int(settings.get("webisoder.search_limit",
+								self.limit))
+
+	def cache(self):
+
+		return region_cache(self.namespace, self.region)
+
+	def search(self, text, backend):
+
+		key = normalize_query(text)
+		cache = self.cache()
+
+		if cache is not None:
+			try:
+				return cache.get(key)
+			except KeyError:
+				pass
+
+		with self.lock:
+			pending = self.pending.get(key)
+			leader = pending is None
+
+			if leader:
+				pending = self.pending[key] = PendingSearch()
+
+		if not leader:
+			log.debug("Joining pending search for '%s'" % key)
+			return pending.wait()
+
+		try:
+			# Ranked like the key so that all queries sharing it get
+			# the same order, whichever of them came first
+			result = rank(key, backend.search(text), self.limit,
+							normalize_query)
+			pending.result = result
+
+			if cache is not None:
+				cache.put(key, result)
+		except Exception as e:
+			pending.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.pending[key]
+			pending.done.set()
+
+		return result
+
+
+search_cache = SearchCache()
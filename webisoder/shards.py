@@ -0,0 +1,240 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from hashlib import md5
+from itertools import chain
+
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import Query, Session, object_mapper
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+from sqlalchemy.sql.util import find_tables
+
+# Users and their subscriptions are spread over the shards by user name, the
+# catalog of shows and episodes stays in the main database, where each shard
+# can read it
+USER_TABLES = frozenset(["users", "subscriptions"])
+
+MAIN = "main"
+
+
+def shard_index(name, count):
+
+	""" The number of the shard a user belongs to
+	"""
+	return int(md5(name.encode("utf-8")).hexdigest()[:8], 16) % count
+
+
+def shard_id(name, count):
+
+	return "shard%d" % shard_index(name, count)
+
+
+def shard_binds(catalog, engines):
+
+	""" The shards argument for a RoutingSession
+	"""
+	binds = dict(("shard%d" % index, engine)
+				for index, engine in enumerate(engines))
+	binds[MAIN] = catalog
+	return binds
+
+
+def user_mapper(mapper):
+
+	return mapper is not None and mapper.local_table.name in USER_TABLES
+
+
+def user_clause(clause):
+
+	tables = find_tables(clause, include_crud=True)
+	return any(table.name in USER_TABLES for table in tables)
+
+
+class RoutingQuery(ShardedQuery):
+
+	def __init__(self, *args, **kwargs):
+
+		Query.__init__(self, *args, **kwargs)
+		self._shard_id = None
+
+	# Lazy loads are baked and reused by later sessions, always ask the
+	# session the query currently runs in
+	@property
+	def id_chooser(self):
+
+		return self.session.choose_ids
+
+	@property
+	def query_chooser(self):
+
+		return self.session.choose_query
+
+	def _execute_and_instances(self, context):
+
+		if not self.session.shards:
+			return Query._execute_and_instances(self, context)
+
+		# Catalog rows keep their identity even when read through a
+		# shard, e.g. the shows of a user
+		users = user_mapper(self._mapper_zero())
+
+		def iter_for_shard(shard):
+
+			context.attributes["shard_id"] = shard
+			context.identity_token = shard if users else MAIN
+			result = self._connection_from_session(
+					mapper=self._mapper_zero(),
+					shard_id=shard).execute(context.statement,
+					self._params)
+			return self.instances(result, context)
+
+		# Refreshing an object that is already loaded
+		if context.identity_token is not None:
+			return iter_for_shard(context.identity_token)
+
+		if self._shard_id is not None:
+			return iter_for_shard(self._shard_id)
+
+		partial = []
+
+		for shard in self.query_chooser(self):
+			partial.extend(iter_for_shard(shard))
+
+		return iter(partial)
+
+
+class RoutingSession(ShardedSession):
+
+	""" A session that keeps every user and their subscriptions on the
+	shard their name hashes to. Without shards, it is a plain session.
+	"""
+
+	def __init__(self, shards=None, **kwargs):
+
+		ShardedSession.__init__(self, self.choose_shard, self.choose_ids,
+			self.choose_query, shards=shards, query_cls=RoutingQuery,
+			**kwargs)
+
+		self.shards = sorted(id for id in shards or () if id != MAIN)
+
+		if not self.shards:
+			self.connection_callable = None
+
+	def shard_of(self, name):
+
+		if not self.shards:
+			return None
+
+		return shard_id(name, len(self.shards))
+
+	def user_shards(self):
+
+		""" The shards to look for users on
+		"""
+		return self.shards or [None]
+
+	def choose_shard(self, mapper, instance, clause=None):
+
+		if instance is not None:
+			if user_mapper(mapper):
+				return self.shard_of(instance.name)
+
+			return MAIN
+
+		if clause is not None:
+			if user_clause(clause):
+				raise ValueError("Statements on users and "
+					"subscriptions need an explicit shard")
+
+			return MAIN
+
+		if mapper is None:
+			return MAIN
+
+		# Subscriptions are written for a relationship rather than an
+		# object, they belong to the users being flushed
+		shards = set(self.shard_of(user.name)
+					for user in self.flushed_users())
+
+		if len(shards) > 1:
+			raise ValueError("Subscriptions of users on different "
+					"shards must be flushed separately")
+
+		return shards.pop() if shards else MAIN
+
+	def flushed_users(self):
+
+		for obj in self.new | self.dirty | self.deleted:
+			mapper = object_mapper(obj)
+
+			if user_mapper(mapper):
+				yield obj
+			elif "users" in mapper.relationships:
+				hist = get_history(obj, "users",
+						PASSIVE_NO_INITIALIZE)
+
+				for user in chain(hist.added or (),
+							hist.deleted or ()):
+					yield user
+
+	def choose_ids(self, query, ident):
+
+		if not self.shards:
+			return [None]
+
+		if user_mapper(query._mapper_zero()):
+			return [self.shard_of(ident[0])]
+
+		return [MAIN]
+
+	def choose_query(self, query):
+
+		if not self.shards:
+			return [None]
+
+		state = query.lazy_loaded_from
+
+		# The shows of a user are joined to their subscriptions
+		if state is not None and state.identity_token in self.shards:
+			return [state.identity_token]
+
+		if user_mapper(query._mapper_zero()):
+			return self.shards
+
+		return [MAIN]
+
+	def connection(self, mapper=None, instance=None, shard_id=None,
+						clause=None, **kwargs):
+
+		if not self.shards:
+			return Session.connection(self, mapper, clause=clause,
+								**kwargs)
+
+		if shard_id is None:
+			shard_id = self._choose_shard_and_assign(mapper, instance,
+								clause=clause)
+
+		return ShardedSession.connection(self, mapper, instance,
+						shard_id, **kwargs)
+
+	def get_bind(self, mapper=None, shard_id=None, instance=None,
+						clause=None, **kwargs):
+
+		if not self.shards:
+			return Session.get_bind(self, mapper, clause=clause)
+
+		return ShardedSession.get_bind(self, mapper, shard_id, instance,
+								clause, **kwargs)
@@ -1 +1,24 @@
 document.documentElement.className = document.documentElement.className.replace("no-js","js");
+
+$(document).ready(function()
+{
+	$('#searchShow').on('input', function(ev)
+	{
+		var input = $(this);
+		var text = input.val();
+
+		if (text.length < 2)
+			return;
+
+		$.getJSON(input.data('suggest'), { q: text }, function(shows)
+		{
+			var list = $('#searchSuggestions');
+			list.empty();
+
+			$.each(shows, function(i, show)
+			{
+				list.append($('<option>').attr('value', show.name));
+			});
+		});
+	});
+});
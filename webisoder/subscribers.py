@@ -0,0 +1,261 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import transaction
+
+from array import array
+from bisect import bisect_left
+from threading import Event, Lock, Thread
+from time import time
+
+from sqlalchemy import event, select
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+
+from .models import DBSession, Show, User, subscriptions
+
+log = logging.getLogger(__name__)
+
+
+class SubscriberIndex(object):
+
+	""" Maps every show to the sorted array of its subscribers. User names
+	are stored once and referred to by number, so that even shows with a
+	large number of subscribers take little memory and no User objects
+	have to be loaded.
+	"""
+
+	def __init__(self, interval=300):
+
+		self.names = []
+		self.ids = {}
+		self.shows = {}
+		self.interval = interval
+		self.last_refresh = None
+		self.listeners = []
+		self.lock = Lock()
+		self.thread = None
+		self.stopped = Event()
+
+	def configure(self, settings, prefix):
+
+		self.interval = int(settings.get(prefix + "interval",
+								self.interval))
+
+	def __id(self, name):
+
+		id = self.ids.get(name)
+
+		if id is None:
+			id = self.ids[name] = len(self.names)
+			self.names.append(name)
+
+		return id
+
+	def load(self):
+
+		""" Read all subscriptions from the database
+		"""
+		query = select([subscriptions.c.show_id,
+			subscriptions.c.user_name]).order_by(
+			subscriptions.c.show_id)
+		session = DBSession()
+		rows = []
+
+		for shard in session.user_shards():
+			connection = session.connection(shard_id=shard)
+			rows.extend(connection.execute(query))
+
+		with self.lock:
+			self.names = []
+			self.ids = {}
+			self.shows = {}
+
+			for show_id, name in rows:
+				users = self.shows.get(show_id)
+
+				if users is None:
+					users = self.shows[show_id] = array("I")
+
+				users.append(self.__id(name))
+
+			for show_id, users in self.shows.items():
+				self.shows[show_id] = array("I", sorted(users))
+
+			self.last_refresh = time()
+
+	def refresh(self):
+
+		""" Reload the index now and then to pick up subscriptions made
+		by other processes. All other methods work on memory only, so that
+		they can be used outside of a transaction.
+		"""
+		if self.last_refresh is None or (
+				time() - self.last_refresh >= self.interval):
+			self.load()
+
+	def start(self):
+
+		""" Reload the index every interval seconds in the background, so
+		that other processes' subscriptions are picked up even while
+		nothing in this process asks for a refresh
+		"""
+		if self.thread is not None:
+			return
+
+		self.stopped.clear()
+		self.thread = Thread(target=self.work, name="subscribers")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+
+		self.stopped.set()
+
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def work(self):
+
+		while not self.stopped.wait(self.interval):
+			try:
+				with transaction.manager:
+					self.refresh()
+			except Exception:
+				log.exception("Failed to reload the subscribers")
+			finally:
+				DBSession.remove()
+
+	def add(self, show_id, name):
+
+		with self.lock:
+			id = self.__id(name)
+			users = self.shows.setdefault(show_id, array("I"))
+			pos = bisect_left(users, id)
+
+			if pos == len(users) or users[pos] != id:
+				users.insert(pos, id)
+
+	def remove(self, show_id, name):
+
+		with self.lock:
+			id = self.ids.get(name)
+			users = self.shows.get(show_id)
+
+			if id is None or users is None:
+				return
+
+			pos = bisect_left(users, id)
+
+			if pos < len(users) and users[pos] == id:
+				users.pop(pos)
+
+			if not users:
+				del(self.shows[show_id])
+
+	def count(self, show_id):
+
+		return len(self.shows.get(show_id, ()))
+
+	def subscribers(self, show_id):
+
+		with self.lock:
+			return [self.names[id] for id in self.shows.get(show_id, ())]
+
+	def affected(self, shows):
+
+		""" The names of all users subscribed to any of the given shows
+		"""
+		with self.lock:
+			ids = set()
+
+			for show_id in shows:
+				ids.update(self.shows.get(show_id, ()))
+
+			return set(self.names[id] for id in ids)
+
+	def changed(self, shows):
+
+		""" Tell the listeners which users are affected by changes to the
+		given shows
+		"""
+		users = self.affected(shows)
+		log.debug("%d users affected by changes to %d shows" %
+						(len(users), len(shows)))
+
+		for listener in self.listeners:
+			listener(shows, users)
+
+		return users
+
+	def watch(self, session):
+
+		""" Apply subscriptions added or removed through the given session
+		once they are committed and notify the listeners about the shows
+		that were marked as changed
+		"""
+		def flushed(session, context):
+
+			added, removed = session.info.setdefault("subscribers",
+								([], []))
+
+			for obj in session.new | session.dirty | session.deleted:
+				if isinstance(obj, User):
+					hist = get_history(obj, "shows",
+							PASSIVE_NO_INITIALIZE)
+					pair = lambda show: (show.id, obj.name)
+				elif isinstance(obj, Show):
+					hist = get_history(obj, "users",
+							PASSIVE_NO_INITIALIZE)
+					pair = lambda user: (obj.id, user.name)
+				else:
+					continue
+
+				if obj in session.deleted:
+					removed.extend(pair(x) for x in hist.sum())
+					continue
+
+				# Unloaded collections have no history
+				added.extend(pair(x) for x in hist.added or ())
+				removed.extend(pair(x) for x in hist.deleted or ())
+
+		def committed(session):
+
+			added, removed = session.info.pop("subscribers", ([], []))
+			shows = session.info.pop("changed_shows", None)
+
+			for show_id, name in removed:
+				self.remove(show_id, name)
+
+			for show_id, name in added:
+				self.add(show_id, name)
+
+			if shows:
+				self.changed(shows)
+
+		def rolled_back(session):
+
+			session.info.pop("subscribers", None)
+			session.info.pop("changed_shows", None)
+
+		event.listen(session, "after_flush", flushed)
+		event.listen(session, "after_commit", committed)
+		event.listen(session, "after_rollback", rolled_back)
+
+
+subscribers = SubscriberIndex()
+subscribers.watch(DBSession)
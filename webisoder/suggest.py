@@ -0,0 +1,178 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+
+from sqlalchemy import or_
+
+from .models import DBSession, Show
+from .search import normalize_query
+
+
+class PrefixIndex(object):
+
+	""" A sorted in-memory index of show names that answers prefix queries
+	without a database or TheTVDB round-trip. Every word of a show name
+	starts a key so that "who" finds "Doctor Who" as well.
+	"""
+
+	def __init__(self, interval=60, overlap=300):
+
+		self.entries = []
+		self.names = {}
+		self.shows = {}
+		self.last_id = 0
+		self.pending = set()
+		self.checked = None
+		self.last_refresh = None
+		self.interval = interval
+		self.overlap = overlap
+		self.lock = Lock()
+
+	def keys(self, name):
+
+		words = normalize_query(name).split()
+		return [" ".join(words[pos:]) for pos in range(len(words))]
+
+	def __remove(self, url):
+
+		name = self.names.pop(url)
+
+		for key in self.keys(name):
+			entry = (key, url, name)
+			pos = bisect_left(self.entries, entry)
+
+			if pos < len(self.entries) and self.entries[pos] == entry:
+				del(self.entries[pos])
+
+	def add_many(self, shows):
+
+		with self.lock:
+			added = []
+
+			for url, name in shows:
+
+				if not url or not name:
+					continue
+
+				url = "%s" % url
+
+				if self.names.get(url) == name:
+					continue
+
+				if url in self.names:
+					self.__remove(url)
+
+				self.names[url] = name
+				added.extend((key, url, name) for key in self.keys(name))
+
+			if added:
+				self.entries.extend(added)
+				self.entries.sort()
+
+	def add(self, url, name):
+
+		self.add_many([(url, name)])
+
+	def add_results(self, result):
+
+		self.add_many((row.get("seriesid", row.get("id")),
+					row.get("seriesname")) for row in result)
+
+	def remove_many(self, urls):
+
+		with self.lock:
+			for url in urls:
+				if url in self.names:
+					self.__remove(url)
+
+	def refresh(self, force=False):
+
+		""" Load the shows that were added or changed since the last
+		refresh and drop the ones that are gone. Shows that are still
+		being imported only have the name a client posted, they are kept
+		aside and picked up once the import has stored the real one.
+		"""
+		now = time()
+
+		if not force and self.last_refresh is not None:
+			if now - self.last_refresh < self.interval:
+				return
+
+		self.last_refresh = now
+		checked = datetime.now()
+
+		columns = (Show.id, Show.url, Show.name, Show.pending)
+		criteria = [Show.id > self.last_id]
+
+		if self.checked is not None:
+			# Show.updated is set before the change is committed, see
+			# AirdateIndex.refresh
+			since = self.checked - timedelta(seconds=self.overlap)
+			criteria.append(Show.updated >= since)
+
+		if self.pending:
+			criteria.append(Show.id.in_(self.pending))
+
+		rows = DBSession.query(*columns).filter(or_(*criteria)).all()
+		ids = set(id for id, in DBSession.query(Show.id))
+
+		self.checked = checked
+		self.pending = set(id for id, url, name, pending in rows
+								if pending)
+		gone = [id for id in self.shows if id not in ids]
+		self.remove_many(self.shows.pop(id) for id in gone)
+
+		if not rows:
+			return
+
+		self.shows.update((id, "%s" % url) for id, url, name, pending
+							in rows if not pending)
+		self.add_many((url, name) for id, url, name, pending in rows
+								if not pending)
+		self.last_id = max(self.last_id, *[r[0] for r in rows])
+
+	def lookup(self, prefix, limit=10):
+
+		prefix = normalize_query(prefix)
+		res = []
+
+		if not prefix:
+			return res
+
+		seen = set()
+
+		with self.lock:
+			pos = bisect_left(self.entries, (prefix,))
+
+			while pos < len(self.entries) and len(res) < limit:
+				key, url, name = self.entries[pos]
+				pos += 1
+
+				if not key.startswith(prefix):
+					break
+
+				if url not in seen:
+					seen.add(url)
+					res.append({"url": url, "name": name})
+
+		return res
+
+
+suggestions = PrefixIndex()
@@ -14,35 +14,89 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import pstats
+import shutil
+import socket
+import tempfile
+import sqlite3
 import unittest
 import transaction
 import re
 
+from contextlib import contextmanager
+
+from beaker.cache import cache_regions
+from threading import Event, Thread
+from time import sleep, time
+
 from decimal import Decimal
-from datetime import date, timedelta
+from StringIO import StringIO
+from datetime import date, datetime, timedelta
 from pyramid import testing
+from pyramid.request import Request
+from pyramid.session import SignedCookieSessionFactory
+from pyramid.tweens import INGRESS
+from pyramid.urldispatch import Route
+from transaction.interfaces import TransientError
 from pyramid_mailer import get_mailer
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.authentication import SessionAuthenticationPolicy
 from pyramid.httpexceptions import HTTPBadRequest
-from sqlalchemy import create_engine
-from tvdb_api import tvdb_shownotfound
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from zope.sqlalchemy import mark_changed
+from tvdb_api import Episode as TVDBEpisode, Season, Show as TVDBShow
+from tvdb_api import tvdb_error, tvdb_shownotfound
+from urllib2 import URLError
 
 from deform.exception import ValidationFailure
 
 from .models import DBSession, Base, ResultRating, SiteNews, User, subscriptions
-from .models import Episode, Show
+from .models import ReadSession, ReplicaSession
+from .models import Episode, EpisodeRow, Show, ShowRow, UpcomingEpisode
+from .models import roll_off_upcoming, sync_upcoming, fill_upcoming, meta
+from .models import ArchivedEpisode, archive_episodes, restore_history
 
 from .views import IndexController, RegistrationController, TokenResetController
 from .views import ShowsController, EpisodesController, PasswordChangeController
 from .views import ProfileController, AuthController, PasswordRecoveryController
 from .views import FeedSettingsController, PasswordResetController
 from .views import SearchController, BannerController, FeedsController
+from .views import MetricsController
 
 from .errors import LoginFailure, DuplicateEmail, MailError, SubscriptionFailure
-from .errors import DuplicateUserName, FormError
-
+from .errors import DuplicateUserName, FormError, UpstreamUnavailable
+from .errors import UpstreamBusy, UpstreamTimeout
+
+from .airdates import AirdateIndex, airdates
+from .cache import cached, region_cache
+from .engines import engine_from_settings, shard_engines
+from .jobs import JobQueue, episodes_from, import_show, parse_status
+from .jobs import import_queue, store_show
 from .mail import WelcomeMessage, PasswordRecoveryMessage
+from .metrics import Histogram, Metrics, escape, metrics
+from .pragmas import configure_sqlite, sqlite_pragmas
+from .queries import QueryCollector, QueryStats, Queries, collector
+from .profiling import HEADER, Profiler, profile_header, profiler
+from .ranking import rank
+from .readonly import read_session, replica, replica_session, tm_activate
+from .retry import RetryPolicy, RetryStats, is_retryable
+from .search import SearchCache, normalize_query
+from .shards import shard_binds, shard_index
+from .subscribers import SubscriberIndex, subscribers
+from .suggest import PrefixIndex
+from .scripts.fake_tvdb import Catalog, Faults, FakeTVDBServer
+from .scripts.initializedb import upgrade
+from .scripts.refresh import Refresh, refresh_show, scheduled_shows
+from .scripts.profiles import merge_stacks, profile_paths
+from .scripts.shards import create_user_tables, rebalance
+from .scripts.snapshot import export_snapshot, import_snapshot
+from .scripts.upcoming import maintain_upcoming
+from .tvdb import AIMDLimiter, CircuitBreaker, TVDBWrapper, UpstreamPool
+from .tvdb import breaker
+from .tvdb import show_data, stale_cache
+from .users import ROUTE_OPTIONS, request_user
 
 import logging
 
@@ -61,7 +115,9 @@ class Database(object):
 			return
 
 		Database._engine = create_engine("sqlite://")
+		collector.watch(Database._engine)
 		DBSession.configure(bind=Database._engine)
+		ReadSession.configure(bind=Database._engine)
 		Base.metadata.create_all(Database._engine)
 
 
@@ -89,7 +145,43 @@ class MockTVDB(object):
 				"seriesname": "doctor who"
 			},
 			1359: {
-				"seriesname": "Show 1359"
+				"seriesname": "Show 1359",
+				"status": "Continuing",
+				1: {
+					1: {
+						"seasonnumber": "1",
+						"episodenumber": "1",
+						"episodename": "Pilot",
+						"firstaired": "2010-01-01",
+						"absolute_number": "1",
+						"productioncode": "101"
+					},
+					2: {
+						"seasonnumber": "1",
+						"episodenumber": "2",
+						"episodename": "Second",
+						"firstaired": str(date.today()),
+						"absolute_number": "2"
+					},
+					3: {
+						"seasonnumber": "1",
+						"episodenumber": "3",
+						"episodename": "Third",
+						"firstaired": None
+					}
+				},
+				2: {
+					1: {
+						"seasonnumber": "2",
+						"episodenumber": "1",
+						"episodename": "Return",
+						"firstaired": str(date.today() + timedelta(30))
+					},
+					2: {
+						"seasonnumber": None,
+						"episodenumber": "2"
+					}
+				}
 			},
 			79169: {
 				"seriesname": "Seinfeld",
@@ -100,7 +192,7 @@ class MockTVDB(object):
 			}
 		}
 
-	def getByURL(self, url):
+	def getByURL(self, url, site=True):
 
 		if not url.isdigit():
 			raise tvdb_shownotfound()
@@ -143,6 +235,21 @@ class MockTVDB(object):
 		return res
 
 
+class MockQueue(object):
+
+	def __init__(self):
+
+		self.jobs = []
+
+	def put(self, func, *args):
+
+		self.jobs.append((func, args))
+
+	def defer(self, func, *args):
+
+		self.put(func, *args)
+
+
 class MockUser(object):
 
 	@staticmethod
@@ -190,6 +297,18 @@ class WebisoderTest(unittest.TestCase):
 		self.config.add_route("recover", "__RECOVER__")
 		self.config.add_route("reset_password", "__REC__/{key}")
 
+	@contextmanager
+	def assertQueries(self, budget):
+
+		""" Fail if the block executes more than budget statements
+		"""
+		with collector.collect(keep=True) as queries:
+			yield queries
+
+		self.assertLessEqual(queries.count, budget,
+				"%d statements, budget %d:\n%s" % (queries.count,
+				budget, "\n".join(queries.statements)))
+
 
 class WebisoderNewModelTests(unittest.TestCase):
 
@@ -499,6 +618,30 @@ class WebisoderModelTests(unittest.TestCase):
 		fmt = '//##SHOW## : ##TITLE##'
 		self.assertEqual('//show1 : test me', ep.render(fmt))
 
+	def testEpisodeRow(self):
+
+		show = DBSession.query(Show).get(1)
+		episode = DBSession.query(Episode).get((1, 2, 1))
+		episode.title = "test me"
+		episode.airdate = date(2016, 3, 4)
+		show.updated = datetime(2016, 3, 1)
+
+		rows = EpisodeRow.query(Episode.show_id == 1)
+		self.assertEqual(2, len(rows))
+		self.assertIs(rows[0].show, rows[1].show)
+		self.assertEqual(ShowRow(1, "show1", "http://1",
+					datetime(2016, 3, 1)), rows[0].show)
+
+		row = [r for r in rows if r.num == 2][0]
+		self.assertEqual(date(2016, 3, 4), row.airdate)
+		self.assertEqual(str(episode), str(row))
+
+		fmt = "//##SHOW## S##SEASON##E##EPISODE## ##TITLE##"
+		self.assertEqual(episode.render(fmt), row.render(fmt))
+
+		with self.assertRaises(AttributeError):
+			row.totalnum = 1
+
 	def testNextEpisode(self):
 
 		show = DBSession.query(Show).get(2)
@@ -521,6 +664,60 @@ class WebisoderModelTests(unittest.TestCase):
 
 		self.assertEqual(ep, ep2)
 
+		show.status = Show.ENDED
+
+		with DBSession.no_autoflush:
+			self.assertIsNone(show.next_episode)
+
+			# Ended with the finale still ahead
+			show.last_airdate = today + timedelta(2)
+			self.assertEqual(ep2, show.next_episode)
+
+			show.next_airdate = today + timedelta(1)
+			self.assertEqual(today + timedelta(1), show.next_date)
+
+	def testActiveShows(self):
+
+		show1 = DBSession.query(Show).get(1)
+		show2 = DBSession.query(Show).get(2)
+
+		self.assertTrue(show1.active)
+		show1.status = Show.RUNNING
+		show1.enabled = True
+		self.assertTrue(show1.active)
+
+		show1.status = Show.ENDED
+		self.assertFalse(show1.active)
+		show2.enabled = False
+		self.assertFalse(show2.active)
+
+		active = DBSession.query(Show).filter(Show.active).all()
+		self.assertEqual([], active)
+
+		show1.status = Show.PAUSED
+		active = DBSession.query(Show).filter(Show.active).all()
+		self.assertEqual([show1], active)
+
+	def testEndedShowAiredSince(self):
+
+		show = DBSession.query(Show).get(1)
+		today = date.today()
+
+		self.assertTrue(show.aired_since(today))
+
+		show.status = Show.ENDED
+		show.last_airdate = today - timedelta(10)
+		self.assertFalse(show.aired_since(today - timedelta(7)))
+		self.assertTrue(show.aired_since(today - timedelta(14)))
+
+		# Ended on TheTVDB while the finale is still ahead
+		show.updated = datetime.now() - timedelta(20)
+		show.last_airdate = today
+		self.assertTrue(show.aired_since(today - timedelta(7)))
+
+		show.last_airdate = None
+		self.assertFalse(show.aired_since(today - timedelta(7)))
+
 	def testSubscriptionCascades(self):
 
 		show1 = DBSession.query(Show).get(1)
@@ -717,6 +914,26 @@ class TestNewUserSignup(WebisoderTest):
 		self.assertTrue(user.authenticate(password))
 		self.assertEqual(user.mail, "newuser1@example.org")
 
+	def testSignupRetry(self):
+
+		post = {"name": "newuser9", "email": "newuser9@example.org"}
+		request = testing.DummyRequest(post=post)
+		mailer = get_mailer(request)
+
+		RegistrationController(request).post()
+		transaction.abort()
+
+		# The retry runs on a new request for the same environment
+		request = testing.DummyRequest(post=post, environ=request.environ)
+		RegistrationController(request).post()
+		transaction.commit()
+
+		self.assertEqual(1, len(mailer.outbox))
+		password = re.findall("[a-zA-Z0-9]{12}", mailer.outbox[0].body)[0]
+
+		user = DBSession.query(User).get("newuser9")
+		self.assertTrue(user.authenticate(password))
+
 	def testInvalidSignupForm(self):
 
 		# No e-mail address
@@ -989,6 +1206,24 @@ class TestRecoverPassword(WebisoderTest):
 		MockUser.resetAuthentication()
 		testing.tearDown()
 
+	def testRequestPasswordRetry(self):
+
+		post = {"email": "user@example.com"}
+		request = testing.DummyRequest(post=post)
+		mailer = get_mailer(request)
+
+		PasswordRecoveryController(request).post()
+		transaction.abort()
+
+		request = testing.DummyRequest(post=post, environ=request.environ)
+		PasswordRecoveryController(request).post()
+		transaction.commit()
+
+		self.assertEqual(1, len(mailer.outbox))
+
+		user = DBSession.query(User).get("testuser467")
+		self.assertIn(user.recover_key, mailer.outbox[0].body)
+
 	def testRequestPasswordWithoutEmailAddress(self):
 
 		request = testing.DummyRequest(post={ })
@@ -1629,9 +1864,11 @@ class TestShowsView(WebisoderTest):
 		request = testing.DummyRequest()
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		res = ctl.get()
 
-		result_shows = [x.id for x in res["subscribed"]]
+		with self.assertQueries(2):
+			res = ctl.get()
+			result_shows = [x.id for x in res["subscribed"]]
+
 		self.assertIn(1, result_shows)
 		self.assertIn(2, result_shows)
 		self.assertIn(3, result_shows)
@@ -1645,7 +1882,7 @@ class TestShowsView(WebisoderTest):
 		request = testing.DummyRequest({"url": "1265"})
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
 		res = ctl.subscribe()
 		shows = [x.id for x in user.shows]
 		self.assertIn(4, shows)
@@ -1657,26 +1894,39 @@ class TestShowsView(WebisoderTest):
 		self.assertEqual(1, len(msg))
 		self.assertEqual('Subscribed to "show4"', msg[0])
 
+	def testSubscribeShowUpToDate(self):
+
+		show = DBSession.query(Show).get(4)
+		show.updated = datetime.now()
+
+		request = testing.DummyRequest({"url": "1265"})
+		request.session["auth.userid"] = "testuser1"
+		ctl = ShowsController(request)
+		ctl.queue = MockQueue()
+		ctl.subscribe()
+
+		self.assertEqual([], ctl.queue.jobs)
+
 	def testSubscribeShowWithWrongArguments(self):
 
 		request = testing.DummyRequest()
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
 		with self.assertRaises(ValidationFailure):
 			ctl.subscribe()
 
 		request = testing.DummyRequest(post={"url": ""})
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
 		with self.assertRaises(ValidationFailure):
 			ctl.subscribe()
 
 		request = testing.DummyRequest(post={"url": "a"})
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
 		with self.assertRaises(tvdb_shownotfound) as ctx:
 			ctl.subscribe()
 
@@ -1702,24 +1952,62 @@ class TestShowsView(WebisoderTest):
 		user = DBSession.query(User).get("testuser1")
 		shows = [x.id for x in user.shows]
 		self.assertNotIn(1359, shows)
-		request = testing.DummyRequest({"url": "1359"})
+		request = testing.DummyRequest({"url": "1359", "name": "Show"})
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
 		res = ctl.subscribe()
 		shows = [x.url for x in user.shows]
 		self.assertIn("1359", shows)
 
 		query = DBSession.query(Show).filter_by(url="1359")
 		show = query.one()
-		self.assertEqual("Show 1359", show.name)
+		self.assertEqual("Show", show.name)
+		self.assertTrue(show.pending)
 
 		self.assertTrue(hasattr(res, "location"))
 		self.assertTrue(res.location.endswith("__SHOWS__"))
 
 		msg = request.session.pop_flash("info")
 		self.assertEqual(1, len(msg))
-		self.assertEqual('Subscribed to "Show 1359"', msg[0])
+		self.assertEqual('Subscribed to "Show"', msg[0])
+
+		self.assertEqual([(import_show, (show.id,))], ctl.queue.jobs)
+		import_show(show.id, MockTVDB)
+
+		show = query.one()
+		self.assertEqual("Show 1359", show.name)
+		self.assertFalse(show.pending)
+		self.assertIn(show, user.shows)
+
+		self.assertEqual(Show.RUNNING, show.status)
+		self.assertEqual(date.today(), show.next_airdate)
+		self.assertLessEqual(show.next_airdate, show.last_airdate)
+		self.assertIsNotNone(show.updated)
+
+		episodes = sorted(show.episodes, key=lambda e: (e.season, e.num))
+		self.assertEqual(4, len(episodes))
+		self.assertEqual("Pilot", episodes[0].title)
+		self.assertEqual(date(2010, 1, 1), episodes[0].airdate)
+		self.assertEqual(1, episodes[0].totalnum)
+		self.assertEqual("101", episodes[0].prodnum)
+		self.assertEqual(None, episodes[2].airdate)
+		self.assertEqual((2, 1), (episodes[3].season, episodes[3].num))
+		self.assertEqual("Second", show.next_episode.title)
+
+	def testSubscribeAndImportShowWithoutName(self):
+
+		request = testing.DummyRequest({"url": "1359"})
+		request.session["auth.userid"] = "testuser1"
+		ctl = ShowsController(request)
+		ctl.queue = MockQueue()
+		ctl.subscribe()
+
+		show = DBSession.query(Show).filter_by(url="1359").one()
+		self.assertEqual("1359", show.name)
+
+		msg = request.session.pop_flash("info")
+		self.assertEqual('Subscribed to "1359"', msg[0])
 
 	def testSubscribeAndImportShowThatDoesNotExist(self):
 
@@ -1729,12 +2017,133 @@ class TestShowsView(WebisoderTest):
 		request = testing.DummyRequest({"url": "1360"})
 		request.session["auth.userid"] = "testuser1"
 		ctl = ShowsController(request)
-		ctl.backend = MockTVDB
+		ctl.queue = MockQueue()
+		ctl.subscribe()
+
+		show = DBSession.query(Show).filter_by(url="1360").one()
+		import_show(show.id, MockTVDB)
+		DBSession.expire_all()
 
-		with self.assertRaises(tvdb_shownotfound):
-			ctl.subscribe()
 		shows = [x.url for x in user.shows]
 		self.assertNotIn("1360", shows)
+		query = DBSession.query(Show).filter_by(url="1360")
+		self.assertEqual(0, query.count())
+
+	def testSubscribeAndImportShowFails(self):
+
+		class BrokenTVDB(MockTVDB):
+
+			def getByURL(self, url, site=True):
+
+				raise UpstreamTimeout("TVDB show timed out")
+
+		retries = []
+		retry = import_queue.retry
+		import_queue.retry = lambda attempt, *args: retries.append(
+						(attempt,) + args) or attempt < 3
+
+		try:
+			request = testing.DummyRequest({"url": "1359"})
+			request.session["auth.userid"] = "testuser1"
+			ctl = ShowsController(request)
+			ctl.queue = MockQueue()
+			ctl.subscribe()
+
+			show = DBSession.query(Show).filter_by(url="1359").one()
+			show_id = show.id
+			import_show(show_id, BrokenTVDB)
+
+			show = DBSession.query(Show).get(show_id)
+			self.assertTrue(show.pending)
+			self.assertFalse(show.failed)
+			self.assertEqual([(1, import_show, show_id, BrokenTVDB,
+								1)], retries)
+
+			import_show(show_id, BrokenTVDB, 2)
+			show = DBSession.query(Show).get(show_id)
+			self.assertTrue(show.pending)
+			self.assertTrue(show.failed)
+			self.assertEqual(3, retries[-1][0])
+		finally:
+			import_queue.retry = retry
+
+		self.assertIn((show_id, "1359"), scheduled_shows())
+
+		import_show(show_id, MockTVDB)
+		show = DBSession.query(Show).get(show_id)
+		self.assertFalse(show.pending)
+		self.assertFalse(show.failed)
+
+	def testRefreshShow(self):
+
+		show = DBSession.query(Show).get(4)
+		show.url = "1359"
+		transaction.commit()
+
+		refresh_show(4, "1359", MockTVDB())
+
+		show = DBSession.query(Show).get(4)
+		self.assertEqual("Show 1359", show.name)
+		self.assertEqual(4, len(show.episodes))
+		self.assertFalse(show.pending)
+
+	def testRefreshSkipsEndedShows(self):
+
+		today = date.today()
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			show.status = Show.ENDED
+			show.updated = datetime.now()
+			show.last_airdate = today - timedelta(1)
+			DBSession.query(Show).get(3).enabled = False
+
+		with transaction.manager:
+			shows = scheduled_shows()
+
+		self.assertEqual([1, 4], sorted(id for id, url in shows))
+
+		# The finale is still ahead
+		with transaction.manager:
+			DBSession.query(Show).get(2).last_airdate = today
+
+		with transaction.manager:
+			shows = scheduled_shows()
+
+		self.assertEqual([1, 2, 4], sorted(id for id, url in shows))
+
+		# Checked again now and then in case it is renewed
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			show.last_airdate = today - timedelta(1)
+			show.updated = datetime.now() - timedelta(31)
+
+		with transaction.manager:
+			self.assertEqual([1, 2, 4], sorted(id for id, url in
+							scheduled_shows()))
+			self.assertEqual([1, 4], sorted(id for id, url in
+							scheduled_shows(60)))
+
+	def testFeedSkipsEndedShows(self):
+
+		request = testing.DummyRequest()
+		request.matchdict["user"] = "testuser1"
+		request.matchdict["token"] = "mytoken"
+		ctl = EpisodesController(request)
+
+		with transaction.manager:
+			user = DBSession.query(User).get("testuser1")
+			user.days_back = 7
+
+		self.assertEqual(5, len(ctl.feed()["episodes"]))
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(1)
+			show.status = Show.ENDED
+			show.updated = datetime.now() - timedelta(10)
+
+		titles = [e.title for e in ctl.feed()["episodes"]]
+		self.assertEqual(["ep1", "ep2"], titles)
 
 	def testUnsubscribeShow(self):
 
@@ -1875,6 +2284,91 @@ class TestShowsView(WebisoderTest):
 		self.assertEqual("Failed to reach TheTVDB, search results will "
 						"be incomplete.", msg[0])
 
+	def testSuggest(self):
+
+		request = testing.DummyRequest(params={"q": "Sho"})
+		request.session["auth.userid"] = "testuser1"
+		ctl = SearchController(request)
+		ctl.index = PrefixIndex()
+		res = ctl.suggest()
+
+		names = [x.get("name") for x in res]
+		self.assertEqual(["show1", "show2", "show3", "show4"], names)
+		self.assertEqual("1265", res[3].get("url"))
+
+		request = testing.DummyRequest(params={"q": "show3"})
+		ctl = SearchController(request)
+		ctl.index = PrefixIndex()
+		res = ctl.suggest()
+		self.assertEqual(1, len(res))
+
+		request = testing.DummyRequest(params={"q": "x"})
+		ctl = SearchController(request)
+		ctl.index = PrefixIndex()
+		self.assertEqual([], ctl.suggest())
+
+	def testSuggestSkipsPendingShows(self):
+
+		with transaction.manager:
+			DBSession.add(Show(id=7, url="7", name="Shouted name",
+								pending=True))
+
+		index = PrefixIndex()
+		index.refresh()
+		self.assertEqual([], index.lookup("shouted"))
+		self.assertEqual(7, index.last_id)
+		self.assertEqual(set([7]), index.pending)
+
+		with transaction.manager:
+			DBSession.add(Show(id=8, url="8", name="Show 8"))
+
+		index.refresh(force=True)
+		self.assertEqual([{"url": "8", "name": "Show 8"}],
+						index.lookup("show 8"))
+		self.assertEqual(8, index.last_id)
+		self.assertEqual(set([7]), index.pending)
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(7)
+			show.name = "Show 7"
+			show.pending = False
+
+		index.refresh(force=True)
+		self.assertEqual([{"url": "7", "name": "Show 7"}],
+						index.lookup("show 7"))
+		self.assertEqual(8, index.last_id)
+		self.assertEqual(set(), index.pending)
+
+	def testSuggestRenamedAndRemovedShows(self):
+
+		index = PrefixIndex()
+		index.refresh()
+		self.assertEqual(1, len(index.lookup("show1")))
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(1)
+			show.name = "Renamed"
+			show.updated = datetime.now()
+			DBSession.delete(DBSession.query(Show).get(2))
+
+		index.refresh(force=True)
+		self.assertEqual([], index.lookup("show1"))
+		self.assertEqual([], index.lookup("show2"))
+		self.assertEqual(1, len(index.lookup("renamed")))
+		self.assertNotIn(2, index.shows)
+
+	def testSearchFeedsSuggestions(self):
+
+		request = testing.DummyRequest(post={"search": "Seinfeld"})
+		request.session["auth.userid"] = "testuser1"
+		ctl = SearchController(request)
+		ctl.backend = MockTVDB
+		ctl.index = PrefixIndex()
+		ctl.post()
+
+		res = ctl.index.lookup("sein")
+		self.assertEqual([{"url": "79169", "name": "Seinfeld"}], res)
+
 	def testSearchRating(self):
 
 		self.assertEqual(1, ResultRating("seinfeld", "seinfeld"))
@@ -1885,6 +2379,36 @@ class TestShowsView(WebisoderTest):
 		self.assertEqual(.4, ResultRating("seinfeld", "X Seinfelds X"))
 		self.assertEqual(0, ResultRating("seinfeld", "The Simpsons"))
 
+	def testRankSameAsResultRating(self):
+
+		names = ["seinfeld", "Seinfeld", "The Seinfeld", "Seinfeld 2000",
+			"X Seinfeld X", "X Seinfelds X", "The Simpsons",
+			"X  Seinfeld", "Seinfeld  X", "seinfeld seinfeld"]
+
+		for search in ["seinfeld", "Seinfeld", "x seinfeld", "ld"]:
+
+			result = [{"seriesname": name} for name in names]
+			rank(search, result)
+
+			for row in result:
+				self.assertEqual(ResultRating(search,
+					row["seriesname"]), row["rating"])
+
+	def testRankOrderAndLimit(self):
+
+		result = [{"seriesname": name, "id": id} for id, name in
+			enumerate(["The Simpsons", "X Seinfelds X", "Seinfeld",
+			"X Seinfeld X", "The Seinfeld", "Seinfeld 2000"])]
+
+		res = rank("seinfeld", result)
+		self.assertEqual([2, 4, 5, 3, 1, 0], [x["id"] for x in res])
+
+		res = rank("seinfeld", result, limit=3)
+		self.assertEqual([2, 4, 5], [x["id"] for x in res])
+
+		res = rank("seinfeld", result, limit=10)
+		self.assertEqual(6, len(res))
+
 	def testEpisodes(self):
 
 		request = testing.DummyRequest()
@@ -2079,7 +2603,9 @@ class TestProfileView(WebisoderTest):
 		request = testing.DummyRequest()
 		request.session["auth.userid"] = "testuser12"
 		ctl = ProfileController(request)
-		res = ctl.get()
+
+		with self.assertQueries(1):
+			res = ctl.get()
 
 		self.assertIn("user", res)
 		user = res.get("user")
@@ -2979,3 +3505,2547 @@ class TestBanners(WebisoderTest):
 
 		self.assertEqual("__BANNER__", res.body)
 		self.assertEqual("image/jpeg", res.content_type)
+
+	def testBannerTVDBFailure(self):
+
+		request = testing.DummyRequest()
+		request.exception = UpstreamUnavailable()
+
+		ctl = BannerController(request)
+		res = ctl.tvdb_failure()
+		self.assertEqual(503, res.code)
+
+
+class TestSearchCache(unittest.TestCase):
+
+	def setUp(self):
+
+		cache_regions.update({"test_search": {
+			"type": "memory",
+			"expire": 60,
+			"enabled": True
+		}})
+
+		self.cache = SearchCache("test_search")
+		self.cache.cache().clear()
+
+	def tearDown(self):
+
+		del(cache_regions["test_search"])
+
+	def testNormalizeQuery(self):
+
+		self.assertEqual("doctor who", normalize_query("Doctor Who"))
+		self.assertEqual("doctor who", normalize_query("  doctor   who "))
+		self.assertEqual("doctor who", normalize_query("Doctor Who?!"))
+		self.assertEqual("marvels agents of shield",
+			normalize_query("Marvel's Agents of S.H.I.E.L.D."))
+
+	def testResultsAreRanked(self):
+
+		backend = MockTVDB()
+		backend.shows[2]["seriesname"] = "the doctor who"
+		backend.shows[3]["seriesname"] = "a doctor who special"
+
+		res = self.cache.search("doctor who", backend)
+		ratings = [row.get("rating") for row in res]
+
+		self.assertEqual(sorted(ratings, reverse=True), ratings)
+		self.assertEqual(1, ratings[0])
+		self.assertEqual(.4, ratings[-1])
+
+	def testCacheByNormalizedQuery(self):
+
+		backend = MockTVDB()
+		calls = []
+
+		def search(text):
+
+			calls.append(text)
+			return MockTVDB.search(backend, text)
+
+		backend.search = search
+
+		res1 = self.cache.search("big bang theory", backend)
+		res2 = self.cache.search("Big Bang  Theory!", backend)
+
+		self.assertEqual(1, len(calls))
+		self.assertEqual(res1, res2)
+		self.assertEqual(80379, res2[0].get("id"))
+
+	def testRankedByNormalizedQuery(self):
+
+		backend = MockTVDB()
+		backend.search = lambda text: [{"seriesname": "Lost Girl"},
+			{"seriesname": "Lost"}, {"seriesname": "Lost & Found"}]
+
+		res = self.cache.search("Lost.", backend)
+		self.assertEqual("Lost", res[0]["seriesname"])
+		self.assertEqual(1, res[0]["rating"])
+
+		self.cache.cache().clear()
+		self.assertEqual(res, self.cache.search("lost", backend))
+
+	def testFailuresAreNotCached(self):
+
+		backend = MockTVDB()
+
+		with self.assertRaises(tvdb_shownotfound):
+			self.cache.search("babylon 5", backend)
+
+		backend.shows[511] = { "seriesname": "babylon 5" }
+		res = self.cache.search("babylon 5", backend)
+		self.assertEqual(1, len(res))
+
+	def testWithoutCacheRegion(self):
+
+		self.cache.region = "not configured"
+		backend = MockTVDB()
+
+		res = self.cache.search("big bang theory", backend)
+		self.assertEqual(1, len(res))
+
+	def testCoalesceSearches(self):
+
+		release = Event()
+		calls = []
+		results = []
+
+		class SlowTVDB(MockTVDB):
+
+			def search(self, text):
+
+				calls.append(text)
+				release.wait()
+				return MockTVDB.search(self, text)
+
+		def search():
+
+			results.append(self.cache.search("doctor who", backend))
+
+		backend = SlowTVDB()
+		threads = [Thread(target=search) for _ in range(5)]
+
+		for thread in threads:
+			thread.start()
+
+		while not self.cache.pending:
+			release.wait(.01)
+
+		release.set()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(1, len(calls))
+		self.assertEqual(5, len(results))
+
+
+class TestPrefixIndex(unittest.TestCase):
+
+	def testLookup(self):
+
+		index = PrefixIndex()
+		index.add_many([
+			(1, "Doctor Who"),
+			(2, "Doctor Who (2005)"),
+			(3, "The Doctors"),
+			(4, "Seinfeld")
+		])
+
+		res = [x.get("url") for x in index.lookup("doctor who")]
+		self.assertEqual(["1", "2"], res)
+
+		res = [x.get("url") for x in index.lookup("Doctor")]
+		self.assertEqual(["1", "2", "3"], res)
+
+		res = [x.get("url") for x in index.lookup("doc", limit=2)]
+		self.assertEqual(["1", "2"], res)
+
+		res = [x.get("url") for x in index.lookup("who")]
+		self.assertEqual(["1", "2"], res)
+
+		self.assertEqual([], index.lookup(""))
+		self.assertEqual([], index.lookup("simpsons"))
+
+	def testRename(self):
+
+		index = PrefixIndex()
+		index.add(1, "Show 1")
+		index.add(1, "Renamed")
+		index.add(1, "Renamed")
+
+		self.assertEqual([], index.lookup("show"))
+		self.assertEqual([{"url": "1", "name": "Renamed"}],
+						index.lookup("ren"))
+		self.assertEqual(1, len(index.entries))
+
+	def testIgnoreIncomplete(self):
+
+		index = PrefixIndex()
+		index.add(None, "No URL")
+		index.add(1, None)
+
+		self.assertEqual([], index.entries)
+
+
+class TestJobQueue(unittest.TestCase):
+
+	def testRunJobs(self):
+
+		done = []
+
+		def job(value):
+
+			done.append(value)
+
+		def broken():
+
+			raise Exception("broken")
+
+		queue = JobQueue("test")
+		queue.start(2)
+		queue.put(job, 1)
+		queue.put(broken)
+		queue.put(job, 2)
+		queue.join()
+
+		self.assertEqual([1, 2], sorted(done))
+		self.assertEqual(2, len(queue.workers))
+
+	def testQueueFull(self):
+
+		queue = JobQueue("test", maxsize=1)
+		queue.put(len, "a")
+		queue.put(len, "b")
+
+		self.assertEqual(1, queue.queue.qsize())
+
+	def testDeferUntilCommit(self):
+
+		queue = JobQueue("test")
+
+		transaction.begin()
+		queue.defer(len, "a")
+		transaction.abort()
+		self.assertEqual(0, queue.queue.qsize())
+
+		transaction.begin()
+		queue.defer(len, "a")
+		transaction.commit()
+		self.assertEqual(1, queue.queue.qsize())
+
+	def testRetry(self):
+
+		done = Event()
+		queue = JobQueue("test", retries=2, retry_delay=0.01)
+		queue.start(1)
+
+		self.assertTrue(queue.retry(1, done.set))
+		self.assertTrue(done.wait(5))
+		self.assertTrue(queue.retry(2, len, "a"))
+		self.assertFalse(queue.retry(3, len, "a"))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+	def setUp(self):
+
+		self.now = 1000
+		self.breaker = CircuitBreaker(window=4, min_calls=2,
+				error_rate=.5, slow_call=10, reset_timeout=30)
+		self.breaker.clock = lambda: self.now
+
+	def fail(self):
+
+		raise IOError("upstream failure")
+
+	def slow(self):
+
+		self.now += 11
+		return "slow"
+
+	def testTripOnErrors(self):
+
+		self.assertEqual("ok", self.breaker.call(lambda: "ok"))
+
+		with self.assertRaises(IOError):
+			self.breaker.call(self.fail)
+
+		self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+		calls = []
+		with self.assertRaises(UpstreamUnavailable):
+			self.breaker.call(lambda: calls.append(1))
+
+		self.assertEqual([], calls)
+
+	def testTripOnLatency(self):
+
+		self.assertEqual("slow", self.breaker.call(self.slow))
+		self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+		self.assertEqual("slow", self.breaker.call(self.slow))
+		self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+	def testBusyIsNoFailure(self):
+
+		def busy():
+
+			raise UpstreamBusy()
+
+		for i in range(4):
+			with self.assertRaises(UpstreamBusy):
+				self.breaker.call(busy)
+
+		self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+	def testNotFoundIsNoFailure(self):
+
+		def not_found():
+
+			raise tvdb_shownotfound()
+
+		for i in range(4):
+			with self.assertRaises(tvdb_shownotfound):
+				self.breaker.call(not_found)
+
+		self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+	def testHalfOpen(self):
+
+		for i in range(2):
+			with self.assertRaises(IOError):
+				self.breaker.call(self.fail)
+
+		self.now += 31
+
+		# Only a single probe is let through
+		self.assertTrue(self.breaker.allow())
+		self.assertFalse(self.breaker.allow())
+		self.breaker.record(False, 0)
+		self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+		with self.assertRaises(UpstreamUnavailable):
+			self.breaker.call(lambda: "ok")
+
+		self.now += 31
+		self.assertEqual("ok", self.breaker.call(lambda: "ok"))
+		self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+		self.assertEqual("ok", self.breaker.call(lambda: "ok"))
+
+	def testConfigure(self):
+
+		self.breaker.configure({
+			"tvdb.window": "50",
+			"tvdb.error_rate": "0.25",
+			"tvdb.reset_timeout": "5"
+		}, "tvdb.")
+
+		self.assertEqual(50, self.breaker.calls.maxlen)
+		self.assertEqual(.25, self.breaker.error_rate)
+		self.assertEqual(5, self.breaker.reset_timeout)
+		self.assertEqual(10, self.breaker.slow_call)
+
+
+class TestUpstreamPool(unittest.TestCase):
+
+	def setUp(self):
+
+		self.release = Event()
+		self.started = Event()
+		self.pool = UpstreamPool(workers=1, max_queue=1, timeout=5)
+
+	def tearDown(self):
+
+		self.release.set()
+
+	def block(self):
+
+		self.started.set()
+		self.release.wait()
+		return "done"
+
+	def testCall(self):
+
+		self.assertEqual(3, self.pool.call("add", lambda a, b: a + b, 1, 2))
+
+		with self.assertRaises(IOError):
+			self.pool.call("fail", self.fail)
+
+	def fail(self):
+
+		raise IOError("failure")
+
+	def testSocketTimeout(self):
+
+		# Accepts connections but never answers
+		server = socket.socket()
+		server.bind(("127.0.0.1", 0))
+		server.listen(1)
+		url = "http://127.0.0.1:%d/" % server.getsockname()[1]
+
+		try:
+			tv = TVDBWrapper().tvdb(cache=False, timeout=0.1)
+			start = time()
+
+			with self.assertRaises((URLError, socket.timeout)):
+				tv.urlopener.open(url).read()
+
+			self.assertLess(time() - start, 5)
+		finally:
+			server.close()
+
+	def testDeadline(self):
+
+		self.pool.timeouts["block"] = .05
+
+		with self.assertRaises(UpstreamTimeout):
+			self.pool.call("block", self.block)
+
+		# The worker is still busy with the first call
+		with self.assertRaises(UpstreamTimeout):
+			self.pool.call("block", self.block)
+
+	def testQueueFull(self):
+
+		self.pool.timeouts["block"] = .05
+		self.pool.start()
+
+		# Occupy the worker, then fill the queue
+		worker = Thread(target=self.pool.call, args=("x", self.block))
+		worker.start()
+		self.started.wait()
+
+		self.pool.queue.put_nowait(None)
+
+		with self.assertRaises(UpstreamBusy):
+			self.pool.call("block", self.block)
+
+		self.pool.queue.get_nowait()
+		self.release.set()
+		worker.join()
+
+	def testConfigure(self):
+
+		self.pool.configure({
+			"tvdb.workers": "2",
+			"tvdb.max_queue": "3",
+			"tvdb.timeout": "7",
+			"tvdb.timeout.search": "2"
+		}, "tvdb.")
+
+		self.assertEqual(2, self.pool.workers)
+		self.assertEqual(3, self.pool.queue.maxsize)
+		self.assertEqual(2, self.pool.deadline("search"))
+		self.assertEqual(7, self.pool.deadline("show"))
+
+
+class TestAIMDLimiter(unittest.TestCase):
+
+	def setUp(self):
+
+		self.now = 100
+		self.limiter = AIMDLimiter(initial=4, minimum=1, maximum=6,
+								latency=2)
+		self.limiter.clock = lambda: self.now
+
+	def testIncrease(self):
+
+		for i in range(5):
+			start = self.limiter.acquire()
+			self.now += 1
+			self.limiter.release(start, True)
+
+		self.assertEqual(5, int(self.limiter.limit))
+
+		for i in range(20):
+			start = self.limiter.acquire()
+			self.limiter.release(start, True)
+
+		self.assertEqual(6, self.limiter.limit)
+		self.assertEqual(25, self.limiter.completed)
+		self.assertEqual(5, self.limiter.rate())
+
+	def testDecreaseOncePerRound(self):
+
+		starts = [self.limiter.acquire() for i in range(4)]
+		self.assertEqual(4, self.limiter.active)
+		self.now += 3
+
+		# All four calls were slow, but they count as a single event
+		for start in starts:
+			self.limiter.release(start, True)
+
+		self.assertEqual(2, self.limiter.limit)
+
+		start = self.limiter.acquire()
+		self.limiter.release(start, False)
+		self.assertEqual(1, self.limiter.limit)
+		self.assertEqual(1, self.limiter.errors)
+
+		start = self.limiter.acquire()
+		self.limiter.release(start, False)
+		self.assertEqual(1, self.limiter.limit)
+
+	def testBlockAtLimit(self):
+
+		self.limiter.limit = 1
+		start = self.limiter.acquire()
+		acquired = []
+
+		def acquire():
+
+			acquired.append(self.limiter.acquire())
+
+		thread = Thread(target=acquire)
+		thread.start()
+		thread.join(.05)
+		self.assertEqual([], acquired)
+
+		self.limiter.release(start, True)
+		thread.join()
+		self.assertEqual(1, len(acquired))
+
+
+class TestRefresh(unittest.TestCase):
+
+	def setUp(self):
+
+		# The refresh workers each need a connection to the same database
+		self.tmp = tempfile.mkdtemp()
+		self.engine = create_engine("sqlite:///%s" % os.path.join(
+							self.tmp, "refresh.sqlite"))
+		Base.metadata.create_all(self.engine)
+		DBSession.remove()
+		DBSession.configure(bind=self.engine)
+
+		with transaction.manager:
+			for id in range(101, 111):
+				DBSession.add(Show(id=id, name="old", url="%d" % id))
+
+	def tearDown(self):
+
+		DBSession.remove()
+		DBSession.configure(bind=Database._engine)
+		breaker.reset()
+		self.engine.dispose()
+		shutil.rmtree(self.tmp)
+
+	def testIgnoreBreaker(self):
+
+		fetched = []
+
+		def fetch(id):
+
+			fetched.append(id)
+
+			# Tripped by the site while the refresh is running
+			if len(fetched) == 3:
+				breaker.trip()
+
+			return {"seriesname": "show %d" % id}
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchShow = fetch
+		limiter = AIMDLimiter(initial=2, maximum=2)
+
+		with transaction.manager:
+			shows = scheduled_shows()
+
+		Refresh(shows, limiter, lambda: tvdb).run()
+
+		self.assertEqual(range(101, 111), sorted(fetched))
+		self.assertEqual(10, limiter.completed)
+		self.assertEqual(0, limiter.errors)
+
+		with transaction.manager:
+			names = [name for name, in DBSession.query(Show.name)]
+
+		self.assertEqual(["show %d" % id for id in range(101, 111)],
+								sorted(names))
+
+
+class TestStaleFallback(unittest.TestCase):
+
+	def setUp(self):
+
+		cache_regions.update({"test_stale": {
+			"type": "memory",
+			"expire": 60,
+			"enabled": True
+		}})
+
+		self.region = stale_cache.region
+		stale_cache.region = "test_stale"
+		breaker.reset()
+
+	def tearDown(self):
+
+		stale_cache.region = self.region
+		del(cache_regions["test_stale"])
+		breaker.reset()
+
+	def testServeStale(self):
+
+		def broken(text):
+
+			raise IOError("upstream failure")
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchSearch = lambda text: [{"seriesname": text}]
+		self.assertEqual([{"seriesname": "stale"}], tvdb.search("stale"))
+
+		tvdb.fetchSearch = broken
+		self.assertEqual([{"seriesname": "stale"}], tvdb.search("stale"))
+
+		with self.assertRaises(IOError):
+			tvdb.search("never seen")
+
+		breaker.trip()
+
+		self.assertEqual([{"seriesname": "stale"}], tvdb.search("stale"))
+
+		with self.assertRaises(UpstreamUnavailable):
+			tvdb.search("never seen")
+
+	def testStaleSearchIsNormalized(self):
+
+		def broken(text):
+
+			raise IOError("upstream failure")
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchSearch = lambda text: [{"seriesname": "Stale"}]
+		tvdb.search("The  Stale")
+
+		tvdb.fetchSearch = broken
+		self.assertEqual([{"seriesname": "Stale"}], tvdb.search("the stale"))
+
+	def testStaleShowData(self):
+
+		show = TVDBShow()
+		show.data = {"seriesname": "Show 1", "status": "Ended",
+							"overview": "Long"}
+		season = show[1] = Season(show=show)
+		episode = season[1] = TVDBEpisode(season=season)
+		episode.update({"seasonnumber": "1", "episodenumber": "1",
+			"episodename": "Pilot", "firstaired": "2010-01-01",
+			"overview": "Long"})
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchShow = lambda id: show
+		data = tvdb.getByURL("1")
+
+		self.assertIs(dict, type(data))
+		self.assertEqual("Show 1", data["seriesname"])
+		self.assertEqual(Show.ENDED, parse_status(data))
+		self.assertNotIn("overview", data)
+		self.assertIs(dict, type(data[1][1]))
+		self.assertEqual([{"show_id": 1, "season": 1, "num": 1,
+			"airdate": date(2010, 1, 1), "title": "Pilot",
+			"totalnum": None, "prodnum": None}],
+			episodes_from(1, data))
+		self.assertEqual(data, stale_cache.get("show:1"))
+		self.assertEqual({"seriesname": "Show 2"},
+				show_data({"seriesname": "Show 2"}))
+
+	def testNotFoundIsNotStale(self):
+
+		def not_found(id):
+
+			raise tvdb_shownotfound()
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchShow = lambda id: {"seriesname": "show %d" % id}
+		self.assertEqual("show 12", tvdb.getByURL("12")["seriesname"])
+
+		tvdb.fetchShow = not_found
+
+		with self.assertRaises(tvdb_shownotfound):
+			tvdb.getByURL("12")
+
+	def testRefreshBypassesStale(self):
+
+		def broken(id):
+
+			raise IOError("upstream failure")
+
+		tvdb = TVDBWrapper()
+		tvdb.fetchShow = lambda id: {"seriesname": "show %d" % id}
+		self.assertEqual("show 12", tvdb.getByURL("12")["seriesname"])
+
+		# Neither served nor stored for the refresh
+		tvdb.fetchShow = broken
+
+		with self.assertRaises(IOError):
+			tvdb.getByURL("12", site=False)
+
+		with self.assertRaises(IOError):
+			refresh_show(12, "12", tvdb)
+
+		tvdb.fetchShow = lambda id: {"seriesname": "new %d" % id}
+		self.assertEqual("new 13", tvdb.getByURL("13", site=False)[
+								"seriesname"])
+		tvdb.fetchShow = broken
+
+		with self.assertRaises(IOError):
+			tvdb.getByURL("13")
+
+		self.assertEqual("show 12", tvdb.getByURL("12")["seriesname"])
+
+
+class TestFakeTVDB(unittest.TestCase):
+
+	def setUp(self):
+
+		self.catalog = Catalog(shows=50, seed=1)
+		self.faults = Faults()
+		self.server = FakeTVDBServer(("127.0.0.1", 0), self.catalog,
+								self.faults)
+
+		thread = Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		self.tvdb = TVDBWrapper()
+		self.tvdb.base_url = self.server.base_url()
+		breaker.reset()
+
+	def tearDown(self):
+
+		self.server.shutdown()
+		self.server.server_close()
+		breaker.reset()
+
+	def testCatalog(self):
+
+		other = Catalog(shows=50, seed=1)
+		self.assertEqual(self.catalog.names, other.names)
+		self.assertEqual(self.catalog.episodes(70010),
+						other.episodes(70010))
+		self.assertEqual(None, self.catalog.show(1))
+
+	def testSearch(self):
+
+		name = self.catalog.names[70020]
+		res = self.tvdb.search(name)
+
+		self.assertEqual(1, len(res))
+		self.assertEqual(name, res[0]["seriesname"])
+		self.assertEqual("70020", res[0]["seriesid"])
+
+	def testShow(self):
+
+		data = self.tvdb.getByURL("70030")
+		episodes = episodes_from(70030, data)
+		expected = self.catalog.episodes(70030)
+		status = self.catalog.show(70030)["Status"]
+
+		self.assertEqual(self.catalog.names[70030], data["seriesname"])
+		self.assertEqual(status == "Ended", parse_status(data) == 3)
+		self.assertEqual(len(expected), len(episodes))
+		self.assertEqual(expected[0]["EpisodeName"], episodes[0]["title"])
+
+		with self.assertRaises(tvdb_error):
+			self.tvdb.getByURL("12")
+
+	def testBanner(self):
+
+		path = self.tvdb.findBanner(70040)
+		self.assertTrue(path.startswith(self.server.base_url()))
+		self.assertTrue(len(self.tvdb.fetchURL(path)) > 0)
+
+	def testErrors(self):
+
+		self.faults.error_rate = 1
+
+		with self.assertRaises(tvdb_error):
+			self.tvdb.search("something")
+
+	def testThrottling(self):
+
+		# No time passes between the calls
+		self.faults.clock = lambda: 100.0
+		self.faults.last = 100.0
+		self.faults.rate_limit = 1
+		self.faults.tokens = 1
+
+		self.tvdb.fetchSearch("something")
+
+		with self.assertRaises(tvdb_error):
+			self.tvdb.fetchSearch("something else")
+
+	def testTokenBucket(self):
+
+		now = [100.0]
+		faults = Faults(rate_limit=2, clock=lambda: now[0])
+
+		self.assertFalse(faults.throttled())
+		self.assertFalse(faults.throttled())
+		self.assertTrue(faults.throttled())
+
+		now[0] += .5
+		self.assertFalse(faults.throttled())
+		self.assertTrue(faults.throttled())
+
+
+class TestSnapshot(unittest.TestCase):
+
+	def setUp(self):
+
+		self.source = create_engine("sqlite://")
+		self.target = create_engine("sqlite://")
+		Base.metadata.create_all(self.source)
+		Base.metadata.create_all(self.target)
+
+		shows = Show.__table__
+		episodes = Episode.__table__
+
+		self.source.execute(shows.insert(), [
+			{"show_id": 1, "url": "1", "show_name": u"Show \u00e9",
+			"status": Show.RUNNING, "enabled": True,
+			"updated": datetime(2016, 1, 2, 3, 4, 5),
+			"next_airdate": date(2016, 2, 1)},
+			{"show_id": 2, "url": "2", "show_name": "Pending",
+			"status": None, "enabled": None, "updated": None,
+			"next_airdate": None}])
+		self.source.execute(episodes.insert(), [
+			{"show_id": 1, "season": 1, "num": n, "title": "Ep %d" % n,
+			"airdate": date(2016, 1, n), "totalnum": n,
+			"prodnum": None} for n in range(1, 26)])
+
+	def snapshot(self):
+
+		out = StringIO()
+		count = export_snapshot(self.source.connect(), out)
+		return count, out.getvalue().splitlines(True)
+
+	def testRoundTrip(self):
+
+		count, lines = self.snapshot()
+		self.assertEqual((2, 25), count)
+		self.assertEqual(28, len(lines))
+
+		with self.target.begin() as connection:
+			res = import_snapshot(connection, iter(lines), batch=10)
+
+		self.assertEqual((2, 25), res)
+
+		query = "SELECT * FROM shows ORDER BY show_id"
+		self.assertEqual(self.source.execute(query).fetchall(),
+					self.target.execute(query).fetchall())
+
+		query = "SELECT * FROM episodes ORDER BY show_id, season, num"
+		self.assertEqual(self.source.execute(query).fetchall(),
+					self.target.execute(query).fetchall())
+
+	def testSkipExistingShows(self):
+
+		count, lines = self.snapshot()
+		self.target.execute(Show.__table__.insert(),
+				{"show_id": 1, "url": "1", "show_name": "Local"})
+
+		with self.target.begin() as connection:
+			res = import_snapshot(connection, iter(lines))
+
+		self.assertEqual((1, 0), res)
+		name = self.target.execute("SELECT show_name FROM shows "
+						"WHERE show_id = 1").scalar()
+		self.assertEqual("Local", name)
+
+	def testInvalidSnapshot(self):
+
+		with self.assertRaises(ValueError):
+			import_snapshot(self.target.connect(), iter(['["other", 1]']))
+
+
+class TestUpgrade(unittest.TestCase):
+
+	def setUp(self):
+
+		# The shows table as created by the first release
+		self.engine = create_engine("sqlite://")
+		self.engine.execute("CREATE TABLE shows (show_id INTEGER NOT "
+			"NULL, show_name TEXT, url TEXT, updated DATETIME, "
+			"enabled BOOLEAN, status INTEGER, PRIMARY KEY (show_id), "
+			"UNIQUE (url))")
+		Episode.__table__.create(self.engine)
+
+		today = date.today()
+		self.engine.execute("INSERT INTO shows (show_id, url, show_name, "
+				"status) VALUES (?, ?, ?, ?)", [(1, "1", "show1",
+				Show.RUNNING), (2, "2", "show2", Show.RUNNING)])
+		self.engine.execute(Episode.__table__.insert(), [
+			{"show_id": 1, "season": 1, "num": num, "airdate":
+			today + timedelta(days)} for num, days in
+			[(1, -7), (2, 0), (3, 7)]])
+
+	def tearDown(self):
+
+		self.engine.dispose()
+
+	def testUpgrade(self):
+
+		with self.assertRaises(OperationalError):
+			self.engine.execute(select([Show.__table__]))
+
+		self.assertEqual(["shows.next_airdate", "shows.last_airdate",
+				"shows.pending", "shows.failed"], upgrade(self.engine))
+		self.assertEqual([], upgrade(self.engine))
+
+		today = date.today()
+		shows = Show.__table__
+		rows = self.engine.execute(select([shows.c.show_id,
+			shows.c.next_airdate, shows.c.last_airdate,
+			shows.c.pending]).order_by(shows.c.show_id)).fetchall()
+		self.assertEqual([(1, today, today + timedelta(7), False),
+					(2, None, None, False)], rows)
+
+		upcoming = UpcomingEpisode.__table__
+		self.assertEqual(3, self.engine.execute(select([func.count()
+					]).select_from(upcoming)).scalar())
+
+	def testNextDate(self):
+
+		today = date.today()
+		show = Show(status=Show.RUNNING, next_airdate=today)
+		self.assertEqual(today, show.next_date)
+
+		show.status = Show.ENDED
+		self.assertIsNone(show.next_date)
+
+		show = Show(status=Show.RUNNING, next_airdate=None)
+		self.assertIsNone(show.next_date)
+
+		# Passed since the last update
+		show = Show(status=Show.RUNNING, next_airdate=today - timedelta(1))
+		show.episodes = [Episode(season=1, num=n, airdate=today +
+				timedelta(n)) for n in (-1, 3, 2)]
+		self.assertEqual(today + timedelta(2), show.next_date)
+
+
+class TestAirdateIndex(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+		self.today = date.today()
+
+		with transaction.manager:
+
+			show1 = Show(id=1, name="show1", url="1")
+			show2 = Show(id=2, name="show2", url="2")
+
+			for num, days in enumerate([-10, -3, 0, 5]):
+				DBSession.add(Episode(show=show1, num=num, season=1,
+					airdate=self.today + timedelta(days)))
+
+			DBSession.add(Episode(show=show2, num=1, season=1,
+					airdate=self.today + timedelta(1)))
+			DBSession.add(Episode(show=show2, num=2, season=1))
+
+		self.index = AirdateIndex(days=7, interval=3600)
+
+		with transaction.manager:
+			self.index.build()
+
+	def tearDown(self):
+
+		with transaction.manager:
+
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+
+		DBSession.remove()
+
+	def keys(self, episodes):
+
+		return [(e.show.id, e.num) for e in episodes]
+
+	def testEpisodes(self):
+
+		then = self.today - timedelta(7)
+
+		res = self.index.episodes([1, 2, 3], then)
+		self.assertEqual([(1, 1), (1, 2), (2, 1), (1, 3)], self.keys(res))
+		self.assertEqual("show1", res[0].show.name)
+		self.assertEqual("show1 S01E01: None", str(res[0]))
+
+		res = self.index.episodes([1], self.today)
+		self.assertEqual([(1, 2), (1, 3)], self.keys(res))
+
+		self.assertEqual([], self.index.episodes([], self.today))
+		self.assertIsNone(self.index.episodes([1], then - timedelta(1)))
+
+		res = self.index.on(self.today + timedelta(1))
+		self.assertEqual([(2, 1)], self.keys(res))
+
+	def testPrune(self):
+
+		self.index.days = 2
+
+		with transaction.manager:
+			res = self.index.episodes([1], self.today - timedelta(2))
+
+		self.assertEqual([(1, 2), (1, 3)], self.keys(res))
+		self.assertEqual(self.today - timedelta(2), self.index.start)
+		self.assertNotIn(self.today - timedelta(3), self.index.dates)
+
+	def testSessionChanges(self):
+
+		with transaction.manager:
+			airdates.build()
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			show.name = "renamed"
+			DBSession.add(Episode(show=show, num=3, season=1,
+						airdate=self.today))
+
+		with transaction.manager:
+			res = airdates.episodes([2], self.today)
+
+		self.assertEqual([(2, 3), (2, 1)], self.keys(res))
+		self.assertEqual("renamed", res[1].show.name)
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			store_show(show, {"seriesname": "stored", "status":
+				"Continuing", 1: {1: {"episodenumber": "7",
+				"seasonnumber": "1", "firstaired": "%s" % self.today,
+				"episodename": "new"}}})
+
+		with transaction.manager:
+			res = airdates.episodes([2], self.today)
+
+		self.assertEqual([(2, 7)], self.keys(res))
+		self.assertEqual("stored", res[0].show.name)
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			show.name = "rolled back"
+			DBSession.flush()
+			transaction.abort()
+
+		self.assertEqual(set(), airdates.stale)
+
+	def testUpdatedElsewhere(self):
+
+		shows = Show.__table__
+		episodes = Episode.__table__
+
+		with transaction.manager:
+			DBSession.execute(episodes.insert(), {"show_id": 2,
+				"season": 2, "num": 1, "airdate": self.today})
+			DBSession.execute(shows.update().values(
+				updated=datetime.now()).where(shows.c.show_id == 2))
+			sync_upcoming(DBSession, [2])
+			mark_changed(DBSession())
+
+		with transaction.manager:
+			res = self.index.episodes([2], self.today)
+
+		self.assertEqual([(2, 1)], self.keys(res))
+
+		self.index.interval = 0
+
+		with transaction.manager:
+			res = self.index.episodes([2], self.today)
+
+		self.assertEqual([(2, 1), (1, 1)], [(e.season, e.num)
+							for e in res])
+
+	def testCommittedLate(self):
+
+		shows = Show.__table__
+		episodes = Episode.__table__
+		self.index.interval = 0
+
+		# Stored with a time before the last check, committed after it
+		with transaction.manager:
+			DBSession.execute(episodes.insert(), {"show_id": 2,
+				"season": 2, "num": 1, "airdate": self.today})
+			DBSession.execute(shows.update().values(updated=
+				self.index.checked - timedelta(seconds=10)).where(
+				shows.c.show_id == 2))
+			sync_upcoming(DBSession, [2])
+			mark_changed(DBSession())
+
+		with transaction.manager:
+			res = self.index.episodes([2], self.today)
+
+		self.assertEqual([(2, 1), (1, 1)], [(e.season, e.num)
+							for e in res])
+
+		# Imported without touching Show.updated at all
+		with transaction.manager:
+			DBSession.execute(episodes.insert(), {"show_id": 2,
+				"season": 3, "num": 1, "airdate": self.today})
+			sync_upcoming(DBSession)
+			mark_changed(DBSession())
+
+		with transaction.manager:
+			res = self.index.episodes([2], self.today)
+			DBSession.execute(meta.delete())
+			mark_changed(DBSession())
+
+		self.assertEqual([(2, 1), (3, 1), (1, 1)], [(e.season, e.num)
+							for e in res])
+
+	def testFilledElsewhere(self):
+
+		# Created empty by an upgrade
+		with transaction.manager:
+			DBSession.query(UpcomingEpisode).delete()
+			DBSession.execute(meta.delete())
+			mark_changed(DBSession())
+
+		with transaction.manager:
+			self.index.build()
+			self.assertEqual([], self.index.episodes([1], self.today))
+
+		with transaction.manager:
+			self.assertTrue(fill_upcoming(DBSession))
+			self.assertFalse(fill_upcoming(DBSession))
+			mark_changed(DBSession())
+
+		self.index.interval = 0
+
+		with transaction.manager:
+			res = self.index.episodes([1], self.today)
+			self.assertEqual([(1, 2), (1, 3)], self.keys(res))
+			DBSession.execute(meta.delete())
+			mark_changed(DBSession())
+
+
+class TestSubscriberIndex(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+
+		with transaction.manager:
+
+			show1 = Show(id=1, name="show1", url="1")
+			show2 = Show(id=2, name="show2", url="2")
+
+			for name in ["user1", "user2", "user3"]:
+				user = User(name=name, mail=name, passwd="x")
+
+				if name != "user3":
+					user.shows.append(show1)
+
+				user.shows.append(show2)
+				DBSession.add(user)
+
+		self.changes = []
+		subscribers.listeners.append(self.listen)
+
+		with transaction.manager:
+			subscribers.load()
+
+	def tearDown(self):
+
+		subscribers.listeners.remove(self.listen)
+
+		with transaction.manager:
+
+			DBSession.execute(subscriptions.delete())
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+			DBSession.query(User).delete()
+
+		DBSession.remove()
+
+	def listen(self, shows, users):
+
+		self.changes.append((sorted(shows), sorted(users)))
+
+	def testLoad(self):
+
+		self.assertEqual(["user1", "user2"], subscribers.subscribers(1))
+		self.assertEqual(3, subscribers.count(2))
+		self.assertEqual(0, subscribers.count(3))
+		self.assertEqual(set(["user1", "user2", "user3"]),
+					subscribers.affected([1, 2, 3]))
+
+	def testSubscribe(self):
+
+		with transaction.manager:
+			user = DBSession.query(User).get("user3")
+			user.shows.append(DBSession.query(Show).get(1))
+
+		self.assertEqual(["user1", "user2", "user3"],
+					subscribers.subscribers(1))
+
+		with transaction.manager:
+			user = DBSession.query(User).get("user1")
+			user.shows.remove(DBSession.query(Show).get(1))
+
+		self.assertEqual(["user2", "user3"], subscribers.subscribers(1))
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(2)
+			show.users.remove(DBSession.query(User).get("user2"))
+
+		self.assertEqual(["user1", "user3"], subscribers.subscribers(2))
+
+		with transaction.manager:
+			user = DBSession.query(User).get("user2")
+			user.shows.append(DBSession.query(Show).get(2))
+			DBSession.flush()
+			transaction.abort()
+
+		self.assertEqual(["user1", "user3"], subscribers.subscribers(2))
+
+	def testDeleteUser(self):
+
+		with transaction.manager:
+			user = DBSession.query(User).get("user2")
+			user.shows
+			DBSession.delete(user)
+
+		self.assertEqual(["user1"], subscribers.subscribers(1))
+		self.assertEqual(["user1", "user3"], subscribers.subscribers(2))
+
+	def testStoreShowNotifies(self):
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(1)
+			store_show(show, {"seriesname": "show1"})
+			self.assertEqual([], self.changes)
+
+		self.assertEqual([([1], ["user1", "user2"])], self.changes)
+
+	def testBackgroundRefresh(self):
+
+		# The refresh thread needs its own connection to the database
+		tmp = tempfile.mkdtemp()
+		engine = create_engine("sqlite:///%s" % os.path.join(tmp,
+							"subscribers.sqlite"))
+		Base.metadata.create_all(engine)
+		DBSession.remove()
+		DBSession.configure(bind=engine)
+		index = SubscriberIndex(interval=0.01)
+
+		try:
+			with transaction.manager:
+				user = User(name="user1", mail="user1",
+								passwd="x")
+				user.shows.append(Show(id=1, name="show1",
+								url="1"))
+				DBSession.add(user)
+
+			index.start()
+
+			for attempt in range(500):
+				if index.count(1):
+					break
+
+				sleep(0.01)
+
+			index.stop()
+			self.assertEqual(["user1"], index.subscribers(1))
+			self.assertIsNone(index.thread)
+		finally:
+			index.stop()
+			DBSession.remove()
+			DBSession.configure(bind=Database._engine)
+			engine.dispose()
+			shutil.rmtree(tmp)
+
+	def testManySubscribers(self):
+
+		index = SubscriberIndex()
+
+		for num in range(100000):
+			index.add(1, "user%06d" % num)
+
+		index.add(2, "user000042")
+		index.remove(1, "user000007")
+
+		self.assertEqual(99999, index.count(1))
+		self.assertEqual(99999, len(index.affected([1, 2])))
+		self.assertEqual(["user000042"], index.subscribers(2))
+
+
+class TestUpcomingEpisodes(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+		self.today = date.today()
+
+		with transaction.manager:
+
+			show = Show(id=1, name="show1", url="1")
+
+			for num, days in enumerate([-30, -8, -7, 0, 3]):
+				DBSession.add(Episode(show=show, num=num, season=1,
+					airdate=self.today + timedelta(days)))
+
+			DBSession.add(Episode(show=show, num=5, season=1))
+
+	def tearDown(self):
+
+		with transaction.manager:
+
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+
+		DBSession.remove()
+
+	def upcoming(self):
+
+		query = DBSession.query(UpcomingEpisode).order_by(
+							UpcomingEpisode.num)
+		return [(e.num, e.show_name) for e in query]
+
+	def testWritePath(self):
+
+		self.assertEqual([(2, "show1"), (3, "show1"), (4, "show1")],
+							self.upcoming())
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(1)
+			show.name = "renamed"
+			DBSession.query(Episode).get((1, 4, 1)).airdate = None
+
+		self.assertEqual([(2, "renamed"), (3, "renamed")],
+							self.upcoming())
+
+		with transaction.manager:
+			show = DBSession.query(Show).get(1)
+			store_show(show, {"seriesname": "stored", 1: {1: {
+				"episodenumber": "9", "seasonnumber": "1",
+				"firstaired": "%s" % self.today}}})
+
+		self.assertEqual([(9, "stored")], self.upcoming())
+
+		with transaction.manager:
+			DBSession.delete(DBSession.query(Show).get(1))
+
+		self.assertEqual([], self.upcoming())
+
+	def testBulkDelete(self):
+
+		with transaction.manager:
+			DBSession.query(Episode).filter(Episode.num > 2).delete()
+
+		self.assertEqual([(2, "show1")], self.upcoming())
+
+	def testRollOff(self):
+
+		table = UpcomingEpisode.__table__
+
+		with transaction.manager:
+			DBSession.execute(table.insert(), {"show_id": 1,
+				"season": 2, "num": 1, "airdate": self.today -
+				timedelta(8), "show_name": "show1"})
+			self.assertEqual(1, maintain_upcoming(DBSession))
+			self.assertEqual(0, roll_off_upcoming(DBSession))
+			mark_changed(DBSession())
+
+		self.assertEqual(3, len(self.upcoming()))
+
+		with transaction.manager:
+			DBSession.execute(table.delete())
+			self.assertEqual(0, maintain_upcoming(DBSession))
+			mark_changed(DBSession())
+
+		self.assertEqual(3, len(self.upcoming()))
+
+	def testFeedRows(self):
+
+		user = User(name="upcoming", mail="upcoming", passwd="x")
+		user.shows.append(DBSession.query(Show).get(1))
+		DBSession.add(user)
+
+		rows = user.episodes_since(self.today - timedelta(7))
+		self.assertEqual([2, 3, 4], sorted(e.num for e in rows))
+		self.assertEqual("show1", rows[0].show.name)
+
+		rows = user.episodes_since(self.today - timedelta(8))
+		self.assertEqual([1, 2, 3, 4], sorted(e.num for e in rows))
+
+		transaction.abort()
+
+
+class TestArchive(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+		self.today = date.today()
+
+		with transaction.manager:
+
+			show = Show(id=1, name="show1", url="1")
+
+			for num, days in enumerate([-400, -100, -10, 0]):
+				DBSession.add(Episode(show=show, num=num, season=1,
+					airdate=self.today + timedelta(days)))
+
+			DBSession.add(Episode(show=show, num=4, season=1))
+
+	def tearDown(self):
+
+		ArchivedEpisode.DAYS = None
+
+		with transaction.manager:
+
+			DBSession.query(ArchivedEpisode).delete()
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+
+		DBSession.remove()
+
+	def nums(self, table):
+
+		return sorted(e.num for e in DBSession.query(table))
+
+	def testArchiveAndRestore(self):
+
+		with transaction.manager:
+			horizon = self.today - timedelta(30)
+			self.assertEqual(2, archive_episodes(DBSession, horizon))
+			mark_changed(DBSession())
+
+		self.assertEqual([2, 3, 4], self.nums(Episode))
+		self.assertEqual([0, 1], self.nums(ArchivedEpisode))
+		self.assertEqual(date.today(),
+				DBSession.query(Show).get(1).next_episode.airdate)
+
+		with transaction.manager:
+			self.assertEqual(2, restore_history(DBSession, 1))
+			mark_changed(DBSession())
+
+		self.assertEqual([0, 1, 2, 3, 4], self.nums(Episode))
+		self.assertEqual([], self.nums(ArchivedEpisode))
+
+	def testHorizon(self):
+
+		self.assertIsNone(ArchivedEpisode.horizon())
+
+		ArchivedEpisode.DAYS = 365
+		self.assertEqual(self.today - timedelta(365),
+						ArchivedEpisode.horizon())
+
+		ArchivedEpisode.DAYS = 3
+		self.assertEqual(self.today - timedelta(7),
+						ArchivedEpisode.horizon())
+
+	def testStoreShow(self):
+
+		ArchivedEpisode.DAYS = 30
+		data = {"seriesname": "show1", 1: dict((num, {
+			"episodenumber": "%d" % num, "seasonnumber": "1",
+			"firstaired": "%s" % (self.today + timedelta(days))})
+			for num, days in enumerate([-400, -100, -10, 0]))}
+
+		with transaction.manager:
+			archive_episodes(DBSession, ArchivedEpisode.horizon())
+			show = DBSession.query(Show).get(1)
+			store_show(show, data)
+
+		self.assertEqual([2, 3], self.nums(Episode))
+		self.assertEqual([0, 1], self.nums(ArchivedEpisode))
+
+	def testCascade(self):
+
+		with transaction.manager:
+			archive_episodes(DBSession, self.today - timedelta(30))
+			mark_changed(DBSession())
+
+		with transaction.manager:
+			DBSession.delete(DBSession.query(Show).get(1))
+
+		self.assertEqual([], self.nums(Episode))
+		self.assertEqual([], self.nums(ArchivedEpisode))
+
+
+class TestSQLitePragmas(unittest.TestCase):
+
+	def setUp(self):
+
+		self.directory = tempfile.mkdtemp()
+		path = os.path.join(self.directory, "test.sqlite")
+		self.engine = create_engine("sqlite:///%s" % path)
+
+	def tearDown(self):
+
+		self.engine.dispose()
+		shutil.rmtree(self.directory)
+
+	def pragma(self, name):
+
+		return self.engine.execute("PRAGMA %s" % name).scalar()
+
+	def testDefaults(self):
+
+		configure_sqlite(self.engine, {})
+
+		self.assertEqual("wal", self.pragma("journal_mode"))
+		self.assertEqual(1, self.pragma("synchronous"))
+		self.assertEqual(-20000, self.pragma("cache_size"))
+		self.assertEqual(5000, self.pragma("busy_timeout"))
+		self.assertEqual(2, self.pragma("temp_store"))
+
+	def testSettings(self):
+
+		configure_sqlite(self.engine, {
+			"webisoder.sqlite.journal_mode": "",
+			"webisoder.sqlite.busy_timeout": "250",
+			"webisoder.sqlite.synchronous": "FULL"
+		})
+
+		self.assertEqual("delete", self.pragma("journal_mode"))
+		self.assertEqual(250, self.pragma("busy_timeout"))
+		self.assertEqual(2, self.pragma("synchronous"))
+
+	def testInvalidValue(self):
+
+		with self.assertRaises(ValueError):
+			sqlite_pragmas({"p.cache_size": "1; DROP TABLE x"}, "p.")
+
+	def testDisabled(self):
+
+		self.assertEqual([], sqlite_pragmas({"p.journal_mode": "",
+			"p.synchronous": "", "p.mmap_size": "", "p.cache_size": "",
+			"p.busy_timeout": "", "p.temp_store": ""}, "p."))
+
+	def testNestedEngines(self):
+
+		replica = os.path.join(self.directory, "replica.sqlite")
+		settings = {
+			"sqlalchemy.url": "sqlite://",
+			"sqlalchemy.replica.url": "sqlite:///%s" % replica,
+			"webisoder.sqlite.journal_mode": ""
+		}
+
+		engine = engine_from_settings(settings)
+		self.assertEqual(None, engine.url.database)
+
+		engine = engine_from_settings(settings, "sqlalchemy.replica.")
+		self.assertEqual(replica, engine.url.database)
+		self.assertEqual("delete", engine.execute(
+					"PRAGMA journal_mode").scalar())
+		engine.dispose()
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+	def setUp(self):
+
+		self.failures = 0
+		self.calls = 0
+		self.stats = RetryStats()
+		self.policy = RetryPolicy(attempts=3, stats=self.stats)
+		self.policy.sleep = lambda delay: None
+
+		config = testing.setUp()
+		config.add_route("conflict", "/conflict")
+		config.add_view(self.view, route_name="conflict", renderer="string")
+		config.set_execution_policy(self.policy)
+		self.app = config.make_wsgi_app()
+
+	def tearDown(self):
+
+		testing.tearDown()
+
+	def view(self, request):
+
+		self.calls += 1
+
+		if self.calls <= self.failures:
+			raise self.locked()
+
+		return "attempt %d: %s" % (request.retry_attempt,
+						request.POST.get("x"))
+
+	def locked(self):
+
+		return OperationalError("COMMIT", {},
+				sqlite3.OperationalError("database is locked"))
+
+	def post(self):
+
+		request = Request.blank("/conflict", POST={"x": "y"})
+		return request.get_response(self.app)
+
+	def testRetryable(self):
+
+		self.assertTrue(is_retryable(self.locked()))
+		self.assertTrue(is_retryable(TransientError()))
+		self.assertFalse(is_retryable(IntegrityError("INSERT", {},
+				sqlite3.IntegrityError("UNIQUE constraint failed"))))
+		self.assertFalse(is_retryable(ValueError("database is locked")))
+
+	def testRetry(self):
+
+		self.failures = 2
+		res = self.post()
+
+		self.assertEqual(200, res.status_int)
+		self.assertEqual("attempt 2: y", res.text)
+		self.assertEqual({"retries": {"conflict": 2},
+			"retried": {"conflict": 1}, "exhausted": {}},
+			self.stats.snapshot())
+
+	def testGiveUp(self):
+
+		self.failures = 3
+
+		with self.assertRaises(OperationalError):
+			self.post()
+
+		self.assertEqual(3, self.calls)
+		self.assertEqual({"conflict": 1}, self.stats.exhausted)
+
+	def testOtherErrors(self):
+
+		self.failures = 1
+		self.locked = lambda: ValueError("failure")
+
+		with self.assertRaises(ValueError):
+			self.post()
+
+		self.assertEqual(1, self.calls)
+
+	def testBackoff(self):
+
+		self.policy.backoff = .1
+		self.policy.max_backoff = .3
+
+		for attempt in range(1, 6):
+			delay = self.policy.delay(attempt)
+			self.assertTrue(0 <= delay <= min(.3, .1 * 2 ** (attempt - 1)))
+
+
+class TestReadOnlySession(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+		today = date.today()
+
+		with transaction.manager:
+
+			user = User(name="reader", mail="reader", passwd="x")
+			user.token = "readtoken"
+			user.days_back = 1
+			show = Show(id=1, name="show1", url="1")
+			user.shows.append(show)
+			DBSession.add(user)
+
+			for num in range(3):
+				DBSession.add(Episode(show=show, num=num, season=1,
+					airdate=today + timedelta(num - 1),
+					title="ep%d" % num))
+
+		config = testing.setUp(settings={
+			"tm.activate_hook": tm_activate})
+		config.include("pyramid_tm")
+		config.add_route("feed", "/atom/{user}/{token}")
+		config.add_route("shows", "/shows")
+		config.add_route("feeds", "/feeds")
+		config.add_view(self.view, route_name="feed", renderer="json")
+		config.add_view(self.view, route_name="shows", renderer="json")
+		config.add_view(self.view, route_name="feeds", renderer="json")
+		self.app = config.make_wsgi_app()
+
+	def tearDown(self):
+
+		testing.tearDown()
+		ReadSession.remove()
+
+		with transaction.manager:
+			DBSession.execute(subscriptions.delete())
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+			DBSession.query(User).delete()
+
+		airdates.invalidate()
+		DBSession.remove()
+
+	def view(self, request):
+
+		session = read_session(request)
+		return [session is ReadSession, "tm.active" in request.environ]
+
+	def get(self, path, method="GET"):
+
+		request = Request.blank(path, method=method)
+		return request.get_response(self.app).json
+
+	def testActivateHook(self):
+
+		self.assertEqual([True, False], self.get("/atom/reader/x"))
+		self.assertEqual([False, True], self.get("/atom/reader/x",
+								"POST"))
+		self.assertEqual([True, False], self.get("/shows"))
+		self.assertEqual([False, True], self.get("/feeds"))
+
+	def testDefaultSession(self):
+
+		request = testing.DummyRequest()
+		self.assertIs(DBSession, read_session(request))
+		self.assertFalse(request.finished_callbacks)
+
+	def testFeed(self):
+
+		request = testing.DummyRequest()
+		request.matchdict["user"] = "reader"
+		request.matchdict["token"] = "readtoken"
+		request.environ["webisoder.readonly"] = True
+		DBSession.remove()
+
+		ctl = EpisodesController(request)
+		res = ctl.feed()
+
+		titles = [e.title for e in res["episodes"]]
+		self.assertEqual(["ep0", "ep1", "ep2"], titles)
+		self.assertIs(ReadSession(), ReadSession.object_session(
+								res["user"]))
+		self.assertFalse(DBSession.registry.has())
+
+		self.assertEqual(1, len(request.finished_callbacks))
+		request._process_finished_callbacks()
+		self.assertFalse(ReadSession.registry.has())
+
+	def testNoFlush(self):
+
+		session = ReadSession()
+		user = session.query(User).get("reader")
+		user.days_back = 5
+
+		self.assertEqual(1, session.query(User).filter_by(
+						days_back=1).count())
+
+
+class TestReplica(unittest.TestCase):
+
+	def setUp(self):
+
+		self.tmp = tempfile.mkdtemp()
+		primary = os.path.join(self.tmp, "primary.sqlite")
+		copy = os.path.join(self.tmp, "replica.sqlite")
+
+		self.primary = create_engine("sqlite:///%s" % primary)
+		Base.metadata.create_all(self.primary)
+		DBSession.remove()
+		DBSession.configure(bind=self.primary)
+		ReadSession.configure(bind=self.primary)
+
+		with transaction.manager:
+			user = User(name="reader", mail="reader", passwd="x")
+			user.shows.append(Show(id=1, name="show1", url="1"))
+			DBSession.add(user)
+
+		DBSession.remove()
+		self.primary.dispose()
+		shutil.copy(primary, copy)
+
+		with transaction.manager:
+			user = DBSession.query(User).get("reader")
+			user.shows.append(Show(id=2, name="show2", url="2"))
+
+		self.replica = create_engine("sqlite:///%s" % copy)
+		replica.bind(self.replica)
+
+		config = testing.setUp(settings={
+			"tm.activate_hook": tm_activate})
+		config.include("pyramid_tm")
+		config.set_session_factory(
+				SignedCookieSessionFactory("secret"))
+		config.add_route("shows", "/shows")
+		config.add_route("feed", "/atom/{user}/{token}")
+		config.add_view(self.shows, route_name="shows",
+					request_method="GET", renderer="json")
+		config.add_view(self.shows, route_name="feed",
+					request_method="GET", renderer="json")
+		config.add_view(self.subscribe, route_name="shows",
+					request_method="POST", renderer="json")
+		self.app = config.make_wsgi_app()
+
+	def tearDown(self):
+
+		testing.tearDown()
+		replica.engine = None
+		replica.stickiness = 5
+
+		DBSession.remove()
+		ReadSession.remove()
+		ReplicaSession.remove()
+		DBSession.configure(bind=Database._engine)
+		ReadSession.configure(bind=Database._engine)
+		ReplicaSession.configure(bind=None)
+
+		self.primary.dispose()
+		self.replica.dispose()
+		shutil.rmtree(self.tmp)
+
+	def shows(self, request):
+
+		user = replica_session(request).query(User).get("reader")
+		return sorted(show.id for show in user.shows)
+
+	def subscribe(self, request):
+
+		return "ok"
+
+	def request(self, path, method="GET", cookie=None):
+
+		request = Request.blank(path, method=method)
+
+		if cookie:
+			request.headers["Cookie"] = cookie
+
+		return request.get_response(self.app)
+
+	def testReadFromReplica(self):
+
+		self.assertEqual([1], self.request("/shows").json)
+		self.assertEqual([1], self.request("/atom/reader/x").json)
+
+	def testReadYourWrites(self):
+
+		res = self.request("/shows", "POST")
+		cookie = res.headers["Set-Cookie"].split(";")[0]
+
+		self.assertEqual([1, 2], self.request("/shows", "GET",
+							cookie).json)
+		self.assertEqual([1], self.request("/atom/reader/x", "GET",
+							cookie).json)
+
+		replica.stickiness = 0
+		self.assertEqual([1], self.request("/shows", "GET",
+							cookie).json)
+
+	def testNoReplica(self):
+
+		replica.engine = None
+		request = testing.DummyRequest()
+		request.environ["webisoder.readonly"] = True
+
+		self.assertIs(ReadSession, replica_session(request))
+		self.assertEqual([1, 2], self.request("/shows").json)
+
+
+class TestShards(unittest.TestCase):
+
+	def setUp(self):
+
+		self.tmp = tempfile.mkdtemp()
+		path = lambda name: "sqlite:///%s" % os.path.join(self.tmp,
+									name)
+		settings = {
+			"webisoder.shards.count": "2",
+			"sqlalchemy.shard0.url": path("users0.sqlite"),
+			"sqlalchemy.shard1.url": path("users1.sqlite")
+		}
+
+		self.catalog = create_engine(path("main.sqlite"))
+		Base.metadata.create_all(self.catalog)
+		self.shards = shard_engines(settings, self.catalog)
+
+		for shard in self.shards:
+			create_user_tables(shard)
+
+		DBSession.remove()
+		DBSession.configure(bind=self.catalog,
+				shards=shard_binds(self.catalog, self.shards))
+
+		names = ["alice", "bob", "carol", "dave", "erin", "frank"]
+		self.names = dict((shard_index(name, 2), name)
+							for name in names)
+
+		with transaction.manager:
+			DBSession.add(Show(id=1, name="show1", url="1"))
+			DBSession.add(Show(id=2, name="show2", url="2"))
+
+		# One shard per flush
+		for name in self.names.values():
+			with transaction.manager:
+				user = User(name=name, mail="%s@x" % name,
+								passwd="x")
+				user.shows.append(DBSession.query(Show).get(1))
+				DBSession.add(user)
+
+	def tearDown(self):
+
+		DBSession.remove()
+		DBSession.configure(bind=Database._engine, shards=None)
+		subscribers.names = []
+		subscribers.ids = {}
+		subscribers.shows = {}
+
+		for engine in self.shards + [self.catalog]:
+			engine.dispose()
+
+		shutil.rmtree(self.tmp)
+
+	def rows(self, engine, table):
+
+		return engine.execute(select([table.c.user_name])).fetchall()
+
+	def testPlacement(self):
+
+		users = User.__table__
+
+		for index, name in self.names.items():
+			shard = self.shards[index]
+			self.assertEqual([(name,)], self.rows(shard, users))
+			self.assertEqual([(name,)], self.rows(shard,
+								subscriptions))
+
+		self.assertEqual([], self.rows(self.catalog, users))
+		self.assertEqual(2, self.catalog.execute(
+			select([func.count()]).select_from(
+			Show.__table__)).scalar())
+
+	def testLookups(self):
+
+		name = self.names[1]
+		user = DBSession.query(User).get(name)
+		self.assertEqual(["show1"], [s.name for s in user.shows])
+
+		res = DBSession.query(User).filter_by(mail="%s@x" % name).all()
+		self.assertEqual([user], res)
+
+		res = DBSession.query(User).filter(User.mail.like("%@x")).all()
+		self.assertEqual(sorted(self.names.values()),
+						sorted(u.name for u in res))
+
+		show = DBSession.query(Show).get(1)
+		self.assertIn(show, user.shows)
+		self.assertEqual(sorted(self.names.values()),
+					sorted(u.name for u in show.users))
+
+	def testLoaderOptions(self):
+
+		for options in ROUTE_OPTIONS.values():
+			for name in self.names.values():
+				user = DBSession.query(User).options(
+							*options()).get(name)
+				self.assertEqual(["show1"], [s.name for s in
+								user.shows])
+
+			DBSession.remove()
+
+	def testSubscribe(self):
+
+		name = self.names[0]
+
+		with transaction.manager:
+			user = DBSession.query(User).get(name)
+			user.shows.remove(DBSession.query(Show).get(1))
+			user.shows.append(DBSession.query(Show).get(2))
+
+		rows = self.shards[0].execute(subscriptions.select()).fetchall()
+		self.assertEqual([(2, name)], [tuple(row) for row in rows])
+		self.assertEqual([(1, self.names[1])], [tuple(row) for row in
+			self.shards[1].execute(subscriptions.select())])
+
+	def testFlushAcrossShards(self):
+
+		show = DBSession.query(Show).get(2)
+		users = [DBSession.query(User).get(name)
+					for name in self.names.values()]
+		show.users.extend(users)
+
+		with self.assertRaises(ValueError):
+			DBSession.flush()
+
+		transaction.abort()
+
+	def testSubscriberIndex(self):
+
+		index = SubscriberIndex()
+
+		with transaction.manager:
+			index.load()
+
+		self.assertEqual(sorted(self.names.values()),
+					sorted(index.subscribers(1)))
+
+	def testRebalance(self):
+
+		users = User.__table__
+		path = os.path.join(self.tmp, "users2.sqlite")
+		shards = self.shards + shard_engines({
+			"webisoder.shards.count": "1",
+			"sqlalchemy.shard0.url": "sqlite:///%s" % path},
+			self.catalog)
+		create_user_tables(shards[2])
+
+		moved = rebalance(self.shards, shards)
+		self.assertEqual(0, rebalance(self.shards, shards))
+
+		for shard in shards:
+			for name, in self.rows(shard, users):
+				self.assertIs(shard, shards[shard_index(name, 3)])
+				self.assertEqual([(name,)], shard.execute(select(
+					[subscriptions.c.user_name]).where(
+					subscriptions.c.user_name == name)).fetchall())
+
+		self.assertEqual(len([name for index, name in self.names.items()
+				if shard_index(name, 3) != index]), moved)
+
+		# Back into the main database
+		self.assertEqual(2, rebalance(shards, [self.catalog]))
+		self.assertEqual(sorted((name,) for name in
+				self.names.values()), sorted(self.rows(
+				self.catalog, users)))
+
+		shards[2].dispose()
+
+	def testRebalanceSameDatabase(self):
+
+		users = User.__table__
+		before = [sorted(self.rows(shard, users))
+						for shard in self.shards]
+
+		# A second engine on a shard that is still configured
+		again = create_engine(self.shards[0].url)
+		self.assertEqual(0, rebalance(self.shards + [again],
+								self.shards))
+		self.assertEqual(0, rebalance([again], self.shards))
+		self.assertEqual(before, [sorted(self.rows(shard, users))
+						for shard in self.shards])
+
+		again.dispose()
+
+
+class TestRequestUser(WebisoderTest):
+
+	def setUp(self):
+
+		super(TestRequestUser, self).setUp()
+		today = date.today()
+
+		with transaction.manager:
+
+			user = User(name="loaded", mail="loaded", passwd="x")
+			user.token = "loadtoken"
+			DBSession.add(user)
+
+			for id in range(1, 4):
+				show = Show(id=id, name="show%d" % id, url="%d" % id,
+					next_airdate=today + timedelta(id))
+				user.shows.append(show)
+				DBSession.add(Episode(show=show, num=1, season=1,
+					airdate=today + timedelta(id), title="ep"))
+
+		DBSession.remove()
+
+	def tearDown(self):
+
+		testing.tearDown()
+
+		with transaction.manager:
+			DBSession.execute(subscriptions.delete())
+			DBSession.query(Episode).delete()
+			DBSession.query(Show).delete()
+			DBSession.query(User).delete()
+
+		DBSession.remove()
+
+	def request(self, route):
+
+		request = testing.DummyRequest()
+		request.session["auth.userid"] = "loaded"
+
+		if route:
+			request.matched_route = Route(route, "/%s" % route)
+
+		return request
+
+	def shows(self, route):
+
+		with collector.collect() as queries:
+			res = ShowsController(self.request(route)).get()
+			dates = [s.next_date for s in res["subscribed"]]
+
+		return dates, queries.count
+
+	def testLoadedOnce(self):
+
+		request = self.request("profile")
+
+		with self.assertQueries(1):
+			user = request_user(request)
+			self.assertIs(user, request_user(request))
+			self.assertIs(user, ProfileController(request).user)
+
+		self.assertEqual("loaded", user.name)
+
+	def testAnonymous(self):
+
+		request = testing.DummyRequest()
+
+		with self.assertQueries(0):
+			self.assertIsNone(request_user(request))
+
+	def testShows(self):
+
+		eager, count = self.shows("shows")
+		self.assertEqual(2, count)
+		DBSession.remove()
+
+		# One lazy load for the shows, the next airdate is stored with
+		# each show so the episodes are never loaded
+		self.assertEqual((eager, 2), self.shows(None))
+
+	def testShowsPastNextAirdate(self):
+
+		today = date.today()
+
+		with transaction.manager:
+			for show in DBSession.query(Show):
+				show.next_airdate = today - timedelta(1)
+
+		DBSession.remove()
+
+		# The episodes of all three shows in one more query
+		dates, count = self.shows("shows")
+		self.assertEqual([today + timedelta(id) for id in range(1, 4)],
+									dates)
+		self.assertEqual(3, count)
+
+	def testProfile(self):
+
+		request = self.request("profile")
+
+		with self.assertQueries(1) as queries:
+			res = ProfileController(request).get()
+			self.assertEqual("loaded", res["user"].mail)
+			self.assertTrue(res["user"].site_news)
+
+		self.assertNotIn("token", vars(res["user"]))
+		self.assertNotIn("token", queries.statements[0])
+
+	def testFeed(self):
+
+		request = self.request("feed")
+		request.matchdict = {"user": "loaded", "token": "loadtoken"}
+
+		with self.assertQueries(10) as queries:
+			res = EpisodesController(request).feed()
+
+		# The subscriptions are joined to the user
+		self.assertEqual(3, len(res["episodes"]))
+		self.assertEqual(1, len([s for s in queries.statements
+						if "subscriptions" in s]))
+
+
+class TestQueryCollector(unittest.TestCase):
+
+	def setUp(self):
+
+		Database.connect()
+		self.collector = QueryCollector()
+		self.collector.watch(Database._engine)
+
+		config = testing.setUp()
+		config.add_tween("webisoder.queries.query_tween_factory",
+								under=INGRESS)
+		config.add_route("shows", "/shows")
+		config.add_view(self.view, route_name="shows", renderer="json")
+		self.app = config.make_wsgi_app()
+
+		collector.stats.reset()
+		self.stream = StringIO()
+		self.handler = logging.StreamHandler(self.stream)
+		logging.getLogger("webisoder.queries").addHandler(self.handler)
+		logging.getLogger("webisoder.queries").setLevel(logging.INFO)
+
+	def tearDown(self):
+
+		logging.getLogger("webisoder.queries").removeHandler(self.handler)
+		collector.headers = False
+		collector.log = False
+		collector.stats.reset()
+		testing.tearDown()
+		DBSession.remove()
+
+	def view(self, request):
+
+		DBSession.execute("SELECT 1")
+		DBSession.execute("SELECT 2")
+		return {}
+
+	def get(self, path):
+
+		return Request.blank(path).get_response(self.app)
+
+	def testQueries(self):
+
+		queries = Queries()
+		queries.add("SELECT 1", .2)
+		queries.add("SELECT 2", .5)
+		queries.add("SELECT 3", .1)
+
+		self.assertEqual(3, queries.count)
+		self.assertAlmostEqual(.8, queries.time)
+		self.assertEqual("SELECT 2", queries.slowest)
+		self.assertIsNone(queries.statements)
+
+	def testStats(self):
+
+		stats = QueryStats()
+
+		for count in (2, 5):
+			queries = Queries()
+
+			for num in range(count):
+				queries.add("SELECT %d" % num, num * .1)
+
+			stats.add("shows", queries)
+
+		res = stats.snapshot()["shows"]
+		self.assertEqual(2, res["requests"])
+		self.assertEqual(7, res["queries"])
+		self.assertEqual(5, res["max_queries"])
+		self.assertEqual("SELECT 4", res["slowest"])
+		self.assertAlmostEqual(1.1, res["time"])
+
+	def testOutsideRequest(self):
+
+		with self.collector.collect(keep=True) as queries:
+			DBSession.execute("SELECT 1")
+
+		DBSession.execute("SELECT 2")
+		self.assertEqual(["SELECT 1"], queries.statements)
+
+	def testConfigure(self):
+
+		self.collector.configure({"webisoder.queries.headers": "true"},
+							"webisoder.queries.")
+		self.assertTrue(self.collector.headers)
+		self.assertFalse(self.collector.log)
+
+	def testTween(self):
+
+		res = self.get("/shows")
+		self.assertNotIn("X-DB-Queries", res.headers)
+		self.assertEqual("", self.stream.getvalue())
+
+		stats = collector.stats.snapshot()
+		self.assertEqual(1, stats["shows"]["requests"])
+		self.assertEqual(2, stats["shows"]["queries"])
+
+	def testHeaders(self):
+
+		collector.headers = True
+		res = self.get("/shows")
+
+		self.assertEqual("2", res.headers["X-DB-Queries"])
+		self.assertGreaterEqual(float(res.headers["X-DB-Time"]),
+					float(res.headers["X-DB-Slowest"]))
+
+	def testLog(self):
+
+		collector.log = True
+		self.get("/shows")
+
+		line = self.stream.getvalue()
+		self.assertIn("route=shows queries=2 ", line)
+		self.assertIn("slowest=SELECT ", line)
+
+
+class TestMetrics(unittest.TestCase):
+
+	def setUp(self):
+
+		cache_regions.update({"test_metrics": {
+			"type": "memory",
+			"expire": 60,
+			"enabled": True
+		}})
+
+		metrics.reset()
+		config = testing.setUp()
+		config.add_tween("webisoder.metrics.metrics_tween_factory",
+								under=INGRESS)
+		config.add_route("feed", "/atom/{user}/{token}")
+		config.add_view(lambda request: {"feed": "x" * 300},
+					route_name="feed", renderer="json")
+		config.add_view(lambda request: HTTPBadRequest(),
+					route_name="feed", request_method="POST")
+		self.app = config.make_wsgi_app()
+
+	def tearDown(self):
+
+		del(cache_regions["test_metrics"])
+		metrics.reset()
+		testing.tearDown()
+
+	def lines(self, prefix):
+
+		return [line for line in metrics.render().splitlines()
+						if line.startswith(prefix)]
+
+	def testHistogram(self):
+
+		histogram = Histogram((1, 5))
+
+		for value in (.5, 1, 3, 7, 9):
+			histogram.observe(value)
+
+		self.assertEqual([(1, 2), (5, 3), ("+Inf", 5)],
+						histogram.cumulative())
+		self.assertEqual(20.5, histogram.sum)
+		self.assertEqual(5, histogram.count)
+
+	def testTween(self):
+
+		Request.blank("/atom/user/token").get_response(self.app)
+		Request.blank("/atom/user/token").get_response(self.app)
+		Request.blank("/atom/user/token", method="POST").get_response(
+								self.app)
+
+		self.assertEqual([
+			'webisoder_responses_total{route="feed",status="200"} 2',
+			'webisoder_responses_total{route="feed",status="400"} 1'],
+			self.lines("webisoder_responses_total{"))
+		self.assertEqual(["webisoder_requests_in_flight 0"],
+				self.lines("webisoder_requests_in_flight "))
+		self.assertIn('webisoder_request_duration_seconds_count'
+				'{route="feed"} 3', self.lines(
+				"webisoder_request_duration_seconds_count"))
+
+		# The error page is the only response below 256 bytes
+		sizes = self.lines("webisoder_response_size_bytes_bucket")
+		self.assertIn('webisoder_response_size_bytes_bucket'
+					'{le="256",route="feed"} 1', sizes)
+		self.assertIn('webisoder_response_size_bytes_bucket'
+					'{le="1024",route="feed"} 3', sizes)
+
+	def testRender(self):
+
+		metrics.finish(None, 404, 10, .02)
+		text = metrics.render()
+
+		self.assertIn("# TYPE webisoder_request_duration_seconds "
+							"histogram\n", text)
+		self.assertIn('webisoder_request_duration_seconds_bucket'
+				'{le="0.025",route=""} 1\n', text)
+		self.assertIn('webisoder_request_duration_seconds_bucket'
+				'{le="+Inf",route=""} 1\n', text)
+		self.assertIn("# TYPE webisoder_retry_retries_total counter\n",
+									text)
+		self.assertEqual('"a\\\\b\\"c\\n"', '"%s"' % escape('a\\b"c\n'))
+
+	def testCache(self):
+
+		cache = region_cache("webisoder.test", "test_metrics")
+
+		with self.assertRaises(KeyError):
+			cache.get("key")
+
+		cache.put("key", "value")
+		self.assertEqual("value", cache.get("key"))
+
+		self.assertEqual("new", cached("webisoder.test", "test_metrics",
+						"other", lambda: "new"))
+		self.assertEqual("new", cached("webisoder.test", "test_metrics",
+						"other", lambda: "newer"))
+		self.assertEqual("x", cached("webisoder.test", "missing",
+						"other", lambda: "x"))
+
+		self.assertEqual([
+			'webisoder_cache_lookups_total{region="test_metrics",'
+							'result="hit"} 2',
+			'webisoder_cache_lookups_total{region="test_metrics",'
+							'result="miss"} 2'],
+			self.lines("webisoder_cache_lookups_total{"))
+
+	def testUpstream(self):
+
+		def not_found():
+
+			raise tvdb_shownotfound()
+
+		def broken():
+
+			raise IOError()
+
+		pool = UpstreamPool(workers=1)
+		pool.call("search", lambda: "result")
+
+		with self.assertRaises(tvdb_shownotfound):
+			pool.call("show", not_found)
+
+		with self.assertRaises(IOError):
+			pool.call("show", broken)
+
+		self.assertEqual([
+			'webisoder_tvdb_call_duration_seconds_count'
+					'{call="search",result="ok"} 1',
+			'webisoder_tvdb_call_duration_seconds_count'
+					'{call="show",result="error"} 1',
+			'webisoder_tvdb_call_duration_seconds_count'
+					'{call="show",result="ok"} 1'],
+			self.lines("webisoder_tvdb_call_duration_seconds_count"))
+
+	def testEndpoint(self):
+
+		def get(auth=None):
+
+			request = Request.blank("/metrics")
+
+			if auth:
+				request.authorization = auth
+
+			ctl = MetricsController(request)
+			ctl.metrics = instance
+			return ctl.get()
+
+		instance = Metrics()
+		self.assertEqual(404, get("Bearer secret").code)
+
+		instance.configure({"webisoder.metrics.token": "secret"},
+							"webisoder.metrics.")
+		self.assertEqual(401, get().code)
+		self.assertEqual(401, get("Bearer wrong").code)
+		self.assertEqual(401, get("Basic c2VjcmV0").code)
+
+		res = get("Bearer secret")
+		self.assertEqual(200, res.status_int)
+		self.assertEqual("text/plain", res.content_type)
+		self.assertIn("webisoder_requests_in_flight 0\n", res.text)
+
+
+class TestProfiler(unittest.TestCase):
+
+	def setUp(self):
+
+		self.tmp = tempfile.mkdtemp()
+		profiler.configure({"webisoder.profile.rate": "1",
+			"webisoder.profile.directory": self.tmp,
+			"webisoder.profile.secret": "secret",
+			"webisoder.profile.interval": "0.001"},
+			"webisoder.profile.")
+
+		config = testing.setUp()
+		config.add_tween("webisoder.profiling.profile_tween_factory",
+								under=INGRESS)
+		config.add_route("feed", "/atom/{user}/{token}")
+		config.add_view(self.slow_view, route_name="feed",
+							renderer="json")
+		self.app = config.make_wsgi_app()
+
+	def tearDown(self):
+
+		profiler.__init__()
+		testing.tearDown()
+		shutil.rmtree(self.tmp)
+
+	def slow_view(self, request):
+
+		sleep(.05)
+		return {}
+
+	def get(self, headers={}):
+
+		Request.blank("/atom/user/token", headers=headers).get_response(
+								self.app)
+
+	def files(self, route="feed"):
+
+		return sorted(os.listdir(os.path.join(self.tmp, route)))
+
+	def testDisabled(self):
+
+		settings = {"webisoder.profile.directory": self.tmp}
+		disabled = Profiler()
+		disabled.configure(settings, "webisoder.profile.")
+		self.assertFalse(disabled.enabled)
+
+		settings["webisoder.profile.rate"] = "0.01"
+		disabled.configure(settings, "webisoder.profile.")
+		self.assertTrue(disabled.enabled)
+
+		with self.assertRaises(ValueError):
+			disabled.configure({"webisoder.profile.format": "svg"},
+							"webisoder.profile.")
+
+	def testSignedHeader(self):
+
+		profiler.rate = 0
+		request = testing.DummyRequest()
+		self.assertFalse(profiler.wanted(request))
+
+		request.headers[HEADER] = profile_header("secret", 60)
+		self.assertTrue(profiler.wanted(request))
+
+		request.headers[HEADER] = profile_header("wrong", 60)
+		self.assertFalse(profiler.wanted(request))
+
+		request.headers[HEADER] = profile_header("secret", -10)
+		self.assertFalse(profiler.wanted(request))
+
+		request.headers[HEADER] = "garbage"
+		self.assertFalse(profiler.wanted(request))
+
+		profiler.secret = None
+		request.headers[HEADER] = profile_header("secret", 60)
+		self.assertFalse(profiler.wanted(request))
+
+	def testCollapsed(self):
+
+		self.get()
+		files = self.files()
+		self.assertEqual(1, len(files))
+		self.assertTrue(files[0].endswith(".collapsed"))
+
+		stacks = merge_stacks(profile_paths(self.tmp, ".collapsed"),
+								prefix=True)
+		slow = [stack for stack in stacks if
+				"webisoder.tests:slow_view" in stack]
+		self.assertTrue(slow)
+		self.assertTrue(all(stack.startswith("feed;") for stack in slow))
+
+	def testPstats(self):
+
+		profiler.format = "pstats"
+		self.get()
+		self.get()
+
+		paths = [path for route, path in profile_paths(self.tmp,
+							".prof", "feed")]
+		self.assertEqual(2, len(paths))
+
+		stats = pstats.Stats(*paths)
+		self.assertTrue([func for func in stats.stats
+						if func[2] == "slow_view"])
+
+	def testRotate(self):
+
+		profiler.keep = 2
+
+		for num in range(3):
+			self.get()
+
+		self.assertEqual(2, len(self.files()))
+
+	def testMerge(self):
+
+		for route in ("feed", "ical"):
+			os.makedirs(os.path.join(self.tmp, route))
+
+			for num in range(2):
+				with open(os.path.join(self.tmp, route,
+						"%d.collapsed" % num), "w") as out:
+					out.write("main;view %d\nmain;other 1\n" % (
+								num + 1))
+
+		paths = profile_paths(self.tmp, ".collapsed", "feed")
+		self.assertEqual({"main;view": 3, "main;other": 2},
+						merge_stacks(paths))
+
+		stacks = merge_stacks(profile_paths(self.tmp, ".collapsed"),
+								prefix=True)
+		self.assertEqual(3, stacks["ical;main;view"])
+		self.assertEqual(4, len(stacks))
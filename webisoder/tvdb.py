@@ -0,0 +1,563 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from Queue import Queue, Full
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+from time import time
+from urllib2 import BaseHandler, urlopen, Request
+
+from tvdb_api import Tvdb, tvdb_attributenotfound, tvdb_shownotfound
+
+from .cache import cached, region_cache
+from .errors import UpstreamBusy, UpstreamTimeout, UpstreamUnavailable
+from .metrics import metrics
+from .search import normalize_query
+
+log = logging.getLogger(__name__)
+
+# The parts of a show that webisoder.jobs.store_show reads
+SHOW_FIELDS = ("seriesname", "status")
+EPISODE_FIELDS = ("seasonnumber", "episodenumber", "firstaired",
+			"episodename", "absolute_number", "productioncode")
+
+
+def show_data(show):
+
+	""" Copy the show and episode fields we use out of a tvdb_api Show into
+	plain dicts of the same layout. The full Show drags along every season,
+	episode and banner object with back references to each other.
+	"""
+	res = {}
+
+	for key in SHOW_FIELDS:
+		try:
+			res[key] = show[key]
+		except (KeyError, tvdb_attributenotfound):
+			pass
+
+	for number, season in show.items():
+
+		if not isinstance(season, dict):
+			continue
+
+		res[number] = dict((num, dict((key, episode.get(key))
+				for key in EPISODE_FIELDS))
+				for num, episode in season.items())
+
+	return res
+
+
+class CircuitBreaker(object):
+
+	""" Stops calling TheTVDB for a while once too many recent calls failed
+	or took too long. After the reset timeout a single probe call is let
+	through to find out whether the service has recovered.
+	"""
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half-open"
+
+	def __init__(self, window=20, min_calls=5, error_rate=.5, slow_call=10,
+							reset_timeout=30):
+
+		self.window = window
+		self.min_calls = min_calls
+		self.error_rate = error_rate
+		self.slow_call = slow_call
+		self.reset_timeout = reset_timeout
+		self.clock = time
+		self.lock = Lock()
+		self.reset()
+
+	def configure(self, settings, prefix):
+
+		self.window = int(settings.get("%swindow" % prefix, self.window))
+		self.min_calls = int(settings.get("%smin_calls" % prefix,
+							self.min_calls))
+		self.error_rate = float(settings.get("%serror_rate" % prefix,
+							self.error_rate))
+		self.slow_call = float(settings.get("%sslow_call" % prefix,
+							self.slow_call))
+		self.reset_timeout = float(settings.get("%sreset_timeout" %
+						prefix, self.reset_timeout))
+		self.reset()
+
+	def reset(self):
+
+		self.state = self.CLOSED
+		self.calls = deque(maxlen=self.window)
+		self.opened = None
+		self.probing = False
+
+	def trip(self):
+
+		log.warning("TVDB circuit breaker open")
+		self.state = self.OPEN
+		self.opened = self.clock()
+		self.probing = False
+
+	def allow(self):
+
+		with self.lock:
+			if self.state == self.OPEN:
+				if self.clock() - self.opened < self.reset_timeout:
+					return False
+
+				self.state = self.HALF_OPEN
+
+			if self.state == self.HALF_OPEN:
+				if self.probing:
+					return False
+
+				self.probing = True
+
+			return True
+
+	def release(self):
+
+		""" Give up a call that never reached TheTVDB without counting it
+		as a success or a failure
+		"""
+		with self.lock:
+			if self.state == self.HALF_OPEN:
+				self.probing = False
+
+	def record(self, success, duration):
+
+		failed = not success or duration > self.slow_call
+
+		with self.lock:
+			if self.state == self.HALF_OPEN:
+				if failed:
+					self.trip()
+				else:
+					log.warning("TVDB circuit breaker closed")
+					self.reset()
+				return
+
+			self.calls.append(failed)
+
+			if len(self.calls) < self.min_calls:
+				return
+
+			rate = float(sum(self.calls)) / len(self.calls)
+
+			if self.state == self.CLOSED and rate >= self.error_rate:
+				self.trip()
+
+	def call(self, func, *args, **kwargs):
+
+		if not self.allow():
+			raise UpstreamUnavailable("TheTVDB is currently unavailable")
+
+		start = self.clock()
+
+		try:
+			res = func(*args, **kwargs)
+		except UpstreamBusy:
+			self.release()
+			raise
+		except tvdb_shownotfound:
+			self.record(True, self.clock() - start)
+			raise
+		except Exception:
+			self.record(False, self.clock() - start)
+			raise
+
+		self.record(True, self.clock() - start)
+		return res
+
+
+class UpstreamCall(object):
+
+	def __init__(self, func, args):
+
+		self.func = func
+		self.args = args
+		self.done = Event()
+		self.cancelled = False
+		self.result = None
+		self.error = None
+
+	def run(self):
+
+		try:
+			self.result = self.func(*self.args)
+		except Exception as e:
+			self.error = e
+		finally:
+			self.done.set()
+
+
+class UpstreamPool(object):
+
+	""" Runs calls to TheTVDB on a fixed number of worker threads. A slow
+	TheTVDB can therefore hold at most that many threads, calls that do not
+	fit into the queue are rejected at once and callers never wait longer
+	than the deadline for the operation.
+	"""
+
+	def __init__(self, workers=4, max_queue=8, timeout=10):
+
+		self.workers = workers
+		self.threads = []
+		self.queue = Queue(max_queue)
+		self.timeout = timeout
+		self.timeouts = {}
+		self.lock = Lock()
+
+	def configure(self, settings, prefix):
+
+		self.workers = int(settings.get("%sworkers" % prefix,
+								self.workers))
+		self.queue.maxsize = int(settings.get("%smax_queue" % prefix,
+							self.queue.maxsize))
+		self.timeout = float(settings.get("%stimeout" % prefix,
+								self.timeout))
+
+		option = "%stimeout." % prefix
+
+		for key in settings:
+			if key.startswith(option):
+				name = key[len(option):]
+				self.timeouts[name] = float(settings[key])
+
+	def deadline(self, name):
+
+		return self.timeouts.get(name, self.timeout)
+
+	def start(self):
+
+		with self.lock:
+			while len(self.threads) < self.workers:
+				name = "tvdb-%d" % len(self.threads)
+				worker = Thread(target=self.work, name=name)
+				worker.daemon = True
+				worker.start()
+				self.threads.append(worker)
+
+	def work(self):
+
+		while True:
+			call = self.queue.get()
+
+			if not call.cancelled:
+				call.run()
+
+	def call(self, name, func, *args):
+
+		self.start()
+		call = UpstreamCall(func, args)
+
+		try:
+			self.queue.put_nowait(call)
+		except Full:
+			raise UpstreamBusy("Too many pending TVDB requests")
+
+		start = time()
+
+		if not call.done.wait(self.deadline(name)):
+			call.cancelled = True
+			metrics.upstream_call(name, False, time() - start)
+			raise UpstreamTimeout("TVDB %s timed out" % name)
+
+		# Including the time spent waiting for a worker
+		metrics.upstream_call(name, call.error is None or isinstance(
+				call.error, tvdb_shownotfound), time() - start)
+
+		if call.error is not None:
+			raise call.error
+
+		return call.result
+
+
+class AIMDLimiter(object):
+
+	""" Adapts the number of concurrent calls to TheTVDB: while calls
+	succeed within the latency target the limit grows by one per round of
+	calls, on errors or slow calls it is cut by the backoff factor, at most
+	once per round.
+	"""
+
+	def __init__(self, initial=2, minimum=1, maximum=32, latency=2.0,
+								backoff=.5):
+
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.latency = latency
+		self.backoff = backoff
+		self.clock = time
+		self.active = 0
+		self.decreased = None
+		self.completed = 0
+		self.errors = 0
+		self.started = None
+		self.condition = Condition()
+
+	def configure(self, settings, prefix):
+
+		self.limit = float(settings.get("%sinitial" % prefix, self.limit))
+		self.minimum = int(settings.get("%sminimum" % prefix,
+								self.minimum))
+		self.maximum = int(settings.get("%smaximum" % prefix,
+								self.maximum))
+		self.latency = float(settings.get("%slatency" % prefix,
+								self.latency))
+		self.backoff = float(settings.get("%sbackoff" % prefix,
+								self.backoff))
+
+	def acquire(self):
+
+		with self.condition:
+			while self.active >= int(self.limit):
+				self.condition.wait()
+
+			self.active += 1
+			now = self.clock()
+
+			if self.started is None:
+				self.started = now
+
+			return now
+
+	def release(self, start, success):
+
+		now = self.clock()
+		healthy = success and now - start <= self.latency
+
+		with self.condition:
+			self.active -= 1
+			self.completed += 1
+
+			if not success:
+				self.errors += 1
+
+			if healthy:
+				limit = self.limit + 1.0 / self.limit
+				self.limit = min(float(self.maximum), limit)
+			elif self.decreased is None or start >= self.decreased:
+				limit = self.limit * self.backoff
+				self.limit = max(float(self.minimum), limit)
+				self.decreased = now
+				log.info("Backing off to %d concurrent TVDB calls" %
+								self.limit)
+
+			self.condition.notify_all()
+
+	def rate(self):
+
+		if self.started is None:
+			return 0.0
+
+		elapsed = self.clock() - self.started
+
+		if elapsed <= 0:
+			return 0.0
+
+		return self.completed / elapsed
+
+
+class TimeoutHandler(BaseHandler):
+
+	""" Sets a socket timeout on every request of a urllib2 opener, there
+	is no option for that in tvdb_api. A call that timed out in the pool
+	keeps its worker busy until then at most.
+	"""
+
+	def __init__(self, timeout):
+
+		self.timeout = timeout
+
+	def http_request(self, req):
+
+		req.timeout = self.timeout
+		return req
+
+	https_request = http_request
+
+
+class StaleCache(object):
+
+	""" Keeps the last good answer from TheTVDB for every call so that it
+	can be served when TheTVDB is unavailable.
+	"""
+
+	namespace = "webisoder.tvdb.stale"
+
+	def __init__(self, region="month"):
+
+		self.region = region
+
+	def configure(self, settings, prefix):
+
+		self.region = settings.get("%sstale_region" % prefix, self.region)
+
+	def get(self, key):
+
+		cache = region_cache(self.namespace, self.region)
+
+		if cache is None:
+			raise KeyError(key)
+
+		return cache.get(key)
+
+	def put(self, key, value):
+
+		cache = region_cache(self.namespace, self.region)
+
+		if cache is not None:
+			cache.put(key, value)
+
+
+breaker = CircuitBreaker()
+pool = UpstreamPool()
+stale_cache = StaleCache()
+
+
+class TVDBWrapper(object):
+
+	base_url = None
+
+	def tvdb(self, timeout=None, **kwargs):
+
+		""" Set up tvdb_api, optionally talking to another server than
+		TheTVDB itself (see webisoder.scripts.fake_tvdb)
+		"""
+		tv = Tvdb(**kwargs)
+
+		if timeout is not None:
+			tv.urlopener.add_handler(TimeoutHandler(timeout))
+
+		if self.base_url:
+			default = tv.config["base_url"]
+
+			for key, value in tv.config.items():
+				if key.startswith("url_"):
+					tv.config[key] = value.replace(default,
+								self.base_url, 1)
+
+			tv.config["base_url"] = self.base_url
+
+		return tv
+
+	def upstream(self, name, arg, func, *args, **kwargs):
+
+		""" Call TheTVDB through the circuit breaker, falling back to the
+		last good result for the same call if that fails. Background jobs
+		pass site=False: they back off on their own, so the call goes
+		straight to the pool, failures are raised and the result is not
+		kept for later.
+		"""
+		key = "%s:%s" % (name, arg)
+
+		if not kwargs.get("site", True):
+			return pool.call(name, func, *args)
+
+		try:
+			res = breaker.call(pool.call, name, func, *args)
+		except tvdb_shownotfound:
+			raise
+		except Exception as e:
+
+			try:
+				res = stale_cache.get(key)
+			except KeyError:
+				raise e
+
+			log.warning("Serving stale %s after TVDB failure: %s" % (
+								key, e))
+			return res
+
+		stale_cache.put(key, res)
+		return res
+
+	def fetchShow(self, id, banners=False):
+
+		name = "banner" if banners else "show"
+		tv = self.tvdb(banners=banners, timeout=pool.deadline(name))
+		return tv[id]
+
+	def fetchShowData(self, id):
+
+		return show_data(self.fetchShow(id))
+
+	def getByURL(self, url, site=True):
+
+		if not url.isdigit():
+			raise tvdb_shownotfound()
+
+		return self.upstream("show", url, self.fetchShowData, int(url),
+								site=site)
+
+	def fetchURL(self, url):
+
+		req = Request(url)
+		res = urlopen(req, timeout=pool.deadline("download"))
+		return res.read()
+
+	def downloadBanner(self, url):
+
+		return cached("webisoder.tvdb.download", "month", url,
+			lambda: self.upstream("download", url, self.fetchURL, url))
+
+	def findBanner(self, id):
+
+		best = None
+		best_rating = -1
+
+		show = self.fetchShow(id, banners=True)
+
+		banners = show["_banners"]
+		fanart = banners.get("fanart", {})
+
+		for res in fanart:
+			items = fanart.get(res)
+
+			for id in items:
+				item = items.get(id)
+				path = item.get("_thumbnailpath")
+				rating = float(item.get("rating", 0))
+
+				if rating > best_rating:
+					best = path
+
+		return best
+
+	def getBanner(self, url):
+
+		if not url.isdigit():
+			raise tvdb_shownotfound()
+
+		return cached("webisoder.tvdb.banner", "week", url,
+			lambda: self.downloadBanner(self.upstream("banner", url,
+						self.findBanner, int(url))))
+
+	def fetchSearch(self, text):
+
+		tv = self.tvdb(timeout=pool.deadline("search"))
+		return tv.search(text)
+
+	def search(self, text):
+
+		# Keyed like SearchCache, so that any spelling of a query can
+		# fall back to the results of another
+		return self.upstream("search", normalize_query(text),
+						self.fetchSearch, text)
@@ -0,0 +1,94 @@
+# webisoder
+# Copyright (C) 2006-2017  Stefan Ott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date
+
+from sqlalchemy.orm import joinedload, load_only, object_session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .models import Episode, User
+from .readonly import replica_session
+
+# What the views and templates of each route use of the user, so that it
+# can be loaded up front instead of one lazy load at a time
+ROUTE_OPTIONS = {
+	"shows": lambda: [selectinload(User.shows)],
+	"episodes": lambda: [joinedload(User.shows)],
+	"feed": lambda: [joinedload(User.shows)],
+	"ical": lambda: [joinedload(User.shows)],
+	"html": lambda: [joinedload(User.shows)],
+	"profile": lambda: [load_only("name", "passwd", "mail", "signup",
+						"site_news", "recover_key")],
+	"feeds": lambda: [load_only("name", "token")],
+	"settings_token": lambda: [load_only("name", "token")],
+	"settings_feed": lambda: [load_only("name", "days_back",
+					"date_offset", "link_format")],
+	"settings_pw": lambda: [load_only("name", "passwd", "recover_key")],
+}
+
+
+def load_next_episodes(shows):
+
+	""" Load the episodes of all shows whose stored next airdate has passed
+	in a single query, Show.next_date has to look at those. The other shows
+	never load their episodes.
+	"""
+	today = date.today()
+	stale = dict((show.id, show) for show in shows if not show.finished
+			and show.next_airdate and show.next_airdate < today)
+
+	if not stale:
+		return shows
+
+	episodes = dict((id, []) for id in stale)
+	query = object_session(shows[0]).query(Episode).filter(
+					Episode.show_id.in_(stale))
+
+	for episode in query:
+		episodes[episode.show_id].append(episode)
+
+	for id, show in stale.items():
+		set_committed_value(show, "episodes", episodes[id])
+
+	return shows
+
+
+def user_query(request):
+
+	""" A query for users with the loader options of the matched route
+	"""
+	query = replica_session(request).query(User)
+	route = getattr(request, "matched_route", None)
+	options = ROUTE_OPTIONS.get(route.name) if route else None
+
+	if options:
+		query = query.options(*options())
+
+	return query
+
+
+def request_user(request):
+
+	""" The logged in user, loaded once per request. Registered as the
+	reified request.user, views get it from here so that plain test
+	requests work as well.
+	"""
+	if "user" in vars(request):
+		return request.user
+
+	uid = request.authenticated_userid
+	request.user = user_query(request).get(uid) if uid else None
+	return request.user
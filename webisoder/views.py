@@ -18,80 +18,38 @@ import logging
 import httplib
 
 from decorator import decorator
+from hmac import compare_digest
 from deform import Form, ValidationFailure
 from datetime import date, timedelta
-from beaker.cache import cache_region
-from urllib2 import urlopen, Request
 
 from pyramid.httpexceptions import HTTPFound, HTTPBadRequest, HTTPUnauthorized
-from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPNotFound, HTTPServiceUnavailable
 from pyramid.response import Response
 from pyramid.security import remember, forget
 from pyramid.view import view_config, view_defaults
 
-from tvdb_api import Tvdb, tvdb_shownotfound, tvdb_error
+from tvdb_api import tvdb_shownotfound, tvdb_error
 
-from .models import DBSession, User, Show, ResultRating
+from .airdates import airdates
+from .models import DBSession, User, Show
 from .errors import LoginFailure, MailError, SubscriptionFailure, DuplicateEmail
 from .errors import FormError, DuplicateUserName
 from .forms import LoginForm, PasswordResetForm, FeedSettingsForm, SubscribeForm
 from .forms import ProfileForm, SearchForm, SignupForm, RequestPasswordResetForm
 from .forms import PasswordForm, UnSubscribeForm
+from .jobs import import_queue, import_show
 from .mail import WelcomeMessage, PasswordRecoveryMessage
+from .metrics import metrics
+from .readonly import read_session
+from .retry import retry_state
+from .search import search_cache
+from .suggest import suggestions
+from .tvdb import TVDBWrapper
+from .users import load_next_episodes, request_user, user_query
 
 log = logging.getLogger(__name__)
 
 
-class TVDBWrapper(object):
-
-	def getByURL(self, url):
-
-		if not url.isdigit():
-			raise tvdb_shownotfound()
-
-		tv = Tvdb()
-		return tv[int(url)]
-
-	@cache_region("month")
-	def downloadBanner(self, url):
-
-		req = Request(url)
-		res = urlopen(req)
-		return res.read()
-
-	@cache_region("week")
-	def getBanner(self, url):
-
-		best = None
-		best_rating = -1
-
-		if not url.isdigit():
-			raise tvdb_shownotfound()
-
-		tv = Tvdb(banners = True)
-		show = tv[int(url)]
-
-		banners = show["_banners"]
-		fanart = banners.get("fanart", {})
-
-		for res in fanart:
-			items = fanart.get(res)
-
-			for id in items:
-				item = items.get(id)
-				path = item.get("_thumbnailpath")
-				rating = float(item.get("rating", 0))
-
-				if rating > best_rating:
-					best = path
-
-		return self.downloadBanner(best)
-
-	def search(self, text):
-
-		tv = Tvdb()
-		return tv.search(text)
-
 @decorator
 def securetoken(func, *args, **kwargs):
 
@@ -104,7 +62,7 @@ def securetoken(func, *args, **kwargs):
 	if not uid:
 		return HTTPBadRequest()
 
-	user = DBSession.query(User).get(uid)
+	user = user_query(request).get(uid)
 	if not user:
 		return HTTPNotFound()
 
@@ -120,6 +78,11 @@ class WebisoderController(object):
 
 		self.request = request
 
+	@property
+	def user(self):
+
+		return request_user(self.request)
+
 	def redirect(self, destination):
 
 		return HTTPFound(location=self.request.route_url(destination))
@@ -156,8 +119,7 @@ class FeedsController(WebisoderController):
 	@view_config(route_name="feeds", request_method="GET")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 		return { "user": user }
 
 
@@ -167,16 +129,15 @@ class ShowsController(WebisoderController):
 	def __init__(self, request):
 
 		super(ShowsController, self).__init__(request)
-		self.backend = TVDBWrapper
+		self.queue = import_queue
 
 	@view_config(route_name="shows", request_method="GET",
 							permission="view")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
-		return {"subscribed": user.shows }
+		return {"subscribed": load_next_episodes(user.shows) }
 
 	@view_config(context=ValidationFailure)
 	@view_config(context=SubscriptionFailure)
@@ -184,11 +145,10 @@ class ShowsController(WebisoderController):
 
 		self.flash("danger", "Failed to modify subscription")
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		res = self.request.POST
-		res["subscribed"] = user.shows
+		res["subscribed"] = load_next_episodes(user.shows)
 
 		return res
 
@@ -198,23 +158,27 @@ class ShowsController(WebisoderController):
 		log.critical("TVDB subscription failed: Show not found")
 		self.flash("danger", "Failed to subscribe to show: not found")
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		res = self.request.POST
-		res["subscribed"] = user.shows
+		res["subscribed"] = load_next_episodes(user.shows)
 
 		return res
 
-	def import_show(self, url):
+	def create_show(self, url, name):
+
+		if not url.isdigit():
+			raise tvdb_shownotfound()
 
-		engine = self.backend()
-		data = engine.getByURL(url)
 		show = Show()
 		show.url = url
-		show.name = data["seriesname"]
+		show.name = name or url
+		show.pending = True
 
 		DBSession.add(show)
+		DBSession.flush()
+
+		return show
 
 	@view_config(route_name="subscribe", request_method="POST",
 							permission="view")
@@ -225,16 +189,17 @@ class ShowsController(WebisoderController):
 		data = form.validate(controls)
 
 		url = data.get("url")
-		query = DBSession.query(Show).filter_by(url=url)
+		show = DBSession.query(Show).filter_by(url=url).first()
 
-		if query.count() != 1:
-			self.import_show(url)
+		if not show:
+			show = self.create_show(url, data.get("name"))
 
-		show = query.one()
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 		user.shows.append(show)
 
+		if show.pending:
+			self.queue.defer(import_show, show.id)
+
 		self.flash("info", 'Subscribed to "%s"' % show.name)
 		return self.redirect("shows")
 
@@ -252,8 +217,7 @@ class ShowsController(WebisoderController):
 		if not show:
 			raise SubscriptionFailure()
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 		user.shows.remove(show)
 
 		self.flash("info", 'Unsubscribed from "%s"' % show.name)
@@ -353,16 +317,26 @@ class RegistrationController(WebisoderController):
 
 		if DBSession.query(User).get(name):
 			raise DuplicateUserName()
-		if DBSession.query(User).filter_by(mail=mail).count() > 0:
+		if DBSession.query(User).filter_by(mail=mail).first():
 			raise DuplicateEmail()
 
+		# A retried request must not mail a different password
+		state = retry_state(self.request)
 		user = User(name=name)
-		password = user.generate_password()
+
+		if "password" in state:
+			user.password = state["password"]
+		else:
+			state["password"] = user.generate_password()
+
 		user.mail = mail
 		DBSession.add(user)
+		DBSession.flush()
 
-		msg = WelcomeMessage()
-		msg.send(self.request, user, password)
+		if not state.get("mailed"):
+			msg = WelcomeMessage()
+			msg.send(self.request, user, state["password"])
+			state["mailed"] = True
 
 		self.flash("info", "Your account has been created and your "
 				"initial password was sent to %s" % (mail))
@@ -406,16 +380,28 @@ class PasswordRecoveryController(WebisoderController):
 		data = form.validate(controls)
 
 		email = data.get("email")
-		users = DBSession.query(User).filter_by(mail=email)
+		# Users are looked up on all shards, count() would not add up
+		users = DBSession.query(User).filter_by(mail=email).all()
 
-		if users.count() != 1:
+		if len(users) != 1:
 			raise FormError({"email": "No such user"})
 
-		user = users.one()
-		user.generate_recover_key()
+		# A retried request must not mail a different key
+		state = retry_state(self.request)
+		user = users[0]
+
+		if "recover_key" in state:
+			user.recover_key = state["recover_key"]
+		else:
+			user.generate_recover_key()
+			state["recover_key"] = user.recover_key
+
+		DBSession.flush()
 
-		msg = PasswordRecoveryMessage()
-		msg.send(self.request, user)
+		if not state.get("mailed"):
+			msg = PasswordRecoveryMessage()
+			msg.send(self.request, user)
+			state["mailed"] = True
 
 		self.flash("info", "Instructions on how to reset your password "
 					"have been sent to %s" % (email))
@@ -459,11 +445,11 @@ class PasswordResetController(WebisoderController):
 		if data.get("verify") != data.get("password"):
 			raise FormError({"verify": "Passwords do not match"})
 
-		query = DBSession.query(User).filter_by(mail=email)
-		if query.count() != 1:
+		users = DBSession.query(User).filter_by(mail=email).all()
+		if len(users) != 1:
 			raise FormError({"email": "No such user"})
 
-		user = query.one()
+		user = users[0]
 		if not key or key != user.recover_key:
 			raise FormError({"key": "Wrong recovery key"})
 
@@ -480,6 +466,8 @@ class SearchController(WebisoderController):
 
 		super(SearchController, self).__init__(request)
 		self.backend = TVDBWrapper
+		self.cache = search_cache
+		self.index = suggestions
 
 	@view_config(context=ValidationFailure)
 	def failure(self):
@@ -520,23 +508,40 @@ class SearchController(WebisoderController):
 		search = data.get("search")
 
 		engine = self.backend()
-		result = engine.search(search)
-
-		for row in result:
-			row["rating"] = ResultRating(search, row["seriesname"])
+		result = self.cache.search(search, engine)
+		self.index.add_results(result)
 
 		return { "shows": result, "search": search }
 
+	@view_config(route_name="suggest", renderer="json", request_method="GET",
+							permission="view")
+	def suggest(self):
+
+		text = self.request.GET.get("q", "")
+
+		self.index.refresh()
+		return self.index.lookup(text)
+
 
 @view_defaults(request_method="GET")
 class EpisodesController(WebisoderController):
 
+	def __init__(self, request):
+
+		super(EpisodesController, self).__init__(request)
+		self.calendar = airdates
+
 	def episodes(self, uid):
 
-		user = DBSession.query(User).get(uid)
+		user = user_query(self.request).get(uid)
 		then = date.today() - timedelta(int(user.days_back) or 0)
 
-		episodes = [e for e in user.episodes if e.airdate >= then]
+		shows = [s.id for s in user.shows if s.aired_since(then)]
+		episodes = self.calendar.episodes(shows, then,
+						read_session(self.request))
+
+		if episodes is None:
+			episodes = user.episodes_since(then)
 
 		return {
 			"episodes": sorted(episodes, key=lambda ep: ep.airdate),
@@ -566,8 +571,7 @@ class ProfileController(WebisoderController):
 	@view_config(permission="view", request_method="GET")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		return { "user": user }
 
@@ -576,20 +580,18 @@ class ProfileController(WebisoderController):
 	def failure(self):
 
 		e = self.request.exception
-		uid = self.request.authenticated_userid
 
 		self.flash("danger", "Failed to update profile")
 
 		res = self.request.POST
 		res["form_errors"] = e.error.asdict()
-		res["user"] = DBSession.query(User).get(uid)
+		res["user"] = self.user
 		return res
 
 	@view_config(permission="view", request_method="POST")
 	def post(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		controls = self.request.POST.items()
 		form = Form(ProfileForm())
@@ -611,8 +613,7 @@ class FeedSettingsController(WebisoderController):
 	@view_config(permission="view", request_method="GET")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		return { "user": user }
 
@@ -621,20 +622,18 @@ class FeedSettingsController(WebisoderController):
 	def failure(self):
 
 		e = self.request.exception
-		uid = self.request.authenticated_userid
 
 		self.flash("danger", "Failed to update profile")
 
 		res = self.request.POST
 		res["form_errors"] = e.error.asdict()
-		res["user"] = DBSession.query(User).get(uid)
+		res["user"] = self.user
 		return res
 
 	@view_config(permission="view", request_method="POST")
 	def post(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		controls = self.request.POST.items()
 		form = Form(FeedSettingsForm())
@@ -654,16 +653,14 @@ class TokenResetController(WebisoderController):
 	@view_config(permission="view", request_method="GET")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		return { "user": user }
 
 	@view_config(permission="view", request_method="POST")
 	def post(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 		user.reset_token()
 
 		self.request.session["feed_token"] = user.token
@@ -678,8 +675,7 @@ class PasswordChangeController(WebisoderController):
 	@view_config(permission="view", request_method="GET")
 	def get(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		return { "user": user }
 
@@ -688,20 +684,18 @@ class PasswordChangeController(WebisoderController):
 	def failure(self):
 
 		e = self.request.exception
-		uid = self.request.authenticated_userid
 
 		self.flash("danger", "Password change failed")
 
 		res = self.request.POST
 		res["form_errors"] = e.error.asdict()
-		res["user"] = DBSession.query(User).get(uid)
+		res["user"] = self.user
 		return res
 
 	@view_config(permission="view", request_method="POST")
 	def post(self):
 
-		uid = self.request.authenticated_userid
-		user = DBSession.query(User).get(uid)
+		user = self.user
 
 		controls = self.request.POST.items()
 		form = Form(PasswordForm())
@@ -738,6 +732,41 @@ class BannerController(WebisoderController):
 		res.content_type = "image/jpeg"
 		return res
 
+	@view_config(context=tvdb_error, http_cache=0)
+	def tvdb_failure(self):
+
+		log.warning("TVDB failure: %s" % self.request.exception)
+		return HTTPServiceUnavailable()
+
+@view_defaults(route_name="metrics", request_method="GET")
+class MetricsController(WebisoderController):
+
+	def __init__(self, request):
+
+		super(MetricsController, self).__init__(request)
+		self.metrics = metrics
+
+	@view_config()
+	def get(self):
+
+		# Not exposed at all unless a token is configured
+		if not self.metrics.token:
+			return HTTPNotFound()
+
+		auth = self.request.authorization
+
+		if not auth or auth[0].lower() != "bearer" or not compare_digest(
+					str(auth[1]), str(self.metrics.token)):
+			res = HTTPUnauthorized()
+			res.www_authenticate = "Bearer"
+			return res
+
+		res = Response(body=self.metrics.render())
+		res.content_type = "text/plain"
+		res.charset = "utf-8"
+		res.cache_control = "no-cache"
+		return res
+
 # TODO remove this
 @view_config(route_name="setup", renderer="templates/empty.pt",
 							request_method="GET")
@@ -752,6 +781,7 @@ def setup(request):
 
 	show = Show(id=1, name="show1", url="http://1")
 	show.updated = datetime.now()
+	show.next_airdate = show.updated.date()
 	DBSession.add(show)
 	user.shows.append(show)
 